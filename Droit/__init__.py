@@ -1,29 +1,46 @@
 from flask import Flask
 
 #import config
-from .views.home import home
-from .views.api import api
-from .views.dashboard import dashboard
-from .views.errors import register_error_page
-from .auth import login_manager
-from .auth.routes import auth
-
-def create_app() -> Flask:
+
+# startup profiles of a directory, see `create_app`
+PROFILES = ('full', 'api')
+
+def create_app(profile: str = 'full') -> Flask:
     """an flask app instance and initialize basic modules and plugins
-    
+
+    The blueprints are imported here rather than with the package, so that the modules of the package can be imported
+    without the web pages, the dashboard and the authentication.
+
+    Args:
+        profile (str): 'full' loads all blueprints, 'api' only loads the API blueprint used by clients and other
+            directories, and does not import the auth and dashboard dependencies (Authlib, Flask-SQLAlchemy, WTForms forms)
+
     Returns:
         app: the initialized flask app instance
     """
+    from .views.api import api
+    from .wire import init_wire_format
+
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown startup profile {profile}, expected one of {', '.join(PROFILES)}")
     app = Flask(__name__)
     #app.config.from_object(config.DevConfig)
 
-    # load flask-login
-    login_manager.init_app(app)
-
     # load views(routers)
-    app.register_blueprint(home, url_prefix = '/')
     app.register_blueprint(api, url_prefix = '/api')
-    app.register_blueprint(dashboard, url_prefix='/dashboard')
-    app.register_blueprint(auth, url_prefix='/auth')
-    register_error_page(app)
+    if profile == 'full':
+        from .views.home import home
+        from .views.dashboard import dashboard
+        from .views.errors import register_error_page
+        from .auth import login_manager
+        from .auth.routes import auth
+
+        # load flask-login
+        login_manager.init_app(app)
+        app.register_blueprint(home, url_prefix = '/')
+        app.register_blueprint(dashboard, url_prefix='/dashboard')
+        app.register_blueprint(auth, url_prefix='/auth')
+        register_error_page(app)
+    # negotiate the wire format and compression of the data exchanged with other directories
+    init_wire_format(app)
     return app
@@ -0,0 +1,120 @@
+"""
+Helpers defined in this file keep the aggregation data of the parent directory up to date without redundant updates.
+
+Each directory remembers which (thing type, location) pairs it has already reported to its parent, so an aggregation
+update is only sent when a location starts or stops holding a type.
+
+Each directory also counts the thing descriptions of each type it stores (`TypeCounter`), and the parent directories
+keep the number of thing descriptions of each type stored behind each location of their aggregation data. Every change
+of a count is reported to the parent with the current count (see Droit/reports.py), and a positive count adds the
+location to the parent's aggregation data if it is missing, so a parent that lost an aggregation entry recovers it with
+the next write of that type at the location.
+"""
+import threading
+from flask import current_app
+from werkzeug.local import LocalProxy
+from .models import TypeCounter, TypeToChildrenNames
+
+
+class ReportedAggregations(object):
+    """Process-local set of (thing type, location) pairs already reported to the parent directory
+
+    """
+
+    def __init__(self):
+        self._reported = set()
+        self._lock = threading.Lock()
+
+    def is_reported(self, thing_type: str, location: str) -> bool:
+        """Check whether the pair is already reported
+
+        """
+        return (thing_type, location) in self._reported
+
+    def add(self, thing_type: str, location: str) -> None:
+        """Record that the location is reported to hold the thing type
+
+        """
+        with self._lock:
+            self._reported.add((thing_type, location))
+
+    def discard(self, thing_type: str, location: str) -> None:
+        """Record that the location is reported not to hold the thing type any more
+
+        """
+        with self._lock:
+            self._reported.discard((thing_type, location))
+
+
+def _get_reported_aggregations() -> ReportedAggregations:
+    extensions = current_app.extensions
+    if 'reported_aggregations' not in extensions:
+        extensions['reported_aggregations'] = ReportedAggregations()
+    return extensions['reported_aggregations']
+
+
+reported_aggregations = LocalProxy(_get_reported_aggregations)
+
+
+def begin_type_write(thing_type: str) -> None:
+    """Record that thing descriptions of the type are about to be inserted or deleted in the current directory
+
+    Every call must be followed by one call to `update_type_count` once the thing descriptions are written, even if
+    none was, in a `finally` clause right after the write so a failing request does not leave the write in progress.
+    The counter of a type is not recounted while a write is in progress, see Droit/rebuild.py.
+
+    Args:
+        thing_type (str): the type of the thing descriptions to insert or delete
+    """
+    TypeCounter.objects(thing_type=thing_type).update_one(upsert=True, inc__pending=1, inc__version=1)
+
+
+def update_type_count(thing_type: str, delta: int) -> int:
+    """Atomically add 'delta' to the number of thing descriptions of the type stored in the current directory
+
+    It ends the write started by `begin_type_write`.
+
+    Args:
+        thing_type (str): the type of the inserted or deleted thing descriptions
+        delta (int): the number of inserted thing descriptions, negative for deleted ones
+
+    Returns:
+        int: the number of thing descriptions of the type after the update
+    """
+    counter = TypeCounter.objects(thing_type=thing_type).modify(upsert=True, new=True, inc__count=delta, inc__pending=-1)
+    return counter.count
+
+
+def get_location_count(thing_type: str, location: str) -> int:
+    """Return the number of thing descriptions of the type stored at the location, as known by the current directory
+
+    Args:
+        thing_type (str): the type of the thing descriptions
+        location (str): the current directory's name, or a location of its aggregation data
+
+    Returns:
+        int: the number of thing descriptions, 0 if unknown
+    """
+    if location == current_app.config.get('HOST_NAME'):
+        counter = TypeCounter.objects(thing_type=thing_type).first()
+        return counter.count if counter is not None else 0
+    children_locations = TypeToChildrenNames.objects(thing_type=thing_type).only('children_counts').first()
+    if children_locations is None or not children_locations.children_counts:
+        return 0
+    return children_locations.children_counts.get(location, 0)
+
+
+def set_location_count(thing_type: str, location: str, count: int) -> None:
+    """Record the number of thing descriptions of the type stored at a location of the aggregation data
+
+    Args:
+        thing_type (str): the type of the thing descriptions
+        location (str): the location reporting its count
+        count (int): the number of thing descriptions, 0 removes the location's count
+    """
+    field = f"children_counts__{location}"
+    if count > 0:
+        TypeToChildrenNames.objects(thing_type=thing_type).update_one(upsert=True, **{f"set__{field}": count})
+    else:
+        TypeToChildrenNames.objects(thing_type=thing_type).update_one(**{f"unset__{field}": True})
+
@@ -0,0 +1,207 @@
+"""
+The Bloom filters defined in this file summarise which thing_ids may be stored in the subtree of each child directory.
+
+Every directory reports the filter bits of the thing_ids registered locally to its parent, and forwards upward the bits
+newly set by its children's reports. So the filter a directory keeps for a child covers the whole subtree of that child,
+and a search by `thing_id` only needs to be sent to the children whose filter may contain the id.
+
+A Bloom filter never gives false negatives but may give false positives. Deleted thing_ids are not removed from the
+filters, they only make false positives more likely. All directories of a tree must use the same `ID_FILTER_BITS` and
+`ID_FILTER_HASHES` configuration, reports using other parameters are rejected.
+For more information about Bloom filters, please refer to https://en.wikipedia.org/wiki/Bloom_filter
+"""
+import hashlib
+import threading
+from flask import current_app
+from werkzeug.local import LocalProxy
+from mongoengine.errors import NotUniqueError
+from .models import IdFilter
+
+DEFAULT_FILTER_BITS = 1 << 20
+DEFAULT_FILTER_HASHES = 7
+MAX_UPDATE_ATTEMPTS = 10
+
+
+def get_indices(item: str, size: int, num_hashes: int) -> list:
+    """Return the positions of the bits set for the item in a filter of 'size' bits, using double hashing
+
+    """
+    digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+    first_hash = int.from_bytes(digest[:8], 'little')
+    second_hash = int.from_bytes(digest[8:], 'little') | 1
+    return [(first_hash + i * second_hash) % size for i in range(num_hashes)]
+
+
+class BloomFilter(object):
+    """Fixed-size Bloom filter of strings
+
+    Attributes:
+        size (int): number of bits of the filter
+        num_hashes (int): number of bits set for each item
+    """
+
+    def __init__(self, size: int = DEFAULT_FILTER_BITS, num_hashes: int = DEFAULT_FILTER_HASHES, bits: bytes = None):
+        self.size = size
+        self.num_hashes = num_hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    def indices(self, item: str) -> list:
+        return get_indices(item, self.size, self.num_hashes)
+
+    def is_set(self, index: int) -> bool:
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def set_indices(self, indices: list) -> list:
+        """Set the bits at the given positions
+
+        Returns:
+            list: the positions of the bits which were not set before
+        """
+        new_indices = []
+        for index in indices:
+            if not self.is_set(index):
+                self.bits[index >> 3] |= 1 << (index & 7)
+                new_indices.append(index)
+        return new_indices
+
+    def might_contain(self, item: str) -> bool:
+        """Check whether the item may have been added to the filter. False means it has certainly not been added
+
+        """
+        return all(self.is_set(index) for index in self.indices(item))
+
+    def update(self, other: 'BloomFilter') -> None:
+        """Set the bits set in another filter of the same size
+
+        """
+        self.bits = bytearray(byte | other_byte for byte, other_byte in zip(self.bits, other.bits))
+
+    def get_set_indices(self) -> list:
+        """Return the positions of all the bits set in the filter
+
+        """
+        return [(position << 3) + bit for position, byte in enumerate(self.bits) if byte
+                for bit in range(8) if byte & (1 << bit)]
+
+
+class IdFilters(object):
+    """Bloom filters of the thing_ids stored in the subtree of each child directory
+
+    The filters are stored in the `id_filters` collection, so they are shared by all processes of the directory, and
+    cached in the process. The cache is checked against the stored versions before it is used.
+
+    Attributes:
+        size (int): number of bits of the filters
+        num_hashes (int): number of bits set for each thing_id
+    """
+
+    def __init__(self, size: int = DEFAULT_FILTER_BITS, num_hashes: int = DEFAULT_FILTER_HASHES):
+        self.size = size
+        self.num_hashes = num_hashes
+        self._cache = {}  # directory name => (version, BloomFilter)
+        self._lock = threading.Lock()
+
+    def indices(self, thing_id: str) -> list:
+        """Return the positions of the filter bits set for the thing_id
+
+        """
+        return get_indices(thing_id, self.size, self.num_hashes)
+
+    def get_filters(self) -> dict:
+        """Return the up-to-date filter of each child directory which has reported thing_ids
+
+        Returns:
+            dict: mapping from child directory names to BloomFilter objects
+        """
+        versions = {id_filter.directory_name: id_filter.version
+                    for id_filter in IdFilter.objects().only('directory_name', 'version')}
+        with self._lock:
+            stale_names = [name for name, version in versions.items()
+                           if name not in self._cache or self._cache[name][0] != version]
+            if stale_names:
+                for id_filter in IdFilter.objects(directory_name__in=stale_names):
+                    self._cache[id_filter.directory_name] = (
+                        id_filter.version, BloomFilter(self.size, self.num_hashes, bits=id_filter.bits))
+            for name in list(self._cache):
+                if name not in versions:
+                    del self._cache[name]
+            return {name: self._cache[name][1] for name in versions if name in self._cache}
+
+    def might_contain(self, child_name: str, thing_id: str, filters: dict = None) -> bool:
+        """Check whether the subtree of the child directory may hold the thing_id
+
+        A child which has not reported any thing_id may hold it, since its reports could still be on their way.
+
+        Args:
+            child_name (str): name of a direct child of the current directory
+            thing_id (str): the thing_id to look for
+            filters (dict): the filters returned by `get_filters`, fetched if missing
+        """
+        if filters is None:
+            filters = self.get_filters()
+        bloom_filter = filters.get(child_name)
+        return bloom_filter is None or bloom_filter.might_contain(thing_id)
+
+    def get_subtree_indices(self, thing_ids) -> list:
+        """Return the positions of the bits set for the thing_ids stored in the subtree of the current directory
+
+        The filter of the subtree is the union of the filters of the children and of the bits of the local thing_ids.
+
+        Args:
+            thing_ids (iterable): the thing_ids registered in the current directory
+
+        Returns:
+            list: the positions of the bits, in increasing order
+        """
+        subtree_filter = BloomFilter(self.size, self.num_hashes)
+        for bloom_filter in self.get_filters().values():
+            subtree_filter.update(bloom_filter)
+        for thing_id in thing_ids:
+            subtree_filter.set_indices(self.indices(thing_id))
+        return subtree_filter.get_set_indices()
+
+    def add_indices(self, child_name: str, indices: list) -> list:
+        """Set the bits reported by a child directory in its filter
+
+        The filter is updated with an optimistic concurrency control on its version, so concurrent reports of the same
+        child are never lost.
+
+        Args:
+            child_name (str): name of the reporting child directory
+            indices (list): positions of the bits reported by the child
+
+        Returns:
+            list: the positions which were not set in the filter of any child before, they have to be reported to the
+                parent directory
+        """
+        filters = self.get_filters()
+        new_indices = [index for index in set(indices)
+                       if not any(bloom_filter.is_set(index) for bloom_filter in filters.values())]
+        for _ in range(MAX_UPDATE_ATTEMPTS):
+            id_filter = IdFilter.objects(directory_name=child_name).first()
+            if id_filter is None:
+                bloom_filter = BloomFilter(self.size, self.num_hashes)
+                bloom_filter.set_indices(indices)
+                try:
+                    IdFilter(directory_name=child_name, bits=bytes(bloom_filter.bits), version=1).save()
+                except NotUniqueError:
+                    continue
+                return new_indices
+            bloom_filter = BloomFilter(self.size, self.num_hashes, bits=id_filter.bits)
+            if not bloom_filter.set_indices(indices):
+                return new_indices
+            if IdFilter.objects(directory_name=child_name, version=id_filter.version).update_one(
+                    set__bits=bytes(bloom_filter.bits), inc__version=1):
+                return new_indices
+        raise RuntimeError(f"Failed to update the thing_id filter of '{child_name}'")
+
+
+def _get_id_filters() -> IdFilters:
+    extensions = current_app.extensions
+    if 'id_filters' not in extensions:
+        extensions['id_filters'] = IdFilters(current_app.config.get('ID_FILTER_BITS', DEFAULT_FILTER_BITS),
+                                             current_app.config.get('ID_FILTER_HASHES', DEFAULT_FILTER_HASHES))
+    return extensions['id_filters']
+
+
+id_filters = LocalProxy(_get_id_filters)
@@ -0,0 +1,148 @@
+"""
+The cache defined in this file keeps the responses of federated queries (`search` and `custom_query`) in memory.
+
+The result of a query only depends on the thing descriptions stored in the subtree of the directory answering it. Each
+directory keeps a subtree version number in mongodb, which is incremented by every local register or delete, and by every
+change reported by a child directory. A cached response is only returned if it was computed at the current subtree
+version, so a repeated query against an unchanged subtree is answered without reading mongodb or requesting children.
+
+The subtree version is read from mongodb at most every `SUBTREE_VERSION_CHECK_INTERVAL` seconds, changes made by the
+current process are seen immediately. The cache is bounded by `SEARCH_CACHE_MAX_ENTRIES` and `SEARCH_CACHE_MAX_BYTES`,
+least recently used responses are evicted first, and a response expires after `SEARCH_CACHE_TTL` seconds in any case.
+Responses missing the result of a child which failed to answer are not cached.
+
+The ancestors are notified of a change in the background (see Droit/reports.py), so a cached response may miss a change
+made d levels below the answering directory for about d * (`PARENT_REPORT_INTERVAL` + outbox delivery delay) +
+`SUBTREE_VERSION_CHECK_INTERVAL` seconds, and never longer than `SEARCH_CACHE_TTL` seconds. A client reading its own
+writes through an ancestor may not see them within that delay, which is why the cache is disabled by default
+(`SEARCH_CACHE_ENABLED`).
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+from flask import current_app
+from werkzeug.local import LocalProxy
+from .models import SubtreeVersion
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 60
+DEFAULT_VERSION_CHECK_INTERVAL = 1
+
+
+class VersionTracker(object):
+    """Process-local view of the subtree version of the current directory
+
+    Attributes:
+        check_interval (float): number of seconds after which the version is read from mongodb again
+    """
+
+    def __init__(self, check_interval: float = DEFAULT_VERSION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._version = None
+        self._checked_at = 0
+
+    def get(self) -> int:
+        """Return the subtree version, read from mongodb if the last read is too old
+
+        """
+        if self._version is None or time.monotonic() - self._checked_at > self.check_interval:
+            version = SubtreeVersion.objects().first()
+            self._version = version.version if version is not None else 0
+            self._checked_at = time.monotonic()
+        return self._version
+
+    def bump(self) -> int:
+        """Increment the subtree version after a change in the subtree
+
+        Returns:
+            int: the new subtree version
+        """
+        version = SubtreeVersion.objects().modify(upsert=True, new=True, inc__version=1)
+        self._version = version.version
+        self._checked_at = time.monotonic()
+        return self._version
+
+
+class ResultCache(object):
+    """In-memory LRU cache of serialized query responses, validated by the subtree version
+
+    Attributes:
+        max_entries (int): maximum number of cached responses
+        max_bytes (int): maximum total size of the cached responses
+        ttl (float): number of seconds after which a cached response expires, 0 means never
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES, ttl: float = DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key => (version, stored time, response body)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(endpoint: str, query: dict) -> str:
+        """Return the cache key of a query, independent of the order of its parameters
+
+        Args:
+            endpoint (str): name of the endpoint answering the query
+            query (dict): the normalised parameters of the query
+        """
+        return endpoint + json.dumps(query, sort_keys=True, separators=(',', ':'))
+
+    def get(self, key: str, version: int) -> bytes:
+        """Return the response cached for the key at the given version, or None
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry_version, stored_at, body = entry
+            if entry_version != version or (self.ttl and time.monotonic() - stored_at > self.ttl):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def put(self, key: str, version: int, body: bytes) -> None:
+        """Cache the response computed at the given version, evicting the least recently used responses if necessary
+
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (version, time.monotonic(), body)
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        _, _, body = self._entries.pop(key)
+        self._size -= len(body)
+
+
+def _get_subtree_version() -> VersionTracker:
+    extensions = current_app.extensions
+    if 'subtree_version' not in extensions:
+        extensions['subtree_version'] = VersionTracker(
+            current_app.config.get('SUBTREE_VERSION_CHECK_INTERVAL', DEFAULT_VERSION_CHECK_INTERVAL))
+    return extensions['subtree_version']
+
+
+def _get_result_cache() -> ResultCache:
+    extensions = current_app.extensions
+    if 'result_cache' not in extensions:
+        config = current_app.config
+        extensions['result_cache'] = ResultCache(config.get('SEARCH_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES),
+                                                 config.get('SEARCH_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+                                                 config.get('SEARCH_CACHE_TTL', DEFAULT_TTL))
+    return extensions['result_cache']
+
+
+subtree_version = LocalProxy(_get_subtree_version)
+result_cache = LocalProxy(_get_result_cache)
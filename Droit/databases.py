@@ -1,8 +1,46 @@
-from .models import ThingDescription, DirectoryNameToURL, TargetToChildName, TypeToChildrenNames
+from .models import ThingDescription, DirectoryNameToURL, TargetToChildName, TypeToChildrenNames, OutboxEvent, TypeCounter, IdFilter, SubtreeVersion
+from .models import AncestorSubtree
+from .models import reset_collections, get_db_alias
 from flask_pymongo import PyMongo
+from flask_mongoengine.connection import create_connections
+from mongoengine import connection as mongoengine_connection
+from pymongo import UpdateOne
 
 mongo = PyMongo()
 
+def get_thing_collection():
+    """Return the raw pymongo collection of thing descriptions
+
+    Hot read paths query it directly to skip the construction of mongoengine documents. It is the collection behind the
+    mongoengine connection, so reads always see the same database as the writes made through `ThingDescription`.
+
+    Returns:
+        pymongo.collection.Collection: the `td` collection of the current directory
+    """
+    return ThingDescription._get_collection()
+
+
+def reconnect_databases(app) -> None:
+    """Replace the mongodb clients of the flask app by new ones
+
+    pymongo clients are not fork-safe: a forked process must not use the clients created by its parent, whose connection
+    pools and locks are copied in an unknown state. This is called in each gunicorn worker, see Droit/server.py.
+
+    Args:
+        app (flask.Flask): the flask app of the current directory
+    """
+    with app.app_context():
+        alias = get_db_alias()
+    # the inherited clients are forgotten rather than closed, closing them may wait for a lock held in the parent process
+    for registry in (mongoengine_connection._connections, mongoengine_connection._dbs,
+                     mongoengine_connection._connection_settings):
+        registry.pop(alias, None)
+    create_connections(app.config)
+    reset_collections()
+    if mongo.cx is not None:
+        mongo.init_app(app)
+
+
 def clear_database() -> None:
     """Drop collections in the mongodb database in order to initialize it.
     
@@ -11,97 +49,54 @@ def clear_database() -> None:
     DirectoryNameToURL.drop_collection()
     TypeToChildrenNames.drop_collection()
     TargetToChildName.drop_collection()
+    OutboxEvent.drop_collection()
+    TypeCounter.drop_collection()
+    IdFilter.drop_collection()
+    SubtreeVersion.drop_collection()
+    AncestorSubtree.drop_collection()
 
 
-def init_dir_to_url(level: str) -> None:
-    """Initialize name-to-URL mappings for the current directory using contents specified by 'level'
-    
-    Args:
-        level(str): it specifies the level of current directory
-    """
+def init_routing_collections(level: str, topology, replace: bool = True) -> None:
+    """Initialize the routing collections of the current directory from the topology, with one bulk write per collection
 
-    DirectoryNameToURL.drop_collection()
-    if level == "level1":
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level2a',
-                           url='http://localhost:5002', relationship='child').save()
-        DirectoryNameToURL(directory_name='level2b',
-                           url='http://localhost:5003', relationship='child').save()
-    elif level == 'level2a':
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level1',
-                           url=f'http://localhost:5001', relationship='parent').save()
-        DirectoryNameToURL(directory_name='level3aa',
-                           url=f'http://localhost:5004', relationship='child').save()
-        DirectoryNameToURL(directory_name='level3ab',
-                           url=f'http://localhost:5005', relationship='child').save()
-    elif level == 'level2b':
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level1',
-                           url=f'http://localhost:5001', relationship='parent').save()
-    elif level == 'level3aa':
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level2a',
-                           url=f'http://localhost:5002', relationship='parent').save()
-    elif level == 'level3ab':
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level2a',
-                           url=f'http://localhost:5002', relationship='parent').save()
-        DirectoryNameToURL(directory_name='level4aba',
-                           url=f'http://localhost:5006', relationship='child').save()
-        DirectoryNameToURL(directory_name='level4abb',
-                           url=f'http://localhost:5007', relationship='child').save()
-    elif level == 'level4aba':
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level3ab',
-                           url=f'http://localhost:5005', relationship='parent').save()
-    elif level == 'level4abb':
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level3ab',
-                           url=f'http://localhost:5005', relationship='parent').save()
-        DirectoryNameToURL(directory_name='level5abba',
-                           url=f'http://localhost:5008', relationship='child').save()
-        DirectoryNameToURL(directory_name='level5abbb',
-                           url=f'http://localhost:5009', relationship='child').save()
-    elif level == 'level5abba':
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level4abb',
-                           url=f'http://localhost:5007', relationship='parent').save()
-    elif level == 'level5abbb':
-        DirectoryNameToURL(directory_name='master',
-                           url=f'http://localhost:5001', relationship='master').save()
-        DirectoryNameToURL(directory_name='level4abb',
-                           url=f'http://localhost:5007', relationship='parent').save()
-
-
-def init_target_to_child_name(level: str) -> None:
-    """Initialize the target-to-child mappings for the current directory
+    The name-to-URL mappings hold the master, the parent and the children directories, the target-to-child mappings
+    hold the child leading to each other descendant, and the ancestor subtrees hold the members of each ancestor's subtree.
 
     Args:
         level(str): it specifies the level of current directory
+        topology (Droit.topology.Topology): the tree of directories, see Droit/topology.py
+        replace (bool): if False, the mappings of the topology are upserted and the directories that joined at runtime
+            (see /api/join) are kept
     """
-    if level == 'level1':
-        TargetToChildName(target_name='level3aa', child_name='level2a').save()
-        TargetToChildName(target_name='level3ab', child_name='level2a').save()
-        TargetToChildName(target_name='level4aba', child_name='level2a').save()
-        TargetToChildName(target_name='level4abb', child_name='level2a').save()
-        TargetToChildName(target_name='level5abba', child_name='level2a').save()
-        TargetToChildName(target_name='level5abbb', child_name='level2a').save()
-    elif level == 'level2a':
-        TargetToChildName(target_name='level4aba', child_name='level3ab').save()
-        TargetToChildName(target_name='level4abb', child_name='level3ab').save()
-        TargetToChildName(target_name='level5abba', child_name='level3ab').save()
-        TargetToChildName(target_name='level5abbb', child_name='level3ab').save()
-    elif level == 'level3ab':
-        TargetToChildName(target_name='level5abba', child_name='level4abb').save()
-        TargetToChildName(target_name='level5abbb', child_name='level4abb').save()
-    else:
-        pass
+    AncestorSubtree.drop_collection()
+    if replace:
+        DirectoryNameToURL.drop_collection()
+        TargetToChildName.drop_collection()
+    if topology is None or level not in topology.urls:
+        return
+
+    parent = topology.parents[level]
+    directories = [DirectoryNameToURL(directory_name='master', url=topology.urls[topology.root], relationship='master')]
+    if parent is not None:
+        directories.append(DirectoryNameToURL(directory_name=parent, url=topology.urls[parent], relationship='parent'))
+    directories.extend(DirectoryNameToURL(directory_name=child, url=topology.urls[child], relationship='child')
+                       for child in topology.children[level])
+    mappings = [TargetToChildName(target_name=descendant, child_name=child)
+                for descendant, child in topology.get_descendant_to_child(level).items()]
+    ancestors = [AncestorSubtree(ancestor_name=ancestor, url=topology.urls[ancestor], depth=depth,
+                                 members=topology.get_subtree(ancestor))
+                 for depth, ancestor in enumerate(topology.get_ancestors(level), start=1)]
+
+    if ancestors:
+        AncestorSubtree._get_collection().insert_many([ancestor.to_mongo() for ancestor in ancestors])
+    for document_class, documents, key in ((DirectoryNameToURL, directories, 'loc'),
+                                           (TargetToChildName, mappings, 'targetLoc')):
+        if not documents:
+            continue
+        if replace:
+            document_class._get_collection().insert_many([document.to_mongo() for document in documents])
+        else:
+            document_class._get_collection().bulk_write([
+                UpdateOne({key: document[key]}, {"$set": document}, upsert=True)
+                for document in (document.to_mongo().to_dict() for document in documents)
+            ], ordered=False)
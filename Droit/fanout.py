@@ -0,0 +1,89 @@
+"""
+The executors defined in this file run the requests that a directory sends to its children in parallel.
+
+Each directory creates two thread pools when its app is initialized, shared by all its requests, so the number of child
+requests in flight stays bounded whatever the number of concurrent searches:
+    children_executor: `CHILDREN_REQUEST_WORKERS` threads reading whole child responses
+    stream_executor: `SEARCH_STREAM_WORKERS` threads relaying the streamed responses of children to NDJSON search clients.
+        A relay runs as long as its client reads, so the relays have their own pool, and slow streaming clients can not
+        hold up the other searches.
+Requests arriving while every thread of a pool is busy wait in its queue. The threads of a parent process do not survive
+a fork, so a forked worker process (see Droit/server.py) creates its own pools on first use. The pools are shut down
+when the process exits.
+"""
+import os
+import atexit
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_STREAM_WORKERS = 32
+
+
+class ChildrenExecutor(object):
+    """Thread pool of the current process sending requests of a directory to its children
+
+    Attributes:
+        max_workers (int): maximum number of requests in flight
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        """Return the thread pool of the current process, created on first use
+
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                        thread_name_prefix="children-requests")
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.get_executor().submit(fn, *args, **kwargs)
+
+    def map(self, fn, *iterables):
+        return self.get_executor().map(fn, *iterables)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the thread pool of the current process, the requests already submitted are still sent
+
+        """
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=wait)
+
+
+def init_children_executors(app) -> None:
+    """Create the executors of the directory of 'app', kept in its extensions and shut down when the process exits
+
+    Args:
+        app (flask.Flask): the flask app of the directory
+    """
+    executors = {
+        'children_executor': ChildrenExecutor(app.config.get('CHILDREN_REQUEST_WORKERS', DEFAULT_MAX_WORKERS)),
+        'stream_executor': ChildrenExecutor(app.config.get('SEARCH_STREAM_WORKERS', DEFAULT_STREAM_WORKERS)),
+    }
+    for name, executor in executors.items():
+        app.extensions[name] = executor
+        # do not wait for the children still answering, their results have no reader anymore
+        atexit.register(executor.shutdown, wait=False)
+
+
+def _get_executor(name: str) -> ChildrenExecutor:
+    if name not in current_app.extensions:
+        init_children_executors(current_app)
+    return current_app.extensions[name]
+
+
+children_executor = LocalProxy(partial(_get_executor, 'children_executor'))
+stream_executor = LocalProxy(partial(_get_executor, 'stream_executor'))
@@ -2,10 +2,71 @@
 Classes defined in this file are used with Mongodb ORM library mongoengine
 For more information, Please refer to its website: http://mongoengine.org/
 """
+from flask import current_app, has_app_context
 from mongoengine import DynamicDocument
-from mongoengine import StringField, IntField, ListField
+from mongoengine import StringField, IntField, ListField, BooleanField, DictField, DateTimeField, BinaryField
+from mongoengine.connection import get_db, DEFAULT_CONNECTION_NAME
 
-class ThingDescription(DynamicDocument):
+# (document class, connection alias) => pymongo collection, for the directories using their own connection alias
+_tenant_collections = {}
+
+
+def get_db_alias() -> str:
+    """Return the mongoengine connection alias of the current directory
+
+    Several directories may run in one process (see Droit/tenants.py). Each one registers its database under its own
+    `MONGODB_ALIAS`, outside of an app context the default connection is used.
+    """
+    if has_app_context():
+        return current_app.config.get('MONGODB_ALIAS', DEFAULT_CONNECTION_NAME)
+    return DEFAULT_CONNECTION_NAME
+
+
+def reset_collections() -> None:
+    """Forget the pymongo collections cached by the document classes, so they are taken again from the current connections
+
+    """
+    _tenant_collections.clear()
+    document_classes = [DirectoryDocument]
+    while document_classes:
+        document_class = document_classes.pop()
+        document_class._collection = None
+        document_classes.extend(document_class.__subclasses__())
+
+
+class DirectoryDocument(DynamicDocument):
+    """Base class of the documents stored in the database of the current directory
+
+    The database is selected by the connection alias of the current flask app when the collection is accessed, instead
+    of being fixed when the class is defined.
+    """
+    meta = {'abstract': True}
+
+    @classmethod
+    def _get_db(cls):
+        return get_db(get_db_alias())
+
+    @classmethod
+    def _get_collection(cls):
+        alias = get_db_alias()
+        if alias == DEFAULT_CONNECTION_NAME:
+            return super(DirectoryDocument, cls)._get_collection()
+        collection = _tenant_collections.get((cls, alias))
+        if collection is None:
+            collection = cls._get_db()[cls._get_collection_name()]
+            _tenant_collections[(cls, alias)] = collection
+            if cls._meta.get('auto_create_index', True):
+                cls.ensure_indexes()
+        return collection
+
+    @classmethod
+    def drop_collection(cls):
+        # the indexes are created again when the collection is accessed next time
+        _tenant_collections.pop((cls, get_db_alias()), None)
+        super(DirectoryDocument, cls).drop_collection()
+
+
+class ThingDescription(DirectoryDocument):
     """ORM class of Thing Description in the mongodb
 
     """
@@ -13,6 +74,11 @@ class ThingDescription(DynamicDocument):
     thing_id = StringField(db_field='thing_id',
                            required=True, unique=True, max_length=160)
     publicity = IntField(db_field='publicity', default=0)
+    # True when the thing description is a copy pushed up from a descendant directory (publicity > 0)
+    # it is left unset for thing descriptions registered at the current directory
+    replica = BooleanField(db_field='replica')
+    # name of the directory storing the original thing description, only set on copies
+    origin = StringField(db_field='origin')
 
     meta = {
         'collection': 'td',
@@ -26,7 +92,7 @@ class ThingDescription(DynamicDocument):
         return f"type: {self.thing_type}\tthing_id: {self.thing_id}\tpublicity: {self.publicity}"
 
 
-class DirectoryNameToURL(DynamicDocument):
+class DirectoryNameToURL(DirectoryDocument):
     """ORM class that represents the mapping between directory name and corresponding URL
 
     """
@@ -40,16 +106,34 @@ class DirectoryNameToURL(DynamicDocument):
         return f"Directory Name : {self.directory_name} --- URL : {self.url}"
 
 
-class TypeToChildrenNames(DynamicDocument):
+class TypeToChildrenNames(DirectoryDocument):
     """Class Contains the list of child locaions that has a certain type of devices
     """
     thing_type = StringField(db_field='type')
     children_names = ListField(StringField(), db_field='childLocs')
+    # number of thing descriptions of this type stored in each child location, reported by the children
+    children_counts = DictField(db_field='childCounts')
 
     meta = {'collection': 'type_to_childLocs'}
 
 
-class TargetToChildName(DynamicDocument):
+class TypeCounter(DirectoryDocument):
+    """ORM class that counts the thing descriptions of a certain type stored in the current directory
+
+    The counter is incremented and decremented in the same requests as the thing descriptions are inserted and deleted,
+    so it is kept in step with the `td` collection without counting it. `pending` is the number of insertions and
+    deletions of this type in progress, whose change is not counted yet, see `begin_type_write` in Droit/aggregation.py.
+    `version` is incremented when each of them starts.
+    """
+    thing_type = StringField(db_field='type', required=True, unique=True)
+    count = IntField(db_field='count', default=0)
+    pending = IntField(db_field='pending', default=0)
+    version = IntField(db_field='version', default=0)
+
+    meta = {'collection': 'type_counters'}
+
+
+class TargetToChildName(DirectoryDocument):
     """ORM class that represents tha mapping `target_name` => `child_name`
 
     In order to reach the 'target_name, what should the next search node at the current node
@@ -58,3 +142,60 @@ class TargetToChildName(DynamicDocument):
     target_name = StringField(db_field='targetLoc')
     child_name = StringField(db_field='childLoc')
     meta = {'collection': 'targetLoc_to_childLoc'}
+
+
+class AncestorSubtree(DirectoryDocument):
+    """ORM class that represents an ancestor directory of the current directory and the directories in its subtree
+
+    `depth` is 1 for the parent, 2 for the grandparent and so on. `members` holds the names of the ancestor itself and of all
+    its descendants, so the lowest common ancestor with any other directory is the ancestor of lowest depth listing it.
+    """
+    ancestor_name = StringField(db_field='loc', required=True)
+    url = StringField(db_field='url')
+    depth = IntField(db_field='depth')
+    members = ListField(StringField(), db_field='members')
+
+    meta = {'collection': 'ancestor_subtrees'}
+
+
+class OutboxEvent(DirectoryDocument):
+    """ORM class of a propagation event waiting to be delivered to the parent directory
+
+    `kind` selects how the event is delivered and `payload` holds its arguments, encoded in JSON so that thing
+    descriptions with any keys (e.g. starting with '$' or containing '.') can be stored. Events sharing the same `key`
+    concern the same thing or aggregation entry and are coalesced before delivery.
+    """
+    kind = StringField(db_field='kind', required=True)
+    key = StringField(db_field='key', required=True)
+    payload = StringField(db_field='payload')
+    attempts = IntField(db_field='attempts', default=0)
+    next_attempt_at = DateTimeField(db_field='nextAttemptAt')
+    lease_owner = StringField(db_field='leaseOwner')
+    lease_until = DateTimeField(db_field='leaseUntil')
+
+    meta = {
+        'collection': 'outbox',
+        'indexes': ['next_attempt_at']
+    }
+
+
+class IdFilter(DirectoryDocument):
+    """ORM class of the Bloom filter of the thing_ids stored in the subtree of a child directory, see Droit/bloom.py
+
+    `version` is incremented by every update of `bits`, it is used for optimistic concurrency control and cache validation.
+    """
+    directory_name = StringField(db_field='loc', required=True, unique=True)
+    bits = BinaryField(db_field='bits')
+    version = IntField(db_field='version', default=0)
+
+    meta = {'collection': 'id_filters'}
+
+
+class SubtreeVersion(DirectoryDocument):
+    """ORM class of the version number of the thing descriptions stored in the subtree of the current directory
+
+    The collection holds a single document, whose version is incremented by every change in the subtree, see Droit/cache.py
+    """
+    version = IntField(db_field='version', default=0)
+
+    meta = {'collection': 'subtree_version'}
@@ -0,0 +1,218 @@
+"""
+The outbox defined in this file delivers propagation events (push-up of thing descriptions, deletion of pushed-up copies
+and aggregation updates) to the parent directory in the background.
+
+Write requests only store an event in the `outbox` collection of the directory's mongodb database, and return as soon as
+the local write is committed. A background worker claims due events, coalesces the events concerning the same thing or
+the same aggregation entry, delivers them in batches using the handlers registered for each kind of event, and retries
+failed deliveries with an exponential backoff. Events are leased while being delivered, so several processes of the
+same directory can drain the outbox concurrently.
+"""
+import json
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from mongoengine.queryset.visitor import Q
+from .models import OutboxEvent
+
+DEFAULT_POLL_INTERVAL = 1
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_RETRY_BASE = 1
+DEFAULT_RETRY_MAX = 300
+DEFAULT_LEASE_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+
+def decode_payload(payload) -> dict:
+    """Decode the JSON payload of an event, the events stored by older versions hold a document instead
+
+    """
+    return json.loads(payload) if isinstance(payload, str) else payload
+
+
+class Outbox(object):
+    """Durable queue of propagation events drained by a background worker
+
+    The following configuration values are read from the flask app:
+        OUTBOX_ENABLED: whether propagation events are delivered in the background. Otherwise they are sent synchronously
+        OUTBOX_POLL_INTERVAL: number of seconds the worker waits when there is no due event
+        OUTBOX_BATCH_SIZE: maximum number of events claimed at once
+        OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX: the delay before retrying a failed event doubles from OUTBOX_RETRY_BASE seconds
+            after each failure, up to OUTBOX_RETRY_MAX seconds
+        OUTBOX_LEASE_SECONDS: number of seconds a claimed event is reserved for the worker delivering it
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self._wakeup = threading.Event()
+
+    def handler(self, kind: str):
+        """Decorator registering the function delivering a batch of events of the given kind
+
+        The decorated function receives the list of event payloads and returns True if all of them are delivered.
+
+        Args:
+            kind (str): the kind of event handled by the function
+        """
+        def decorator(function):
+            self.handlers[kind] = function
+            return function
+        return decorator
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the current app delivers propagation events in the background
+
+        """
+        return current_app.config.get('OUTBOX_ENABLED', False)
+
+    def put(self, kind: str, key: str, payload: dict) -> None:
+        """Store a new event in the outbox and wake up the worker
+
+        Args:
+            kind (str): the kind of event, which selects the handler delivering it
+            key (str): events with the same key concern the same object and are coalesced, only the last event of
+                each kind is delivered
+            payload (dict): the arguments given to the handler
+        """
+        OutboxEvent(kind=kind, key=key, payload=json.dumps(payload), next_attempt_at=datetime.utcnow()).save()
+        self._wakeup.set()
+
+    def put_once(self, kind: str, key: str, payload: dict) -> None:
+        """Store a new event in the outbox, unless an event of the same kind and key is already waiting to be claimed
+
+        This is meant for events whose handler reads the current state at delivery time, such as counters: any number of
+        changes made before the waiting event is claimed are delivered by that single event.
+
+        Args:
+            kind (str): the kind of event, which selects the handler delivering it
+            key (str): the key of the event, see `put`
+            payload (dict): the arguments given to the handler
+        """
+        OutboxEvent.objects(kind=kind, key=key, lease_owner=None).update_one(
+            upsert=True, set_on_insert__payload=json.dumps(payload), set_on_insert__attempts=0,
+            set_on_insert__next_attempt_at=datetime.utcnow())
+        self._wakeup.set()
+
+    def start(self, app) -> threading.Thread:
+        """Start the background worker draining the outbox of the flask app, if the outbox is enabled
+
+        Args:
+            app (flask.Flask): the flask app of the current directory
+        Returns:
+            threading.Thread: the worker thread, or None if the outbox is disabled
+        """
+        if not app.config.get('OUTBOX_ENABLED', False):
+            return None
+        worker = threading.Thread(target=self._run, args=(app,), name="outbox-worker", daemon=True)
+        worker.start()
+        return worker
+
+    def _run(self, app) -> None:
+        poll_interval = app.config.get('OUTBOX_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+        while True:
+            try:
+                # the handlers build URLs with 'url_for', which needs a request context
+                with app.test_request_context():
+                    drained = self.drain()
+            except Exception:
+                logger.exception("Failed to drain the outbox")
+                drained = 0
+            if drained == 0:
+                self._wakeup.wait(poll_interval)
+                self._wakeup.clear()
+
+    def drain(self) -> int:
+        """Claim a batch of due events and deliver them
+
+        For each key, only the last event of each kind is kept, and the kept events are delivered in their original order.
+        Events of the same kind are delivered in one call to the handler. If an event of a key fails, the following events
+        of the same key are postponed as well.
+
+        Returns:
+            int: the number of claimed events
+        """
+        config = current_app.config
+        events = self._claim(config.get('OUTBOX_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+                             config.get('OUTBOX_LEASE_SECONDS', DEFAULT_LEASE_SECONDS))
+        if not events:
+            return 0
+
+        # 1. coalesce: keep the last event of each (key, kind), ordered by the position of that last event
+        last_events = {}
+        for event in events:
+            last_events.pop((event.key, event.kind), None)
+            last_events[(event.key, event.kind)] = event
+        kept_ids = {event.id for event in last_events.values()}
+        superseded_ids = [event.id for event in events if event.id not in kept_ids]
+
+        # 2. split the kept events into rounds, the n-th round holds the n-th event of every key
+        rounds = []
+        positions = {}
+        for event in last_events.values():
+            position = positions.get(event.key, 0)
+            positions[event.key] = position + 1
+            if position == len(rounds):
+                rounds.append([])
+            rounds[position].append(event)
+
+        # 3. deliver each round, one handler call per kind
+        delivered_ids = list(superseded_ids)
+        failed_events = []
+        failed_keys = set()
+        for round_events in rounds:
+            events_by_kind = {}
+            for event in round_events:
+                if event.key in failed_keys:
+                    failed_events.append(event)
+                else:
+                    events_by_kind.setdefault(event.kind, []).append(event)
+            for kind, kind_events in events_by_kind.items():
+                if self._deliver(kind, kind_events):
+                    delivered_ids.extend(event.id for event in kind_events)
+                else:
+                    failed_events.extend(kind_events)
+                    failed_keys.update(event.key for event in kind_events)
+
+        if delivered_ids:
+            OutboxEvent.objects(id__in=delivered_ids).delete()
+        self._reschedule(failed_events, config.get('OUTBOX_RETRY_BASE', DEFAULT_RETRY_BASE),
+                         config.get('OUTBOX_RETRY_MAX', DEFAULT_RETRY_MAX))
+        return len(events)
+
+    def _claim(self, batch_size: int, lease_seconds: float) -> list:
+        now = datetime.utcnow()
+        not_leased = Q(lease_until=None) | Q(lease_until__lt=now)
+        candidate_ids = [event.id for event in OutboxEvent.objects(Q(next_attempt_at__lte=now) & not_leased)
+                         .order_by('id').limit(batch_size).only('id')]
+        if not candidate_ids:
+            return []
+        lease_owner = uuid.uuid4().hex
+        OutboxEvent.objects(Q(id__in=candidate_ids) & not_leased).update(
+            set__lease_owner=lease_owner, set__lease_until=now + timedelta(seconds=lease_seconds))
+        return list(OutboxEvent.objects(id__in=candidate_ids, lease_owner=lease_owner).order_by('id'))
+
+    def _deliver(self, kind: str, events: list) -> bool:
+        handler = self.handlers.get(kind)
+        if handler is None:
+            logger.error("No outbox handler for events of kind '%s'", kind)
+            return False
+        try:
+            return handler([decode_payload(event.payload) for event in events])
+        except Exception:
+            logger.exception("Failed to deliver outbox events of kind '%s'", kind)
+            return False
+
+    @staticmethod
+    def _reschedule(events: list, retry_base: float, retry_max: float) -> None:
+        now = datetime.utcnow()
+        for event in events:
+            delay = min(retry_base * (2 ** event.attempts), retry_max)
+            event.update(inc__attempts=1, set__next_attempt_at=now + timedelta(seconds=delay),
+                         unset__lease_owner=True, unset__lease_until=True)
+
+
+outbox = Outbox()
@@ -0,0 +1,140 @@
+"""
+The HTTP client defined in this file is shared by all requests sent from the current directory to other directories
+
+Directories always talk to the same handful of neighbours (parent, children and master), so one session with
+per-peer connection pools and keep-alive is kept per process, instead of opening a new TCP connection for every call.
+For more information about sessions and transport adapters, please refer to https://requests.readthedocs.io/
+"""
+import gzip
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from .wire import BSON_MIMETYPE, JSON_MIMETYPE, GZIP_LEVEL, REQUEST_ENCODING_HEADER
+
+DEFAULT_POOL_CONNECTIONS = 16
+DEFAULT_POOL_MAXSIZE = 32
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_WIRE_FORMAT = "bson"
+DEFAULT_GZIP_MIN_SIZE = 1024
+
+
+class PeerSession(object):
+    """Pooled, keep-alive HTTP client used for inter-directory requests
+
+    The following configuration values are read when the session is bound to a flask app:
+        PEER_POOL_CONNECTIONS: number of peer URLs (host and port) whose connection pools are kept
+        PEER_POOL_MAXSIZE: maximum number of idle connections kept for each peer
+        PEER_CONNECT_TIMEOUT: default timeout (in seconds) to establish a connection to a peer
+        PEER_READ_TIMEOUT: default timeout (in seconds) to wait for a peer's response
+        PEER_WIRE_FORMAT: "bson" to ask peers for BSON responses (peers not supporting it answer in JSON), or "json"
+        PEER_GZIP_MIN_SIZE: request bodies of at least this size (in bytes) are compressed with gzip, None means never.
+            Only the bodies sent to peers which advertised gzip in a previous response are compressed, see Droit/wire.py
+
+    Only one session exists per process. If several apps are bound to it, the configuration of the first one is used.
+    """
+
+    def __init__(self, app=None):
+        self.session = None
+        self.timeout = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+        self.wire_format = DEFAULT_WIRE_FORMAT
+        self.gzip_min_size = DEFAULT_GZIP_MIN_SIZE
+        self.pool_connections = DEFAULT_POOL_CONNECTIONS
+        self.pool_maxsize = DEFAULT_POOL_MAXSIZE
+        self.adapters = {}
+        # scheme and network location of the peers accepting request bodies compressed with gzip
+        self.gzip_peers = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Create the shared session using the configuration of the flask app
+
+        Args:
+            app (flask.Flask): the flask app whose configuration is used
+        """
+        app.extensions['peer_session'] = self
+        if self.session is not None:
+            return
+        self.timeout = (app.config.get('PEER_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+                        app.config.get('PEER_READ_TIMEOUT', DEFAULT_READ_TIMEOUT))
+        self.wire_format = app.config.get('PEER_WIRE_FORMAT', DEFAULT_WIRE_FORMAT)
+        self.gzip_min_size = app.config.get('PEER_GZIP_MIN_SIZE', DEFAULT_GZIP_MIN_SIZE)
+        self.pool_connections = app.config.get('PEER_POOL_CONNECTIONS', DEFAULT_POOL_CONNECTIONS)
+        self.pool_maxsize = app.config.get('PEER_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE)
+        self.session = self._create_session()
+
+    def reset(self) -> None:
+        """Replace the connection pools, for example in a worker process forked from a process which already used them
+
+        Pooled sockets inherited through a fork are shared with the parent process and must not be reused.
+        """
+        if self.session is not None:
+            self.session = self._create_session()
+
+    def mount(self, prefix: str, adapter) -> None:
+        """Send the requests whose URL starts with 'prefix' through another transport adapter
+
+        For example, the requests to directories hosted in the same process are served without network, see Droit/tenants.py
+
+        Args:
+            prefix (str): the URL prefix, such as "http://localhost:5002/"
+            adapter (requests.adapters.BaseAdapter): the transport adapter
+        """
+        self.adapters[prefix] = adapter
+        if self.session is not None:
+            self.session.mount(prefix, adapter)
+
+    def _create_session(self) -> requests.Session:
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        for prefix, local_adapter in self.adapters.items():
+            session.mount(prefix, local_adapter)
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request to another directory through the shared connection pools
+
+        Args:
+            method (str): HTTP method of the request
+            url (str): the full URL of the request
+            kwargs: any other arguments accepted by `requests.Session.request`. If 'timeout' is missing, the
+                configured connect/read timeouts are used. If the 'Accept' header is missing, the configured wire format
+                is asked for, see Droit/wire.py. Large 'data' bodies are compressed with gzip if the peer accepts them.
+
+        Returns:
+            requests.Response: the response of the peer directory
+        """
+        if self.session is None:
+            self.session = self._create_session()
+        kwargs.setdefault('timeout', self.timeout)
+        headers = dict(kwargs.get('headers') or {})
+        if 'Accept' not in headers and self.wire_format == "bson":
+            headers['Accept'] = f"{BSON_MIMETYPE}, {JSON_MIMETYPE};q=0.9"
+        data = kwargs.get('data')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        peer = urlsplit(url)[:2]
+        if isinstance(data, bytes) and self.gzip_min_size is not None and len(data) >= self.gzip_min_size and \
+                peer in self.gzip_peers:
+            kwargs['data'] = gzip.compress(data, GZIP_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
+        kwargs['headers'] = headers
+        response = self.session.request(method, url, **kwargs)
+        if 'gzip' in response.headers.get(REQUEST_ENCODING_HEADER, '').lower():
+            self.gzip_peers.add(peer)
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, **kwargs)
+
+
+peer_session = PeerSession()
@@ -0,0 +1,123 @@
+"""
+The rebuild defined in this file restores the state derived from the thing descriptions after a warm restart.
+
+A warm restart (`run.py --warm True`) keeps the mongodb database of the directory: the thing descriptions, the outbox of
+undelivered propagation events, the aggregation data and thing_id filters reported by the children, and the subtree
+version. Only the routing collections are derived again from the topology when the directory starts, and the
+process-local caches (routing table, referrals, results) start empty and fill up again with the traffic.
+
+The type counters are kept in step with the `td` collection by the requests, but a process stopped between the two writes
+leaves them off. After a warm restart, a background thread recounts the thing descriptions of each type, one type at a
+time, while the directory already serves requests. Requests mark their writes as pending on the counter of the type, and
+a type is only recounted between writes, so a recount never includes a thing description whose counter update is still
+to come. A type which is not idle within `PENDING_WRITES_MAX_WAIT` seconds, because it is written all the time or a
+write was interrupted without ending, is skipped and logged, so it does not hold up the other types. A counter is only rewritten if it is wrong, and only the types whose count changed are reported to the parent
+directory, so a restart does not send the aggregation data again.
+"""
+import time
+import logging
+import threading
+from mongoengine.errors import NotUniqueError
+from .databases import get_thing_collection
+from .models import TypeCounter
+from .views.api import propagate_aggregation, propagate_type_count
+
+# seconds to wait before counting a type again while some of its thing descriptions are being written
+PENDING_WRITES_RETRY_INTERVAL = 0.1
+# seconds after which a type whose thing descriptions are still being written is skipped
+PENDING_WRITES_MAX_WAIT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def reset_pending_writes() -> None:
+    """Forget the writes left in progress by the previous run, before the directory serves requests again
+
+    """
+    TypeCounter.objects(pending__nin=[0, None]).update(set__pending=0)
+
+
+def rebuild_type_count(thing_type: str, location: str) -> bool:
+    """Recount the thing descriptions of a type, fix its counter and report the change to the parent directory
+
+    The thing descriptions are only counted while no insertion or deletion of the type is in progress (see
+    `begin_type_write` in Droit/aggregation.py), and the counter is only replaced if no write started while they were
+    counted, which is checked with the version of the counter. Otherwise the type is counted again, until
+    `PENDING_WRITES_MAX_WAIT` seconds have passed.
+
+    Args:
+        thing_type (str): the type of the thing descriptions
+        location (str): the current directory's name
+
+    Returns:
+        bool: True if the counter was wrong, otherwise False. False as well if the type was skipped.
+    """
+    collection = get_thing_collection()
+    deadline = time.monotonic() + PENDING_WRITES_MAX_WAIT
+    while True:
+        if time.monotonic() > deadline:
+            logger.warning("Skipped the rebuild of the '%s' type counter, its thing descriptions are still being written",
+                           thing_type)
+            return False
+        counter = TypeCounter.objects(thing_type=thing_type).first()
+        if counter is not None and counter.pending:
+            time.sleep(PENDING_WRITES_RETRY_INTERVAL)
+            continue
+        stored_count = counter.count if counter is not None else 0
+        count = collection.count_documents({"thing_type": thing_type})
+        if count == stored_count:
+            return False
+        if counter is None:
+            try:
+                TypeCounter(thing_type=thing_type, count=count, pending=0, version=0).save(force_insert=True)
+            except NotUniqueError:
+                continue
+        elif TypeCounter.objects(thing_type=thing_type, version=counter.version, pending__in=[0, None]) \
+                .update_one(set__count=count) == 0:
+            continue
+        break
+
+    if (stored_count > 0) != (count > 0):
+        propagate_aggregation(thing_type, location, count > 0)
+    propagate_type_count(thing_type, location)
+    return True
+
+
+def rebuild_type_counters(location: str) -> int:
+    """Recount the thing descriptions of every type stored in the current directory or having a counter
+
+    Args:
+        location (str): the current directory's name
+
+    Returns:
+        int: the number of counters that were wrong
+    """
+    thing_types = set(get_thing_collection().distinct("thing_type"))
+    thing_types.update(counter.thing_type for counter in TypeCounter.objects().only('thing_type'))
+    thing_types.discard(None)
+    return sum(rebuild_type_count(thing_type, location) for thing_type in sorted(thing_types))
+
+
+def _run(app) -> None:
+    try:
+        # the propagation helpers build URLs with 'url_for' when the outbox is disabled, which needs a request context
+        with app.test_request_context():
+            fixed = rebuild_type_counters(app.config['HOST_NAME'])
+    except Exception:
+        logger.exception("Failed to rebuild the type counters")
+        return
+    logger.info("Warm restart of %s: rebuilt the type counters, %d were wrong", app.config['HOST_NAME'], fixed)
+
+
+def start_rebuild(app) -> threading.Thread:
+    """Start rebuilding the derived state of the flask app's directory in the background
+
+    Args:
+        app (flask.Flask): the flask app of the current directory
+
+    Returns:
+        threading.Thread: the rebuilding thread
+    """
+    worker = threading.Thread(target=_run, args=(app,), name="warm-rebuild", daemon=True)
+    worker.start()
+    return worker
@@ -0,0 +1,135 @@
+"""
+The referral cache defined in this file lets a directory reach remote directories directly, like a recursive DNS resolver.
+
+A location that is neither adjacent nor a descendant of the current directory is reached through the master directory.
+Every API response carries the name and the URL of the directory which answered it (`X-Directory-Name` and
+`X-Directory-URL`), and forwarding directories relay these headers back to their callers. When a forwarded request is
+answered by the target location itself, the directory learns the URL of that location and sends the next requests for it
+straight there, taking the master off the path. Learned referrals expire after `REFERRAL_TTL` seconds.
+
+Two kinds of negative answers are cached for `REFERRAL_NEGATIVE_TTL` seconds:
+    - unknown locations: the root directory marks the responses for a location it can not route with
+      `X-Directory-Unknown`, so the directories on the path answer the next requests for it without forwarding them.
+    - unreachable referrals: if a learned URL can not be reached, the location is reached through the master again and
+      no referral is learned for it until the negative entry expires.
+"""
+import time
+import threading
+from collections import OrderedDict
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+DIRECTORY_NAME_HEADER = "X-Directory-Name"
+DIRECTORY_URL_HEADER = "X-Directory-URL"
+UNKNOWN_LOCATION_HEADER = "X-Directory-Unknown"
+REFERRAL_HEADERS = (DIRECTORY_NAME_HEADER, DIRECTORY_URL_HEADER, UNKNOWN_LOCATION_HEADER)
+
+DEFAULT_TTL = 300
+DEFAULT_NEGATIVE_TTL = 30
+DEFAULT_MAX_ENTRIES = 4096
+
+REFERRAL = "referral"
+UNKNOWN = "unknown"
+UNREACHABLE = "unreachable"
+
+
+class ReferralCache(object):
+    """Process-local TTL cache of the URLs of remote directories learned from forwarded responses
+
+    Attributes:
+        ttl (float): number of seconds a learned referral is kept
+        negative_ttl (float): number of seconds an unknown location or an unreachable referral is remembered
+        max_entries (int): maximum number of cached locations, the oldest ones are evicted first
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # location => (kind, url, expiration time)
+        self._lock = threading.Lock()
+
+    def _get_entry(self, location: str) -> tuple:
+        entry = self._entries.get(location)
+        if entry is not None and time.monotonic() >= entry[2]:
+            del self._entries[location]
+            return None
+        return entry
+
+    def _put_entry(self, location: str, kind: str, url: str, ttl: float) -> None:
+        self._entries.pop(location, None)
+        self._entries[location] = (kind, url, time.monotonic() + ttl)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, location: str) -> str:
+        """Return the learned URL of the location, or None if there is no valid referral
+
+        """
+        with self._lock:
+            entry = self._get_entry(location)
+        return entry[1] if entry is not None and entry[0] == REFERRAL else None
+
+    def is_unknown(self, location: str) -> bool:
+        """Return whether the root directory recently answered that the location does not exist
+
+        """
+        with self._lock:
+            entry = self._get_entry(location)
+        return entry is not None and entry[0] == UNKNOWN
+
+    def learn(self, location: str, url: str) -> None:
+        """Cache the URL of the directory which answered a request for the location
+
+        Nothing is learned while the location is remembered as unreachable.
+        """
+        if not self.ttl or not url:
+            return
+        with self._lock:
+            entry = self._get_entry(location)
+            if entry is not None and entry[0] == UNREACHABLE:
+                return
+            self._put_entry(location, REFERRAL, url, self.ttl)
+
+    def mark_unknown(self, location: str) -> None:
+        if self.negative_ttl:
+            with self._lock:
+                self._put_entry(location, UNKNOWN, None, self.negative_ttl)
+
+    def mark_unreachable(self, location: str) -> None:
+        """Drop the referral of the location after its URL could not be reached
+
+        """
+        with self._lock:
+            entry = self._get_entry(location)
+            if entry is None or entry[0] != REFERRAL:
+                return
+            if self.negative_ttl:
+                self._put_entry(location, UNREACHABLE, None, self.negative_ttl)
+            else:
+                del self._entries[location]
+
+    def invalidate(self, location: str = None) -> None:
+        """Forget the cached answers for the location, or for every location if location is None
+
+        """
+        with self._lock:
+            if location is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(location, None)
+
+
+def _get_referral_cache() -> ReferralCache:
+    extensions = current_app.extensions
+    if 'referral_cache' not in extensions:
+        config = current_app.config
+        ttl = config.get('REFERRAL_TTL', DEFAULT_TTL) if config.get('REFERRAL_CACHE_ENABLED', True) else 0
+        negative_ttl = config.get('REFERRAL_NEGATIVE_TTL', DEFAULT_NEGATIVE_TTL) if ttl else 0
+        extensions['referral_cache'] = ReferralCache(ttl, negative_ttl,
+                                                     config.get('REFERRAL_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+    return extensions['referral_cache']
+
+
+referral_cache = LocalProxy(_get_referral_cache)
@@ -0,0 +1,111 @@
+"""
+The reports defined in this file coalesce the notifications that each write sends to the parent directory.
+
+A register or a delete changes the number of thing descriptions of a type and the subtree version of the directory. Both
+are only of interest to the ancestors as a current value, so instead of notifying the parent in every request, the write
+marks the change in a process-local set, and a background thread of the process sends the marked changes every
+`PARENT_REPORT_INTERVAL` seconds: one count report per (thing type, location), reading the count at that time, and one
+subtree version notification. A burst of writes is therefore reported once, and the requests never wait for the reports,
+even when the outbox is disabled.
+
+Additions and removals of a location in the parent's aggregation data (the count crossing zero) are not coalesced, see
+`propagate_aggregation` in Droit/views/api.py.
+"""
+import os
+import time
+import logging
+import threading
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+DEFAULT_REPORT_INTERVAL = 1
+
+logger = logging.getLogger(__name__)
+
+
+class PendingReports(object):
+    """Process-local changes waiting to be reported to the parent directory
+
+    Attributes:
+        interval (float): number of seconds between two reports
+    """
+
+    def __init__(self, interval: float = DEFAULT_REPORT_INTERVAL):
+        self.interval = interval
+        self._counts = set()
+        self._subtree_changed = False
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_pid = None
+
+    def add_count(self, thing_type: str, location: str) -> None:
+        """Mark the number of thing descriptions of the type stored at the location as changed
+
+        """
+        with self._lock:
+            self._counts.add((thing_type, location))
+
+    def add_subtree_change(self) -> None:
+        """Mark the subtree of the current directory as changed
+
+        """
+        with self._lock:
+            self._subtree_changed = True
+
+    def drain(self) -> tuple:
+        """Take the marked changes
+
+        Returns:
+            tuple: the set of changed (thing type, location) pairs, and whether the subtree changed
+        """
+        with self._lock:
+            counts, self._counts = self._counts, set()
+            subtree_changed, self._subtree_changed = self._subtree_changed, False
+        return counts, subtree_changed
+
+    def start(self, app, send) -> None:
+        """Start the background thread of the current process reporting the marked changes, unless it is running
+
+        The thread of a parent process does not survive a fork, so a forked process starts its own one.
+
+        Args:
+            app (flask.Flask): the flask app of the current directory
+            send (callable): called with the changed (thing type, location) pairs and whether the subtree changed,
+                returns the pairs and the subtree change that could not be reported, to retry them later
+        """
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher = threading.Thread(target=self._run, args=(app, send), name="parent-reports", daemon=True)
+            self._flusher_pid = os.getpid()
+        self._flusher.start()
+
+    def _run(self, app, send) -> None:
+        while True:
+            time.sleep(self.interval)
+            counts, subtree_changed = self.drain()
+            if not counts and not subtree_changed:
+                continue
+            try:
+                # the reports build URLs with 'url_for', which needs a request context
+                with app.test_request_context():
+                    failed_counts, subtree_failed = send(counts, subtree_changed)
+            except Exception:
+                logger.exception("Failed to report the changes to the parent directory")
+                failed_counts, subtree_failed = counts, subtree_changed
+            with self._lock:
+                self._counts.update(failed_counts)
+                self._subtree_changed = self._subtree_changed or subtree_failed
+
+
+def _get_pending_reports() -> PendingReports:
+    extensions = current_app.extensions
+    if 'pending_reports' not in extensions:
+        extensions['pending_reports'] = PendingReports(
+            current_app.config.get('PARENT_REPORT_INTERVAL', DEFAULT_REPORT_INTERVAL))
+    return extensions['pending_reports']
+
+
+pending_reports = LocalProxy(_get_pending_reports)
@@ -0,0 +1,201 @@
+"""
+The routing table defined in this file is a process-local copy of the directory name-to-URL mappings (`loc_to_url`),
+the target-to-child mappings (`targetLoc_to_childLoc`) and the ancestor subtrees (`ancestor_subtrees`) stored in mongodb.
+
+A location outside the subtree of the current directory is reached through the lowest common ancestor, i.e. the nearest
+ancestor whose subtree contains it, so traffic between neighbouring branches does not go through the master directory.
+
+Forwarded requests resolve the next-hop URL with dict lookups on this table instead of querying mongodb for every request.
+The table is loaded when the directory starts, reloaded after `invalidate()` is called (for example when the mappings are
+modified), and refreshed every `ROUTING_REFRESH_INTERVAL` seconds to pick up changes made by other processes.
+"""
+import time
+import threading
+from collections import namedtuple
+from flask import current_app
+from werkzeug.local import LocalProxy
+from .models import DirectoryNameToURL, TargetToChildName, AncestorSubtree
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+Directory = namedtuple('Directory', ['name', 'url'])
+Ancestor = namedtuple('Ancestor', ['name', 'url', 'members'])
+
+# An immutable snapshot of the routing collections. It is replaced as a whole when the table is reloaded,
+# so a request always sees consistent mappings
+Routes = namedtuple('Routes', ['directory_urls', 'parent', 'master', 'children', 'descendant_to_child', 'ancestors'])
+
+
+class RoutingTable(object):
+    """Process-local routing table of the current directory
+
+    Attributes:
+        refresh_interval (float): number of seconds after which the table is reloaded from mongodb, 0 means never
+    """
+
+    def __init__(self, refresh_interval: float = DEFAULT_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._routes = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def load(self) -> Routes:
+        """Read the routing collections from mongodb and replace the current snapshot
+
+        Returns:
+            Routes: the new snapshot
+        """
+        directory_urls = {}
+        parent = master = None
+        children = {}
+        for directory in DirectoryNameToURL.objects():
+            directory_urls[directory.directory_name] = directory.url
+            if directory.relationship == 'parent':
+                parent = Directory(directory.directory_name, directory.url)
+            elif directory.relationship == 'child':
+                children[directory.directory_name] = directory.url
+            if directory.directory_name == 'master':
+                master = Directory(directory.directory_name, directory.url)
+        descendant_to_child = {
+            mapping.target_name: mapping.child_name for mapping in TargetToChildName.objects()
+        }
+        # from the parent up to the root
+        ancestors = [
+            Ancestor(ancestor.ancestor_name, ancestor.url, frozenset(ancestor.members))
+            for ancestor in AncestorSubtree.objects().order_by('depth')
+        ]
+        routes = Routes(directory_urls, parent, master, children, descendant_to_child, ancestors)
+        self._routes = routes
+        self._loaded_at = time.monotonic()
+        return routes
+
+    def invalidate(self) -> None:
+        """Drop the current snapshot, the next lookup will reload it from mongodb
+
+        """
+        self._routes = None
+
+    @property
+    def routes(self) -> Routes:
+        """The current snapshot of the routing table, loaded or refreshed if necessary
+
+        Only one thread reloads an expired snapshot, other threads keep using the previous one meanwhile.
+        """
+        routes = self._routes
+        if routes is None:
+            with self._lock:
+                routes = self._routes
+                return routes if routes is not None else self.load()
+        if self.refresh_interval and time.monotonic() - self._loaded_at > self.refresh_interval:
+            if self._lock.acquire(blocking=False):
+                try:
+                    return self.load()
+                finally:
+                    self._lock.release()
+        return routes
+
+    @property
+    def parent(self) -> Directory:
+        """The parent directory, or None if the current directory is the root
+
+        """
+        return self.routes.parent
+
+    @property
+    def master(self) -> Directory:
+        """The master (root) directory of the tree, or None if it is unknown
+
+        """
+        return self.routes.master
+
+    @property
+    def children(self) -> dict:
+        """Mapping from the names of the direct children directories to their URLs
+
+        """
+        return self.routes.children
+
+    @property
+    def descendants(self) -> list:
+        """Names of all the descendant directories, children first
+
+        """
+        routes = self.routes
+        return list(routes.children) + [name for name in routes.descendant_to_child if name not in routes.children]
+
+    def get_child_name(self, location: str) -> str:
+        """Return the name of the direct child leading to the 'location' directory, or None if 'location' is not in the subtree
+
+        Args:
+            location (str): name of a child or descendant directory
+        """
+        routes = self.routes
+        if location in routes.children:
+            return location
+        return routes.descendant_to_child.get(location)
+
+    def get_route_url(self, location: str) -> str:
+        """Return the base URL of the adjacent directory leading to the 'location' directory, without the master fallback
+
+        Args:
+            location (str): the target location to be reached
+
+        Returns:
+            str: the base URL of the adjacent directory, or None if 'location' is neither adjacent nor a descendant
+        """
+        routes = self.routes
+        if location in routes.directory_urls:
+            return routes.directory_urls[location]
+        child_name = routes.descendant_to_child.get(location)
+        if child_name is not None and child_name in routes.directory_urls:
+            return routes.directory_urls[child_name]
+        return None
+
+    def get_next_hop_url(self, location: str) -> str:
+        """Return the base URL of the next directory to request in order to reach the 'location' directory
+
+        The location is looked up in the adjacent directories first, then in the descendant directories, then in the
+        subtrees of the ancestors: the lowest common ancestor is the next hop, skipping the ancestors in between.
+        Otherwise, if the current directory is not the root, the master directory is the next hop.
+
+        Args:
+            location (str): the target location to be reached
+
+        Returns:
+            str: the base URL of the next hop, or None if the location can not be reached
+        """
+        route_url = self.get_route_url(location)
+        if route_url is not None:
+            return route_url
+        routes = self.routes
+        for ancestor in routes.ancestors:
+            if location in ancestor.members:
+                return ancestor.url
+        if routes.parent is not None and routes.master is not None:
+            return routes.master.url
+        return None
+
+
+def init_routing_table(app) -> RoutingTable:
+    """Create the routing table of the flask app and load it from mongodb
+
+    Args:
+        app (flask.Flask): the flask app of the current directory
+    Returns:
+        RoutingTable: the loaded routing table
+    """
+    table = RoutingTable(app.config.get('ROUTING_REFRESH_INTERVAL', DEFAULT_REFRESH_INTERVAL))
+    app.extensions['routing_table'] = table
+    table.load()
+    return table
+
+
+def _get_routing_table() -> RoutingTable:
+    extensions = current_app.extensions
+    if 'routing_table' not in extensions:
+        extensions['routing_table'] = RoutingTable(
+            current_app.config.get('ROUTING_REFRESH_INTERVAL', DEFAULT_REFRESH_INTERVAL))
+    return extensions['routing_table']
+
+
+routing_table = LocalProxy(_get_routing_table)
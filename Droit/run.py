@@ -1,8 +1,13 @@
 from flask import Flask
 from flask_mongoengine import MongoEngine
 from .auth.models import auth_db
-from .databases import init_dir_to_url, init_target_to_child_name, clear_database
+from .databases import clear_database
 from .databases import mongo
+from .peers import peer_session
+from .fanout import init_children_executors
+from .routing import init_routing_table
+from .outbox import outbox
+from .rebuild import start_rebuild, reset_pending_writes
 from .auth.oauth2 import oauth, config_oauth, initiate_providers
 from .views.home import home
 from .views.api import api
@@ -10,28 +15,30 @@ from .views.dashboard import dashboard
 from .views.errors import register_error_page
 from .auth import login_manager
 from .auth.routes import auth
+from .wire import init_wire_format
+from .server import run_server
+from config import DevConfig
 import os
 
-SingleConfig = {
+# the tuning settings are shared with the directories of the topology file, see config.py
+SingleConfig = dict(DevConfig.to_dict(), **{
     'SECRET_KEY': os.urandom(128),
     'HOST_NAME': "SingleDirectory",
     'ENV_NAME': "SingleDirectory-Dev",
     'PORT': 4999,
     # mongo engine
-    'MONGODB_HOST': 'localhost',
-    'MONGODB_PORT': 27017,
     'MONGODB_DB': 'SingleDirectory',
     # pymongo
-    'MONGO_URI': "mongodb://localhost:27017/SingleDirectory",
+    'MONGO_URI': f"mongodb://{DevConfig.MONGODB_HOST}:{DevConfig.MONGODB_PORT}/SingleDirectory",
     # OAUth2
     'OAUTH2_JWT_ENABLED': True,
     'OAUTH2_JWT_ISS': 'http://localhost:4999/',
     'OAUTH2_JWT_KEY': 'SingleDirectory-secret',
     'OAUTH2_JWT_ALG': 'HS256',
     'OAUTH2_JWT_EXP': 3600
-}
+})
 
-def main(init_db=True, debug=True, host='localhost'):
+def main(init_db=True, debug=False, host='localhost', server='dev', workers=None, threads=None, warm=False):
     app = Flask(__name__)
 
     # load flask-login
@@ -43,6 +50,8 @@ def main(init_db=True, debug=True, host='localhost'):
     app.register_blueprint(dashboard, url_prefix='/dashboard')
     app.register_blueprint(auth, url_prefix='/auth')
     register_error_page(app)
+    # negotiate the wire format and compression of the data exchanged with other directories
+    init_wire_format(app)
 
     # initialize Flask app
     app.config.update(**SingleConfig)
@@ -50,6 +59,10 @@ def main(init_db=True, debug=True, host='localhost'):
     # initialize db connections for mongo engine, and pymongo
     mongo_db = MongoEngine(app)
     mongo.init_app(app)
+    # initialize the pooled HTTP client used to talk to other directories
+    peer_session.init_app(app)
+    # initialize the thread pools sending the requests of this directory to its children
+    init_children_executors(app)
     # initialize flask-sqlalchemy used by OAuth 2.0 and OpenID Connect 1.0
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///./SingleDirectory.db'
     auth_db.init_app(app)
@@ -58,15 +71,30 @@ def main(init_db=True, debug=True, host='localhost'):
     config_oauth(app)
     initiate_providers('SingleDirectory')
     
-    if init_db:
+    app.config['WARM_RESTART'] = warm
+    if init_db and not warm:
         with app.app_context():
             # Create all tables for authentication
             auth_db.create_all()
         # Initialize IoT related tables in MongoDB
         clear_database()
-        init_dir_to_url('SingleDirectory')
-        init_target_to_child_name('SingleDirectory')
+    elif warm:
+        reset_pending_writes()
+    # load the routing collections into the process-local routing table
+    init_routing_table(app)
+    if server == 'gunicorn':
+        # the background workers run in one gunicorn worker process, see Droit/server.py
+        run_server(app, host, app.config["PORT"], workers, threads, on_elected=start_background_workers)
+        return
+    start_background_workers(app)
     app.run(debug = debug, host= host, port= app.config["PORT"])
+
+
+def start_background_workers(app):
+    # deliver propagation events to the parent directory, and rebuild the derived state after a warm restart
+    outbox.start(app)
+    if app.config.get('WARM_RESTART', False):
+        start_rebuild(app)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
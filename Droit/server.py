@@ -0,0 +1,111 @@
+"""
+The server defined in this file runs a directory under gunicorn, a pre-forking WSGI server, instead of the Werkzeug
+development server started by `app.run`.
+
+The app is created and initialized once in the master process (`preload_app`), then forked into `SERVER_WORKERS` worker
+processes serving `SERVER_THREADS` requests each, so a directory keeps answering while its own recursive requests come
+back into it. Each worker opens its own mongodb and HTTP connections, since they are not fork-safe, and the master process
+runs no background thread while it forks workers.
+The background workers (outbox and warm restart rebuild) run in one worker process only: the workers compete for a lock
+file, and the one holding it starts them. If that worker exits, another one takes the lock over. Sending SIGHUP to the master gracefully replaces the workers, and SIGTERM stops them after their current
+requests, waiting at most `SERVER_GRACEFUL_TIMEOUT` seconds.
+gunicorn is not available on Windows, where the development server has to be used.
+For more information about gunicorn, please refer to https://docs.gunicorn.org/
+"""
+import os
+import time
+import tempfile
+import threading
+import multiprocessing
+from .peers import peer_session
+from .databases import reconnect_databases
+
+DEFAULT_THREADS = 8
+DEFAULT_TIMEOUT = 60
+DEFAULT_GRACEFUL_TIMEOUT = 30
+DEFAULT_LOCK_RETRY_INTERVAL = 5
+
+
+def get_default_workers() -> int:
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def get_lock_path(app) -> str:
+    """Return the path of the lock file electing the worker process running the background workers of the directory
+
+    """
+    return app.config.get('SERVER_LOCK_FILE') or os.path.join(
+        tempfile.gettempdir(), f"goldie-{app.config['HOST_NAME']}-{app.config['PORT']}.lock")
+
+
+def run_when_elected(app, on_elected) -> None:
+    """Wait until the current worker process holds the lock file of the directory, then call 'on_elected' with the app
+
+    The lock is released by the operating system when the process exits, so another worker takes it over.
+    """
+    import fcntl
+
+    lock_file = open(get_lock_path(app), 'a')
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except OSError:
+            time.sleep(DEFAULT_LOCK_RETRY_INTERVAL)
+    # the lock is held as long as the file stays open
+    app.extensions['server_lock'] = lock_file
+    on_elected(app)
+
+
+def run_server(app, host: str, port: int, workers: int = None, threads: int = None, on_elected=None) -> None:
+    """Serve the flask app with gunicorn until the master process is stopped
+
+    Args:
+        app (flask.Flask): the initialized flask app of the current directory
+        host (str): the host that the server listens on
+        port (int): the port that the server listens on
+        workers (int): number of worker processes, `SERVER_WORKERS` of the app config if missing
+        threads (int): number of threads of each worker process, `SERVER_THREADS` of the app config if missing
+        on_elected (callable): optional, called with the app in exactly one worker process at a time, to start the
+            background workers of the directory
+    Raises:
+        RuntimeError: if gunicorn is not installed
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise RuntimeError("gunicorn is required to run the production server, install it with `pip install gunicorn`")
+
+    def post_fork(server, worker):
+        # connections opened by the master process must not be shared with the workers
+        peer_session.reset()
+        reconnect_databases(app)
+
+    def post_worker_init(worker):
+        if on_elected is not None:
+            threading.Thread(target=run_when_elected, args=(app, on_elected), name="server-election", daemon=True).start()
+
+    options = {
+        'bind': f"{host}:{port}",
+        'workers': workers or app.config.get('SERVER_WORKERS') or get_default_workers(),
+        'threads': threads or app.config.get('SERVER_THREADS', DEFAULT_THREADS),
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'timeout': app.config.get('SERVER_TIMEOUT', DEFAULT_TIMEOUT),
+        'graceful_timeout': app.config.get('SERVER_GRACEFUL_TIMEOUT', DEFAULT_GRACEFUL_TIMEOUT),
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        # several directories may run on the same host, they must not share the control socket of recent gunicorn versions
+        'control_socket_disable': True,
+    }
+
+    class DirectoryServer(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                if key in self.cfg.settings:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    DirectoryServer().run()
@@ -0,0 +1,64 @@
+"""
+Helpers defined in this file measure the cold start of a directory: the time until its app is ready to serve requests,
+and the resident memory of the process at that point.
+
+The measures of each directory are kept in `app.extensions['startup']` and printed by run.py, so the startup profiles
+(see `create_app` in Droit/__init__.py) can be compared on the same machine.
+"""
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def get_resident_memory() -> int:
+    """Return the resident memory of the current process in bytes
+
+    On Linux, the current resident memory is read from /proc. Otherwise the peak resident memory is returned.
+
+    Returns:
+        int: the number of bytes, or None if it can not be measured on this platform
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def record_startup(app, started_at: float, profile: str) -> dict:
+    """Measure the cold start of the directory of 'app' and keep the measures in its extensions
+
+    Args:
+        app (flask.Flask): the initialized flask app of the directory
+        started_at (float): the `time.perf_counter()` value when the startup began
+        profile (str): the startup profile of the app
+
+    Returns:
+        dict: the startup profile, the startup time in seconds and the resident memory in bytes (None if unknown)
+    """
+    measures = {
+        "profile": profile,
+        "seconds": time.perf_counter() - started_at,
+        "resident_memory": get_resident_memory(),
+    }
+    app.extensions['startup'] = measures
+    return measures
+
+
+def format_startup(name: str, measures: dict) -> str:
+    """Describe the startup measures of a directory in one line
+
+    """
+    memory = measures["resident_memory"]
+    memory = f"{memory / (1 << 20):.1f} MiB resident" if memory is not None else "resident memory unknown"
+    return f"Directory {name} ({measures['profile']} profile) started in {measures['seconds']:.2f} s, {memory}"
@@ -10,42 +10,71 @@ $(".result table tbody").on("click", "button", function () {
 });
 
 
-// Register click event for the 'search' button
-$("#search").click(function () {
-    let form_data = $(".register-form").serialize();
-    let request_url = `${SEARCH_API}?${form_data}`
+// Number of thing descriptions requested per page
+const SEARCH_PAGE_SIZE = 100;
+// Continuation token of the next page, null when the last page is loaded
+let nextCursor = null;
+let searchFormData = "";
 
-    /** Send asynchronous request to delete the thing description */
-    let $resultContainer = $('.result');
+const $loadMoreButton = $("#load_more");
 
-    $resultContainer.hide();
-    lock_btn($(this));
-    fetch(request_url)
-        .then(response => response.json())
+/** Append each thing description to the result table */
+const render_things = function (data) {
+    let $tableBody = $(".result table tbody");
+    data.forEach(element => {
+        $tableBody.append(`<tr>
+        <td>${element.thing_id}</td>
+        <td>${element.thing_type}</td>
+        <td>${element.title}</td>
+        <td>
+            <button class="btn btn-primary">Show</button>
+            <div hidden>
+                ${JSON.stringify(element)}
+            </div>
+        </td>
+        </tr>`);
+    });
+}
+
+/** Send asynchronous request to get one page of the search result */
+const load_page = function ($button) {
+    let request_url = `${SEARCH_API}?${searchFormData}&limit=${SEARCH_PAGE_SIZE}`;
+    if (nextCursor) {
+        request_url += `&cursor=${encodeURIComponent(nextCursor)}`;
+    }
+    lock_btn($button);
+    return fetch(request_url)
+        .then(response => {
+            if (!response.ok) {
+                throw response;
+            }
+            nextCursor = response.headers.get("X-Next-Cursor");
+            return response.json();
+        })
         .then(data => {
-            // Show result list 
-            $resultContainer.show();
-            // render each thing description
-            $tableBody = $(".result table tbody");
-            $tableBody.html("");
-            data.forEach(element => {
-                $tableBody.append(`<tr>
-                <td>${element.thing_id}</td>
-                <td>${element.thing_type}</td>
-                <td>${element.title}</td>
-                <td>
-                    <button class="btn btn-primary">Show</button>
-                    <div hidden>
-                        ${JSON.stringify(element)}
-                    </div>
-                </td>
-                </tr>`);
-            });
-
-            unlock_btn($(this));
+            render_things(data);
+            $loadMoreButton.toggle(nextCursor !== null);
+            unlock_btn($button);
         })
         .catch(response => {
             show_prompt('Search failed, please try again using valid input');
-            unlock_btn($(this));
+            unlock_btn($button);
         });
-});
\ No newline at end of file
+}
+
+// Register click event for the 'search' button
+$("#search").click(function () {
+    searchFormData = $(".register-form").serialize();
+    nextCursor = null;
+
+    let $resultContainer = $('.result');
+    $resultContainer.hide();
+    $(".result table tbody").html("");
+    $loadMoreButton.hide();
+    load_page($(this)).then(() => $resultContainer.show());
+});
+
+// Register click event for the 'load more' button
+$loadMoreButton.click(function () {
+    load_page($(this));
+});
@@ -0,0 +1,112 @@
+"""
+Helpers defined in this file host several directories in one process (multi-tenant mode).
+
+Each directory keeps its own flask app, configuration and database, selected by its `MONGODB_ALIAS` (see Droit/models.py),
+while the process shares one interpreter, one mongodb client (mongoengine reuses the client of connections with the same
+settings) and the inter-directory HTTP session of Droit/peers.py. Every app listens on the port of its configuration.
+
+Requests between co-hosted directories skip the network: the URLs of the co-hosted directories are mounted on the peer
+session with `LocalAdapter`, which calls the WSGI app of the target directory in the calling thread.
+
+Requests are dispatched by port only: the directories build the URLs of other directories with `url_for`, so they can not
+be mounted under a path prefix of a shared server.
+"""
+import io
+import logging
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from werkzeug.serving import make_server
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from .peers import peer_session
+from .outbox import outbox
+
+# headers computed again for the in-process request, or useless without network
+SKIPPED_REQUEST_HEADERS = {'host', 'content-length', 'connection', 'accept-encoding'}
+LOCAL_HOSTNAMES = ('localhost', '127.0.0.1')
+
+logger = logging.getLogger(__name__)
+
+
+class LocalAdapter(BaseAdapter):
+    """Transport adapter of `requests` sending the requests to a WSGI app of the current process
+
+    The response is always read entirely before it is returned: a streamed response would keep the request context of
+    the co-hosted app pushed in the calling thread while the caller reads it.
+
+    Args:
+        wsgi_app: the WSGI app of the co-hosted directory
+    """
+
+    def __init__(self, wsgi_app):
+        super().__init__()
+        self.wsgi_app = wsgi_app
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlsplit(request.url)
+        headers = [(name, value) for name, value in request.headers.items()
+                   if name.lower() not in SKIPPED_REQUEST_HEADERS]
+        body = request.body.encode('utf-8') if isinstance(request.body, str) else request.body
+        environ = EnvironBuilder(path=url.path, query_string=url.query, base_url=f"{url.scheme}://{url.netloc}",
+                                 method=request.method, headers=headers, data=body).get_environ()
+        app_iter, status, response_headers = run_wsgi_app(self.wsgi_app, environ, buffered=True)
+
+        response = requests.Response()
+        status_code, _, reason = status.partition(' ')
+        response.status_code = int(status_code)
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(response_headers.items())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(b"".join(app_iter))
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def mount_local_app(app, host: str) -> None:
+    """Serve the requests sent to the URLs of the directory of 'app' in-process
+
+    Args:
+        app (flask.Flask): the app of a co-hosted directory
+        host (str): the host that the directories are running on
+    """
+    adapter = LocalAdapter(app)
+    port = app.config['PORT']
+    for hostname in set(LOCAL_HOSTNAMES + (host,)):
+        peer_session.mount(f"http://{hostname}:{port}/", adapter)
+
+
+def serve_tenants(apps: list, host: str, on_start=outbox.start) -> None:
+    """Serve several directory apps in the current process until it is interrupted
+
+    Args:
+        apps (list[flask.Flask]): the initialized apps of the directories, each one listens on the `PORT` of its config
+        host (str): the host that the directories are running on
+        on_start (callable): called with each app to start its background workers, by default the outbox worker
+    """
+    for app in apps:
+        if app.config.get('TENANT_LOCAL_CALLS', True):
+            mount_local_app(app, host)
+    servers = [make_server(host, app.config['PORT'], app, threaded=True) for app in apps]
+    for app in apps:
+        on_start(app)
+
+    threads = []
+    for app, server in zip(apps, servers):
+        thread = threading.Thread(target=server.serve_forever, name=f"server-{app.config['HOST_NAME']}", daemon=True)
+        thread.start()
+        threads.append(thread)
+        logger.info("Directory %s is running on http://%s:%s/", app.config['HOST_NAME'], host, app.config['PORT'])
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
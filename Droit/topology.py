@@ -0,0 +1,100 @@
+"""
+The topology defined in this file is the tree of directories described by a topology file, `topology.json` by default.
+
+The file lists every directory with its name, its base URL and the name of its parent (missing for the root):
+
+    {"directories": [
+        {"name": "level1", "url": "http://localhost:5001"},
+        {"name": "level2a", "url": "http://localhost:5002", "parent": "level1"}
+    ]}
+
+Each directory derives its routing collections from the tree when it starts (see `init_routing_collections` in
+Droit/databases.py): its neighbours, the child leading to each of its descendants, and the subtree of each of its ancestors.
+An optional "config" object of a directory overrides its configuration values, see config.py.
+"""
+import json
+
+
+class Topology(object):
+    """Tree of directories described by a topology file
+
+    Attributes:
+        root (str): name of the root (master) directory
+        urls (dict): mapping from each directory name to its base URL
+        parents (dict): mapping from each directory name to the name of its parent, None for the root
+        children (dict): mapping from each directory name to the names of its children, in the order of the file
+
+    Args:
+        directories (list[dict]): the "directories" list of the topology file
+    Raises:
+        ValueError: if the directories do not form one tree
+    """
+
+    def __init__(self, directories: list):
+        self.urls = {}
+        self.parents = {}
+        self.children = {}
+        for directory in directories:
+            name = directory.get('name')
+            if not name or not directory.get('url'):
+                raise ValueError(f"Every directory needs a name and a url: {directory}")
+            if name in self.urls:
+                raise ValueError(f"Duplicate directory {name}")
+            self.urls[name] = directory['url'].rstrip('/')
+            self.parents[name] = directory.get('parent')
+            self.children[name] = []
+        roots = [name for name, parent in self.parents.items() if parent is None]
+        if len(roots) != 1:
+            raise ValueError(f"The topology needs exactly one root directory, found {len(roots)}")
+        self.root = roots[0]
+        for name, parent in self.parents.items():
+            if parent is None:
+                continue
+            if parent not in self.children:
+                raise ValueError(f"Unknown parent {parent} of directory {name}")
+            self.children[parent].append(name)
+        if len(self.get_subtree(self.root)) != len(self.urls):
+            raise ValueError("Some directories are not connected to the root directory")
+
+    @classmethod
+    def load(cls, path: str):
+        """Read the topology file at 'path'
+
+        Raises:
+            ValueError: if the file is not a valid topology
+        """
+        with open(path) as topology_file:
+            return cls(json.load(topology_file)['directories'])
+
+    def get_subtree(self, name: str) -> list:
+        """Return the names of the directory and of all its descendants, in depth-first order
+
+        """
+        subtree = []
+        stack = [name]
+        while stack:
+            directory_name = stack.pop()
+            subtree.append(directory_name)
+            stack.extend(reversed(self.children[directory_name]))
+        return subtree
+
+    def get_ancestors(self, name: str) -> list:
+        """Return the names of the ancestors of the directory, from its parent up to the root
+
+        """
+        ancestors = []
+        parent = self.parents[name]
+        while parent is not None:
+            ancestors.append(parent)
+            parent = self.parents[parent]
+        return ancestors
+
+    def get_descendant_to_child(self, name: str) -> dict:
+        """Return the mapping from each descendant of the directory, except its children, to the child leading to it
+
+        """
+        return {
+            descendant: child
+            for child in self.children[name]
+            for descendant in self.get_subtree(child)[1:]
+        }
@@ -3,7 +3,8 @@ Functions declared in this file are helper functions that can be shared by all o
 """
 import flask
 from urllib.parse import urljoin
-from .models import DirectoryNameToURL, TargetToChildName
+from .routing import routing_table
+from .referrals import referral_cache
 
 def is_json_request(request: flask.Request, properties: list = []) -> bool:
     """Check whether the request's body could be parsed to JSON format, and all necessary properties specified by `properties` are in the JSON object
@@ -30,12 +31,15 @@ def is_json_request(request: flask.Request, properties: list = []) -> bool:
 def clean_thing_description(thing_description: dict) -> dict:
     """Change the property name "@type" to "thing_type" and "id" to "thing_id" in the thing_description
 
+    The "_id" of a thing description read from another directory is removed as well, a new one is given on insertion.
+
     Args:
         thing_description (dict): dict representing a thing description
 
     Returns:
-        dict: the same dict with "@type" and "id" keys are mapped to "thing_type" and "thing_id"
+        dict: the same dict with "@type" and "id" keys are mapped to "thing_type" and "thing_id", without "_id"
     """
+    thing_description.pop("_id", None)
     if "@type" in thing_description:
         thing_description["thing_type"] = thing_description.pop("@type")
     if "id" in thing_description:
@@ -46,12 +50,15 @@ def clean_thing_description(thing_description: dict) -> dict:
 def get_target_url(location: str, api: str = "") -> str:
     """Check the next possible location to request in order to get the 'location' directory
 
-    It will check database if the 'location' is an adjacent directory to the current one.
+    It will check the routing table if the 'location' is an adjacent directory to the current one.
     If it is, then return the concatenated URI using this adjacent directory's URI.
 
     Then it will check whether this 'location' is one of descendants directories.
     If it is, then return.
 
+    Otherwise, if the URL of this 'location' was learned from a previous forwarded response, the request is sent straight
+    there (see Droit/referrals.py). Locations recently reported unknown by the root directory are not forwarded at all.
+
     Finally if current directory is not master, then it will return the URI using master directory's location
 
     Args:
@@ -62,24 +69,15 @@ def get_target_url(location: str, api: str = "") -> str:
         str: if the location is possible, return the concatenated URI along with the 'api', otherwise return None
 
     """
-    target_url = None
-    # 1. check whether the location is known to current directory (parent or direct children)
-    known_directory = DirectoryNameToURL.objects(
-        directory_name=location).first()
-    if known_directory is not None:
-        target_url = urljoin(known_directory.url, api)
-
-    # 2. check if the location is its descendants
-    elif TargetToChildName.objects(target_name=location).first() is not None:
-        descendant_directory = TargetToChildName.objects(
-            target_name=location).first()
-        target_url = urljoin(DirectoryNameToURL.objects(
-            directory_name=descendant_directory.child_name).first().url, api)
-
-    # 3. if current is not master directory, return the url of master directory
-    elif DirectoryNameToURL.objects(relationship="parent").first() is not None:
-        master_url = DirectoryNameToURL.objects(
-            directory_name="master").first().url
-        target_url = urljoin(master_url, api)
-
-    return target_url
+    next_hop_url = routing_table.get_route_url(location)
+    if next_hop_url is None:
+        if referral_cache.is_unknown(location):
+            flask.g.unknown_location = location
+            return None
+        next_hop_url = referral_cache.get(location) or routing_table.get_next_hop_url(location)
+    if next_hop_url is None:
+        # only the root directory can tell that a location does not exist, the others forward it to the master
+        if routing_table.parent is None:
+            flask.g.unknown_location = location
+        return None
+    return urljoin(next_hop_url, api)
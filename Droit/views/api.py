@@ -1,25 +1,67 @@
 import json
 import copy
+import uuid
+import base64
+import binascii
+import time
+import queue
+import threading
 import requests
-from flask import Blueprint, request, url_for, redirect, Response, make_response, jsonify
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from flask import Blueprint, request, url_for, redirect, Response, make_response, jsonify, stream_with_context, g
 from flask import current_app as app
 from urllib.parse import urljoin, urlencode
-from ..models import ThingDescription, DirectoryNameToURL, TypeToChildrenNames, TargetToChildName
+from ..models import ThingDescription, DirectoryNameToURL, TypeToChildrenNames, TargetToChildName, IdFilter, TypeCounter
+from ..databases import get_thing_collection
 from ..utils import get_target_url, is_json_request, clean_thing_description
+from ..peers import peer_session
+from ..fanout import children_executor, stream_executor
+from ..routing import routing_table
+from ..outbox import outbox
+from ..aggregation import reported_aggregations, begin_type_write, update_type_count, get_location_count, set_location_count
+from ..bloom import id_filters
+from ..reports import pending_reports
+from ..cache import result_cache, subtree_version
+from ..wire import make_data_response, decode_response, get_response_mimetype
+from ..referrals import referral_cache, REFERRAL_HEADERS, DIRECTORY_NAME_HEADER, DIRECTORY_URL_HEADER, UNKNOWN_LOCATION_HEADER
 
 
 ERROR_JSON = {"error": "Invalid request."}
+NDJSON_MIMETYPE = "application/x-ndjson"
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# set on a page of search result missing the thing descriptions of a directory that failed to answer
+PARTIAL_RESULT_HEADER = "X-Partial-Result"
+# set on the response of a registration stored locally whose propagation to the ancestors failed
+PROPAGATION_FAILED_HEADER = "X-Propagation-Failed"
 OPERATION_COUNT = ""
 
 api = Blueprint('api', __name__)
 
+
+@api.after_request
+def add_referral_headers(response):
+    """Tell the caller which directory answered the request, see Droit/referrals.py
+
+    Responses forwarded from other directories keep the headers of the directory which answered them.
+    """
+    if DIRECTORY_NAME_HEADER not in response.headers:
+        response.headers[DIRECTORY_NAME_HEADER] = app.config.get('HOST_NAME', "Unknown")
+        response.headers[DIRECTORY_URL_HEADER] = request.host_url.rstrip('/')
+    unknown_location = g.get('unknown_location')
+    if unknown_location is not None and UNKNOWN_LOCATION_HEADER not in response.headers:
+        response.headers[UNKNOWN_LOCATION_HEADER] = unknown_location
+    return response
+
+
 def delete_local_thing_description(thing_id: str) -> bool:
     """Delete the thing description with the specific 'thing_id' in local directory and return whether the deletion is complete.
 
     This is the function that perform the real thing description deletion oepration. It will do it locally by deleting the 
     thing description specified by `thing_id` field. If the to-be-delete thing description has publicity larger than 1, it 
     will send addition request to its parent directory to totally remove the record. This is a recursive request and only
-    until its finished, this function should return.
+    until its finished, this function should return, unless the outbox is enabled, see `propagate_delete_up`.
 
     Args:
         thing_id (str): ID for thing description to be deleted
@@ -30,20 +72,62 @@ def delete_local_thing_description(thing_id: str) -> bool:
     delete_thing = ThingDescription.objects(thing_id=thing_id).first()
     if delete_thing is None:
         return True
-    delete_thing.delete()
+    # only the request that actually removed the document updates the counter
+    begin_type_write(delete_thing.thing_type)
+    deleted_count = 0
+    try:
+        deleted_count = ThingDescription.objects(id=delete_thing.id).delete()
+    finally:
+        dir_remaining_count = update_type_count(delete_thing.thing_type, -deleted_count)
+    if deleted_count == 0:
+        return True
+    propagate_subtree_change()
     # 1. if the publicity is larger than 0, it needs to recursively delete the thing in parent's directory
     if delete_thing.publicity > 0:
-        delete_up_things(delete_thing.thing_id)
+        propagate_delete_up(delete_thing.thing_id)
     # 2. if current directory has no other thing_description of this type,
     # should update parent's aggregation information to delete this one
-    dir_remaining_count = ThingDescription.objects(
-        thing_type=delete_thing.thing_type).count()
-    if dir_remaining_count == 0:
-        delete_parent_aggregation(
-            delete_thing.thing_type, app.config['HOST_NAME'])
+    if dir_remaining_count <= 0:
+        propagate_aggregation(
+            delete_thing.thing_type, app.config['HOST_NAME'], False)
+    propagate_type_count(delete_thing.thing_type, app.config['HOST_NAME'])
     return True
 
 
+def delete_local_replicas(origins: list) -> int:
+    """Delete the copies of thing descriptions pushed up from the given directories
+
+    Only the copies stored in the current directory are deleted, the ancestors delete their own ones when the directories
+    leave their subtree as well. Copies pushed up by older versions do not know their origin and are kept.
+
+    Args:
+        origins (list): the names of the directories storing the original thing descriptions
+
+    Returns:
+        int: the number of deleted copies
+    """
+    location = app.config['HOST_NAME']
+    query = {"replica": True, "origin": {"$in": origins}}
+    collection = get_thing_collection()
+    deleted_count = 0
+    for thing_type in collection.distinct("thing_type", query):
+        begin_type_write(thing_type)
+        type_deleted_count = 0
+        try:
+            type_deleted_count = collection.delete_many(dict(query, thing_type=thing_type)).deleted_count
+        finally:
+            remaining_count = update_type_count(thing_type, -type_deleted_count)
+        if type_deleted_count == 0:
+            continue
+        deleted_count += type_deleted_count
+        if remaining_count <= 0:
+            propagate_aggregation(thing_type, location, False)
+        propagate_type_count(thing_type, location)
+    if deleted_count:
+        propagate_subtree_change()
+    return deleted_count
+
+
 def push_up_things(thing_description: dict, publicity: int) -> bool:
     """Send register request to parent directory, only if the publicity is larger than 0 and current directory has parent
 
@@ -54,8 +138,7 @@ def push_up_things(thing_description: dict, publicity: int) -> bool:
     Return:
         bool: boolean value indicating the push up result. If succeed, return True, otherwise False
     """
-    parent_directory = DirectoryNameToURL.objects(
-        relationship='parent').first()
+    parent_directory = routing_table.parent
     # 1. only do push-up when the publicity is larger than 0, and it has parent
     if publicity == 0 or parent_directory is None:
         return True
@@ -64,14 +147,52 @@ def push_up_things(thing_description: dict, publicity: int) -> bool:
     parent_url = urljoin(parent_directory.url, url_for('api.register'))
     request_data = {
         "td": thing_description,
-        "location": parent_directory.directory_name,
-        "publicity": publicity - 1
+        "location": parent_directory.name,
+        "publicity": publicity - 1,
+        "replica": True
     }
 
-    response = requests.post(parent_url, data=json.dumps(request_data), headers={
-        'Content-Type': 'application/json',
-        'Accept-Charset': 'UTF-8'
-    })
+    try:
+        response = peer_session.post(parent_url, data=json.dumps(request_data), headers={
+            'Content-Type': 'application/json',
+            'Accept-Charset': 'UTF-8'
+        })
+    except requests.RequestException:
+        return False
+
+    return response.status_code == 200
+
+
+def push_up_things_batch(thing_descriptions: list, publicity: int) -> bool:
+    """Send one batch register request to parent directory, only if the publicity is larger than 0 and current directory has parent
+
+    Args:
+        thing_descriptions (list): the thing descriptions may need to be pushed up
+        publicity (int): how many levels the things need to be pushed up
+
+    Return:
+        bool: boolean value indicating the push up result. If succeed, return True, otherwise False
+    """
+    parent_directory = routing_table.parent
+    # 1. only do push-up when the publicity is larger than 0, and it has parent
+    if publicity == 0 or parent_directory is None or len(thing_descriptions) == 0:
+        return True
+
+    # 2. send push up request to the parent url
+    parent_url = urljoin(parent_directory.url, url_for('api.register_batch'))
+    request_data = {
+        "tds": thing_descriptions,
+        "location": parent_directory.name,
+        "publicity": publicity - 1,
+        "replica": True
+    }
+    try:
+        response = peer_session.post(parent_url, data=json.dumps(request_data), headers={
+            'Content-Type': 'application/json',
+            'Accept-Charset': 'UTF-8'
+        })
+    except requests.RequestException:
+        return False
 
     return response.status_code == 200
 
@@ -84,14 +205,14 @@ def delete_up_things(thing_id: str) -> bool:
     Return:
         bool: True if the deletion is complete, otherwise False.
     """
-    parent_dir = DirectoryNameToURL.objects(relationship='parent').first()
+    parent_dir = routing_table.parent
     response = None
     if parent_dir is not None:
         query_parameters = urlencode(
-            {"location": parent_dir.directory_name, "thing_id": thing_id})
+            {"location": parent_dir.name, "thing_id": thing_id})
         request_url = f"{urljoin(parent_dir.url, url_for('api.delete'))}?{query_parameters}"
         try:
-            response = requests.delete(request_url)
+            response = peer_session.delete(request_url)
         except:
             return False
     return response is None or response.status_code == 200
@@ -109,7 +230,7 @@ def add_parent_aggregation(thing_type: str, location: str) -> bool:
     :return: boolean value indicating the update result. return True if update successfully
     """
 
-    parent_dir = DirectoryNameToURL.objects(relationship='parent').first()
+    parent_dir = routing_table.parent
     if parent_dir is None:
         return True
 
@@ -117,10 +238,13 @@ def add_parent_aggregation(thing_type: str, location: str) -> bool:
     request_url = urljoin(parent_dir.url, url_for(
         'api.update_type_aggregation'))
 
-    response = requests.post(request_url, data=json.dumps(request_body), headers={
-        'Content-Type': 'application/json',
-        'Accept-Charset': 'UTF-8'
-    })
+    try:
+        response = peer_session.post(request_url, data=json.dumps(request_body), headers={
+            'Content-Type': 'application/json',
+            'Accept-Charset': 'UTF-8'
+        })
+    except requests.RequestException:
+        return False
 
     return response.status_code == 200
 
@@ -136,73 +260,1142 @@ def delete_parent_aggregation(thing_type: str, location: str) -> bool:
         bool: True when the delete aggregation operation is successful. Otherwise False.
     """
     # 1. if it has no parent directory, terminate the call
-    parent_dir = DirectoryNameToURL.objects(relationship='parent').first()
+    parent_dir = routing_table.parent
     if parent_dir is None:
         return True
     query_parameters = urlencode(
         {"location": location, "thing_type": thing_type})
     request_url = f"{urljoin(parent_dir.url, url_for('api.update_type_aggregation'))}?{query_parameters}"
     try:
-        response = requests.delete(request_url)
+        response = peer_session.delete(request_url)
     except:
         return False
 
-    return response == 200
+    return response.status_code == 200
+
+
+def update_parent_type_count(thing_type: str, location: str, count: int) -> bool:
+    """Send a post request to parent's directory to update the number of thing descriptions stored at a location.
+
+    Args:
+        thing_type (str): Specify the type of the thing descriptions.
+        location (str): the directory name whose number of thing descriptions is updated.
+        count (int): the number of thing descriptions of this type stored at the location.
+
+    Returns:
+        bool: True if the update is complete, otherwise False.
+    """
+    parent_dir = routing_table.parent
+    if parent_dir is None:
+        return True
+
+    request_body = {"location": location, "thing_type": thing_type, "count": count}
+    request_url = urljoin(parent_dir.url, url_for('api.update_type_aggregation'))
+    try:
+        response = peer_session.post(request_url, data=json.dumps(request_body), headers={
+            'Content-Type': 'application/json',
+            'Accept-Charset': 'UTF-8'
+        })
+    except requests.RequestException:
+        return False
+
+    return response.status_code == 200
+
+
+def add_parent_id_filter(indices: list) -> bool:
+    """Send a post request to parent's directory to set bits in the thing_id filter of the current directory.
+
+    Args:
+        indices (list): the positions of the bits to set, see Droit/bloom.py
+
+    Returns:
+        bool: True if the update is complete, otherwise False.
+    """
+    parent_dir = routing_table.parent
+    if parent_dir is None:
+        return True
+
+    request_body = {
+        "name": app.config['HOST_NAME'],
+        "indices": indices,
+        "bits": id_filters.size,
+        "hashes": id_filters.num_hashes
+    }
+    request_url = urljoin(parent_dir.url, url_for('api.update_id_filter'))
+    try:
+        response = peer_session.post(request_url, data=json.dumps(request_body), headers={
+            'Content-Type': 'application/json',
+            'Accept-Charset': 'UTF-8'
+        })
+    except requests.RequestException:
+        return False
+
+    return response.status_code == 200
+
+
+def notify_parent_subtree_change() -> bool:
+    """Send a post request to parent's directory to increment its subtree version.
+
+    Returns:
+        bool: True if the update is complete, otherwise False.
+    """
+    parent_dir = routing_table.parent
+    if parent_dir is None:
+        return True
+
+    request_url = urljoin(parent_dir.url, url_for('api.update_subtree_version'))
+    try:
+        response = peer_session.post(request_url, data=json.dumps({"name": app.config['HOST_NAME']}), headers={
+            'Content-Type': 'application/json',
+            'Accept-Charset': 'UTF-8'
+        })
+    except requests.RequestException:
+        return False
+
+    return response.status_code == 200
+
+
+def update_parent_membership(api_name: str, members: list, url: str = None) -> bool:
+    """Send a post request to parent's directory to add or remove directories in the subtree of the current directory.
+
+    Args:
+        api_name (str): 'api.join' or 'api.leave'
+        members (list): the names of the joining or leaving directories
+        url (str): optional, the base URL of the current directory, needed if the parent does not know it yet
+
+    Returns:
+        bool: True if the update is complete, otherwise False.
+    """
+    parent_dir = routing_table.parent
+    if parent_dir is None:
+        return True
+
+    body = {"name": app.config['HOST_NAME'], "members": members}
+    if url is not None:
+        body["url"] = url
+    request_url = urljoin(parent_dir.url, url_for(api_name))
+    try:
+        response = peer_session.post(request_url, data=json.dumps(body), headers={
+            'Content-Type': 'application/json',
+            'Accept-Charset': 'UTF-8'
+        })
+    except requests.RequestException:
+        return False
+
+    return response.status_code == 200
+
+
+def report_subtree_to_parent() -> bool:
+    """Send the thing_id filter and the number of thing descriptions of each type of the whole subtree to the parent directory
+
+    The parent drops what it knows about a subtree when it leaves (see `leave`), and knows nothing about a new one, so a
+    directory joining the tree reports everything its subtree already holds, instead of only the later changes.
+
+    Returns:
+        bool: True if every report is complete, otherwise False.
+    """
+    location = app.config['HOST_NAME']
+    local_ids = (thing["thing_id"] for thing in get_thing_collection().find(
+        get_local_query(None, None, True), {"thing_id": 1, "_id": 0}) if thing.get("thing_id"))
+    result = add_parent_id_filter(id_filters.get_subtree_indices(local_ids))
+    for counter in TypeCounter.objects(count__gt=0):
+        result = update_parent_type_count(counter.thing_type, location, counter.count) and result
+    for aggregation in TypeToChildrenNames.objects():
+        children_counts = aggregation.children_counts or {}
+        for child_location in aggregation.children_names:
+            if children_counts.get(child_location, 0) > 0:
+                result = update_parent_type_count(aggregation.thing_type, child_location,
+                                                  children_counts[child_location]) and result
+            else:
+                result = add_parent_aggregation(aggregation.thing_type, child_location) and result
+    return result
+
+
+def join_parent(members: list, url: str = None) -> bool:
+    """Send a join request to the parent directory, see `update_parent_membership`
+
+    When the current directory itself joins, its whole subtree is reported once the parent knows it, see
+    `report_subtree_to_parent`.
+
+    Returns:
+        bool: True if the join and the reports are complete, otherwise False.
+    """
+    if not update_parent_membership('api.join', members, url):
+        return False
+    return members[0] != app.config['HOST_NAME'] or report_subtree_to_parent()
+
+
+def propagate_push_up(thing_descriptions: list, publicity: int) -> bool:
+    """Push up thing descriptions to the parent directory, in the background if the outbox is enabled
+
+    Args:
+        thing_descriptions (list): the thing descriptions may need to be pushed up
+        publicity (int): how many levels the things need to be pushed up
+
+    Return:
+        bool: True if the push up is complete or stored in the outbox, otherwise False
+    """
+    if publicity == 0 or routing_table.parent is None or len(thing_descriptions) == 0:
+        return True
+    # the copies remember where the original is stored, so they can be removed when it leaves the tree, see `leave`
+    thing_descriptions = [dict(thing_description, origin=thing_description.get("origin") or app.config['HOST_NAME'])
+                          for thing_description in thing_descriptions]
+    if not outbox.enabled:
+        if len(thing_descriptions) == 1:
+            return push_up_things(thing_descriptions[0], publicity)
+        return push_up_things_batch(thing_descriptions, publicity)
+    try:
+        for thing_description in thing_descriptions:
+            outbox.put("push_up", f"thing:{thing_description['thing_id']}",
+                       {"td": thing_description, "publicity": publicity})
+    except Exception:
+        return False
+    return True
 
 
-def get_children_result(thing_type: str, api: str, query_string: str) -> list:
+def propagate_delete_up(thing_id: str) -> bool:
+    """Delete the copy of a thing description in the parent directory, in the background if the outbox is enabled
+
+    Args:
+        thing_id (str): Unique identifer of thing description that specify the thing description to be deleted. 
+    Return:
+        bool: True if the deletion is complete or stored in the outbox, otherwise False.
+    """
+    if routing_table.parent is None:
+        return True
+    if not outbox.enabled:
+        return delete_up_things(thing_id)
+    outbox.put("delete_up", f"thing:{thing_id}", {"thing_id": thing_id})
+    return True
+
+
+def propagate_aggregation(thing_type: str, location: str, is_added: bool) -> bool:
+    """Add or delete a location in the parent directory's aggregation data, in the background if the outbox is enabled
+
+    Args:
+        thing_type (str): Specify the type of the aggregation.
+        location (str): the directory name that the aggregation should be using to update.
+        is_added (bool): True to add the location to the aggregation, False to delete it.
+
+    An addition already reported to the parent directory is skipped, see `reported_aggregations`.
+
+    Returns:
+        bool: True if the update is complete, skipped or stored in the outbox, otherwise False.
+    """
+    if routing_table.parent is None:
+        return True
+    if is_added and reported_aggregations.is_reported(thing_type, location):
+        return True
+    if not is_added:
+        reported_aggregations.discard(thing_type, location)
+    if not outbox.enabled:
+        if not is_added:
+            return delete_parent_aggregation(thing_type, location)
+        is_updated = add_parent_aggregation(thing_type, location)
+    else:
+        kind = "add_aggregation" if is_added else "delete_aggregation"
+        outbox.put(kind, f"aggregation:{thing_type}:{location}", {"thing_type": thing_type, "location": location})
+        is_updated = True
+    if is_added and is_updated:
+        reported_aggregations.add(thing_type, location)
+    return is_updated
+
+
+def propagate_type_count(thing_type: str, location: str) -> bool:
+    """Report the number of thing descriptions of a type stored at a location to the parent directory, in the background
+
+    The report is coalesced with the other changes of the same type and location, see Droit/reports.py.
+
+    Args:
+        thing_type (str): Specify the type of the thing descriptions.
+        location (str): the current directory's name, or a location of its aggregation data.
+
+    Returns:
+        bool: always True, the report is sent later.
+    """
+    if routing_table.parent is None:
+        return True
+    pending_reports.add_count(thing_type, location)
+    pending_reports.start(app._get_current_object(), send_pending_reports)
+    return True
+
+
+def propagate_id_filter(indices: list, key: str) -> bool:
+    """Report bits of the thing_id filter to the parent directory, in the background if the outbox is enabled
+
+    Args:
+        indices (list): the positions of the bits to set, see Droit/bloom.py
+        key (str): the outbox key of the report
+
+    Returns:
+        bool: True if the report is complete or stored in the outbox, otherwise False.
+    """
+    if routing_table.parent is None or not indices:
+        return True
+    if not outbox.enabled:
+        return add_parent_id_filter(indices)
+    outbox.put("id_filter", key, {"indices": indices})
+    return True
+
+
+def propagate_subtree_change() -> bool:
+    """Increment the subtree version of the current directory and of all its ancestors, which invalidates their cached results
+
+    The local version is incremented at once, the ancestors are notified in the background, and a burst of changes is
+    notified once, see Droit/reports.py.
+
+    Returns:
+        bool: always True, the ancestors are notified later.
+    """
+    subtree_version.bump()
+    if routing_table.parent is None:
+        return True
+    pending_reports.add_subtree_change()
+    pending_reports.start(app._get_current_object(), send_pending_reports)
+    return True
+
+
+def send_pending_reports(counts: set, subtree_changed: bool) -> tuple:
+    """Report the coalesced changes to the parent directory, in the outbox if it is enabled
+
+    Args:
+        counts (set): the (thing type, location) pairs whose number of thing descriptions changed
+        subtree_changed (bool): whether the subtree of the current directory changed
+
+    Returns:
+        tuple: the pairs and the subtree change that could not be reported
+    """
+    if routing_table.parent is None:
+        return set(), False
+    if outbox.enabled:
+        for thing_type, location in counts:
+            outbox.put_once("update_count", f"aggregation:{thing_type}:{location}",
+                            {"thing_type": thing_type, "location": location})
+        if subtree_changed:
+            outbox.put_once("subtree_change", "subtree_version", {})
+        return set(), False
+    failed_counts = {(thing_type, location) for thing_type, location in counts
+                     if not update_parent_type_count(thing_type, location, get_location_count(thing_type, location))}
+    return failed_counts, subtree_changed and not notify_parent_subtree_change()
+
+
+def propagate_membership(kind: str, members: list, url: str = None) -> bool:
+    """Report directories joining or leaving the subtree of the current directory to the parent, in the background if the
+    outbox is enabled
+
+    The events of the same joining or leaving subtree share one outbox key, so they are delivered in order.
+
+    Args:
+        kind (str): "join" or "leave"
+        members (list): the names of the joining or leaving directories, the root of their subtree first
+        url (str): optional, the base URL of the current directory, needed if the parent does not know it yet
+
+    Returns:
+        bool: True if the parent is updated or the update is stored in the outbox, otherwise False
+    """
+    if routing_table.parent is None:
+        return True
+    if not outbox.enabled:
+        if kind == "join":
+            return join_parent(members, url)
+        return update_parent_membership("api.leave", members)
+    outbox.put(kind, f"membership:{members[0]}", {"members": members, "url": url})
+    return True
+
+
+def announce_to_parent() -> bool:
+    """Report the current directory and its subtree to the parent, so that the ancestors route to them without restarting
+
+    Once the parent knows the current directory, the thing descriptions already stored in the subtree are reported too.
+
+    Returns:
+        bool: True if the parent is updated or the update is stored in the outbox, otherwise False
+    """
+    members = [app.config['HOST_NAME']] + routing_table.descendants
+    return propagate_membership("join", members, app.config.get('DIRECTORY_URL'))
+
+
+def get_cached_response(endpoint: str, query: dict) -> tuple:
+    """Look up the response of a query answered by the current directory in the result cache
+
+    Args:
+        endpoint (str): name of the endpoint answering the query
+        query (dict): the normalised parameters of the query
+
+    Returns:
+        tuple: the cache key, the current subtree version and the cached response, or None if the query has to be computed.
+            The cache key is None if the cache is disabled.
+    """
+    if not app.config.get('SEARCH_CACHE_ENABLED', False):
+        return None, None, None
+    mimetype = get_response_mimetype()
+    cache_key = result_cache.get_key(f"{endpoint}:{mimetype}", query)
+    version = subtree_version.get()
+    body = result_cache.get(cache_key, version)
+    if body is None:
+        return cache_key, version, None
+    return cache_key, version, app.response_class(body, mimetype=mimetype)
+
+
+def cache_response(cache_key: str, version: int, response: Response) -> Response:
+    """Store the response computed at the subtree version returned by `get_cached_response` in the result cache
+
+    A response missing the results of a child which failed to answer (`g.partial_result`) is marked as partial with
+    `PARTIAL_RESULT_HEADER` instead, and is not cached.
+    """
+    if g.get('partial_result'):
+        response.headers[PARTIAL_RESULT_HEADER] = "true"
+    elif cache_key is not None:
+        result_cache.put(cache_key, version, response.get_data())
+    return response
+
+
+def learn_referral(location: str, peer_response: requests.Response) -> None:
+    """Cache the URL of the location if the forwarded request was answered by the location itself, see Droit/referrals.py
+
+    Args:
+        location (str): the target location of the forwarded request
+        peer_response (requests.Response): the response of the next directory
+    """
+    headers = peer_response.headers
+    if headers.get(UNKNOWN_LOCATION_HEADER) == location:
+        referral_cache.mark_unknown(location)
+    elif headers.get(DIRECTORY_NAME_HEADER) == location and routing_table.get_route_url(location) is None:
+        referral_cache.learn(location, headers.get(DIRECTORY_URL_HEADER))
+
+
+def relay_referral(location: str, peer_response: requests.Response, response: Response) -> Response:
+    """Learn the referral of the location from the response of the next directory, and relay it to the caller
+
+    Args:
+        location (str): the target location of the forwarded request
+        peer_response (requests.Response): the response of the next directory
+        response (flask.Response): the response returned to the caller
+
+    Returns:
+        flask.Response: the response returned to the caller, with the referral headers of the peer response
+    """
+    learn_referral(location, peer_response)
+    for header in REFERRAL_HEADERS:
+        if header in peer_response.headers:
+            response.headers[header] = peer_response.headers[header]
+    return response
+
+
+@outbox.handler("push_up")
+def deliver_push_up_events(payloads: list) -> bool:
+    """Send the thing descriptions of outbox events to the parent directory, one batch request per publicity
+
+    """
+    thing_descriptions_by_publicity = {}
+    for payload in payloads:
+        thing_descriptions_by_publicity.setdefault(payload["publicity"], []).append(payload["td"])
+    result = True
+    for publicity, thing_descriptions in thing_descriptions_by_publicity.items():
+        result = push_up_things_batch(thing_descriptions, publicity) and result
+    return result
+
+
+@outbox.handler("delete_up")
+def deliver_delete_up_events(payloads: list) -> bool:
+    """Delete the copies of the thing descriptions of outbox events in the parent directory
+
+    """
+    return all([delete_up_things(payload["thing_id"]) for payload in payloads])
+
+
+@outbox.handler("add_aggregation")
+def deliver_add_aggregation_events(payloads: list) -> bool:
+    """Add the locations of outbox events to the parent directory's aggregation data
+
+    """
+    return all([add_parent_aggregation(payload["thing_type"], payload["location"]) for payload in payloads])
+
+
+@outbox.handler("delete_aggregation")
+def deliver_delete_aggregation_events(payloads: list) -> bool:
+    """Delete the locations of outbox events from the parent directory's aggregation data
+
+    """
+    return all([delete_parent_aggregation(payload["thing_type"], payload["location"]) for payload in payloads])
+
+
+@outbox.handler("id_filter")
+def deliver_id_filter_events(payloads: list) -> bool:
+    """Report the bits of the thing_id filter of outbox events to the parent directory in one request
+
+    """
+    indices = set()
+    for payload in payloads:
+        indices.update(payload["indices"])
+    return add_parent_id_filter(sorted(indices))
+
+
+@outbox.handler("subtree_change")
+def deliver_subtree_change_events(payloads: list) -> bool:
+    """Notify the parent directory of the changes in the subtree of the current directory
+
+    """
+    return notify_parent_subtree_change()
+
+
+@outbox.handler("update_count")
+def deliver_update_count_events(payloads: list) -> bool:
+    """Report the current numbers of thing descriptions of outbox events to the parent directory
+
+    """
+    return all([update_parent_type_count(payload["thing_type"], payload["location"],
+                                         get_location_count(payload["thing_type"], payload["location"]))
+                for payload in payloads])
+
+
+@outbox.handler("join")
+def deliver_join_events(payloads: list) -> bool:
+    """Report the directories joining the subtree of the current directory to the parent directory
+
+    """
+    return all([join_parent(payload["members"], payload.get("url")) for payload in payloads])
+
+
+@outbox.handler("leave")
+def deliver_leave_events(payloads: list) -> bool:
+    """Report the directories leaving the subtree of the current directory to the parent directory
+
+    """
+    return all([update_parent_membership('api.leave', payload["members"]) for payload in payloads])
+
+
+def get_child_result(request_url: str, query_parameters: dict) -> tuple:
+    """Send one search request to a child directory and return its result as a list
+
+    Args:
+        request_url(str): The full URL of the child directory's API endpoint.
+        query_parameters(dict): Query parameters of the request.
+
+    Returns:
+        tuple: the result returned by the child directory as a list, and whether it is complete. If the child is unreachable
+            or the request failed, an empty list is returned and the result is not complete. A child answering with a
+            partial result of its own subtree (see `PARTIAL_RESULT_HEADER`) is not complete either.
+    """
+    try:
+        response = peer_session.get(request_url, params=query_parameters)
+    except requests.RequestException:
+        return [], False
+    if response.status_code != 200:
+        return [], False
+    try:
+        child_result = decode_response(response)
+    except ValueError:
+        return [], False
+    is_complete = not response.headers.get(PARTIAL_RESULT_HEADER)
+    return (child_result if type(child_result) == list else [child_result]), is_complete
+
+
+def get_children_requests(thing_type: str, api: str, query_parameters: dict, thing_id: str = None) -> list:
+    """Get the URL and the query parameters of the request to send to each relevant child directory
+
+    Each child directory handles its own subtree recursively, so only one request is needed per child.
+    If `thing_type` is specified, then only children whose subtree holds thing descriptions of `thing_type` are relevant.
+    If `thing_id` is specified, then only children whose thing_id filter may contain `thing_id` are relevant.
+
+    Args:
+        thing_type(str): Type of thing descriptions to return. Is this is missing, then no filtering will be doing.
+        api(str): The API endpoint of the children directories.
+        query_parameters(dict): Query parameters of the requests sent to children directories.
+        thing_id(str): optional, ID of the only thing description to return.
+
+    Returns:
+        list: list of (request URL, query parameters) tuples, in the same order as the aggregation data.
+    """
+    child_name_to_url_map = routing_table.children
+    # Get descendant names that contains the 'thing_type' accroding to the aggregation stats
+    # if 'thing_type' is missing, every descendant holding any thing description is relevant
+    if thing_type is not None:
+        aggregations = TypeToChildrenNames.objects(thing_type=thing_type).all()
+    else:
+        aggregations = TypeToChildrenNames.objects().all()
+    # map each descendant to the child directory leading to it, and request each child only once
+    relevant_children_names = []
+    for aggregation in aggregations:
+        for descendant_directory_name in aggregation.children_names:
+            child_name = routing_table.get_child_name(descendant_directory_name)
+            if child_name is not None and child_name not in relevant_children_names:
+                relevant_children_names.append(child_name)
+    if thing_id is not None:
+        filters = id_filters.get_filters()
+        relevant_children_names = [child_name for child_name in relevant_children_names
+                                   if id_filters.might_contain(child_name, thing_id, filters)]
+
+    request_arguments = []
+    for child_name in relevant_children_names:
+        child_parameters = dict(query_parameters)
+        if 'location' in child_parameters:
+            child_parameters['location'] = child_name
+        request_arguments.append((urljoin(child_name_to_url_map[child_name], api), child_parameters))
+    return request_arguments
+
+
+def get_children_result(thing_type: str, api: str, query_parameters: dict, thing_id: str = None) -> list:
     """Get thing descriptions from all children directories and return the result
 
-    This operation is done recursively using a DFS serach algorithm. The request is sent to the endpoint of
-    children directory specified by `api` argument along with `query_string` as the query parameters. 
-    If `thing_type` is specified, then only thing descriptions matching the `thing_type` argument is collected.
+    The request is sent to the endpoint of every relevant child directory specified by `api` argument along with 
+    `query_parameters` as the query parameters, see `get_children_requests`. All children are requested concurrently 
+    using the thread pool of the directory, shared by all requests, see Droit/fanout.py.
     
     Args:
         thing_type(str): Type of thing descriptions to return. Is this is missing, then no filtering will be doing.
         api(str): The API endpoint of the children directories.
-        query_string(str): Query string of the of the requests sent to children directories.
+        query_parameters(dict): Query parameters of the requests sent to children directories.
+        thing_id(str): optional, ID of the only thing description to return, see `get_children_requests`.
     
     Returns:
         list: the list of thing descriptions that meet the filter condition. Each thing description is a dict object.
+            Results are ordered by child directory, in the same order as the aggregation data. If a child failed to
+            answer, its results are missing and `g.partial_result` is set, see `cache_response`.
     """
-    children_directories = DirectoryNameToURL.objects(
-        relationship='child').all()
-    # Get children names that contains only the 'thing_type' accroding to the aggregation stats
-    descendant_names_with_type = TypeToChildrenNames.objects(thing_type=thing_type).first() \
-        if thing_type is not None else TypeToChildrenNames.objects.first()
-    descendant_to_child_mappings = TargetToChildName.objects().all()
-    # Send request to each child node that has thing desciriptions with this [thing_type] and get result as a list
+    request_arguments = get_children_requests(thing_type, api, query_parameters, thing_id)
+    if not request_arguments:
+        return []
+
+    children_results = children_executor.map(lambda arguments: get_child_result(*arguments), request_arguments)
     result_list = []
-    if children_directories is not None and descendant_names_with_type is not None:
-        child_name_to_url_map = {
-            child_directory.directory_name: child_directory.url for child_directory in children_directories
-        }
-        if descendant_to_child_mappings is not None:
-            for mapping in descendant_to_child_mappings:
-                child_name_to_url_map[mapping.target_name] = child_name_to_url_map[mapping.child_name]
-
-        for descendant_directory_name in descendant_names_with_type.children_names:
-            child_url = child_name_to_url_map[descendant_directory_name]
-            para_dict = dict(k.split('=') for k in query_string.split('&'))
-            if 'location' in para_dict.keys():
-                # tmpstr = query_string.split('&', 1)[1]
-                # new_query_string = f"location={descendant_directory_name}&{tmpstr}"
-                para_dict['location'] = descendant_directory_name
-                new_query_string = urlencode(para_dict)
-                request_url = f"{urljoin(child_url, api)}?{new_query_string}"
-            else:
-                request_url = f"{urljoin(child_url, api)}?{query_string}"
-            response = requests.get(request_url)
-            if response.status_code != 200:
-                continue
-            child_result = response.json()
-            if type(child_result) == list:
-                result_list.extend(child_result)
-            else:
-                result_list.append(child_result)
+    for child_result, is_complete in children_results:
+        result_list.extend(child_result)
+        if not is_complete:
+            g.partial_result = True
     return result_list
 
 
+def stream_children_result(request_arguments: list, buffer_size: int, stall_timeout: float):
+    """Relay the NDJSON search results of children directories as they arrive
+
+    Children are requested concurrently using the streaming thread pool of the directory, see Droit/fanout.py. Each line
+    received from a child is put into a bounded buffer and yielded in arrival order, so the memory used does not depend
+    on the size of the results. Children that do not support streaming return a JSON list, which is converted to lines.
+    If the client does not read for `stall_timeout` seconds while the buffer is full, the relays give up and the
+    stream ends, so a stalled client does not hold threads of the pool.
+
+    Args:
+        request_arguments(list): list of (request URL, query parameters) tuples, see `get_children_requests`
+        buffer_size(int): maximum number of lines received but not yielded yet
+        stall_timeout(float): maximum number of seconds a relay waits for room in the buffer
+
+    Yields:
+        bytes: one thing description in JSON format per line, ending with a newline
+    """
+    lines = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+    end_of_child = object()
+
+    def put_line(line):
+        deadline = time.monotonic() + stall_timeout
+        while not stopped.is_set():
+            try:
+                lines.put(line, timeout=1)
+                return True
+            except queue.Full:
+                if time.monotonic() > deadline:
+                    stopped.set()
+        return False
+
+    def relay_child(request_url, query_parameters):
+        try:
+            if stopped.is_set():
+                return
+            with peer_session.get(request_url, params=query_parameters, headers={'Accept': NDJSON_MIMETYPE},
+                                  stream=True) as response:
+                if response.status_code != 200:
+                    return
+                if response.headers.get('Content-Type', '').startswith(NDJSON_MIMETYPE):
+                    child_lines = (line for line in response.iter_lines() if line)
+                else:
+                    child_lines = (json.dumps(thing).encode() for thing in decode_response(response))
+                for line in child_lines:
+                    if not put_line(line):
+                        return
+        except (requests.RequestException, ValueError):
+            return
+        finally:
+            put_line(end_of_child)
+
+    for arguments in request_arguments:
+        stream_executor.submit(relay_child, *arguments)
+    remaining_children = len(request_arguments)
+    try:
+        while remaining_children > 0:
+            try:
+                line = lines.get(timeout=1)
+            except queue.Empty:
+                # the relays gave up, their end of child may never come
+                if stopped.is_set():
+                    break
+                continue
+            if line is end_of_child:
+                remaining_children -= 1
+                continue
+            yield line + b"\n"
+    finally:
+        # the relays still waiting for a thread of the pool return at once
+        stopped.set()
+
+
+def get_local_query(thing_type: str, thing_id: str, skip_replicas: bool) -> dict:
+    """Build the raw mongodb query of a local search
+
+    Args:
+        thing_type(str): Type of thing descriptions to return. If this is None, there is no constraint on the type.
+        thing_id(str): ID of the thing description to return. If this is None, there is no constraint on the id.
+        skip_replicas(bool): whether copies pushed up from descendants are skipped
+    Returns:
+        dict: the query, in mongodb syntax
+    """
+    query = {}
+    if skip_replicas:
+        query["replica"] = {"$ne": True}
+    if thing_type is not None:
+        query["thing_type"] = thing_type
+    if thing_id is not None:
+        query["thing_id"] = thing_id
+    return query
+
+
+def find_local_things(query: dict, fields: list = None):
+    """Read the local thing descriptions matching a raw mongodb query, without building mongoengine documents
+
+    Args:
+        query(dict): the query, in mongodb syntax
+        fields(list): the fields to return, see `get_search_fields`. If this is None, every field is returned.
+            '_id' is only returned if it is in the list.
+    Returns:
+        pymongo.cursor.Cursor: cursor over the raw documents
+    """
+    projection = None
+    if fields:
+        projection = {field: 1 for field in fields}
+        projection.setdefault("_id", 0)
+    return get_thing_collection().find(query, projection)
+
+
+def to_json_document(document: dict) -> dict:
+    """Convert a raw thing description read from mongodb to the JSON-compatible form returned by `Document.to_json()`
+
+    Thing descriptions are only written from JSON request bodies, so their '_id' is the only value that has to be converted.
+
+    Args:
+        document(dict): the raw document, which is modified in place
+    Returns:
+        dict: the same document, with '_id' in MongoDB Extended JSON format
+    """
+    if isinstance(document.get("_id"), ObjectId):
+        document["_id"] = {"$oid": str(document["_id"])}
+    return document
+
+
+def get_search_fields(fields: str) -> list:
+    """Parse the `fields` argument of a search into the list of fields of the thing descriptions to return
+
+    Fields are separated by commas, and nested fields are written with dots, for example "title,properties.geo".
+    "id" and "@type" stand for "thing_id" and "thing_type". "thing_id" is always returned. A field nested in another
+    requested field is dropped, for example "properties,properties.geo" returns "properties".
+
+    Args:
+        fields(str): the `fields` argument of the request, or None
+    Returns:
+        list: the fields to return, or None if every field is returned
+    Raises:
+        ValueError: if a field name is invalid
+    """
+    if fields is None or not fields.strip():
+        return None
+    field_list = []
+    for field in fields.split(','):
+        field = field.strip()
+        field = {"id": "thing_id", "@type": "thing_type"}.get(field, field)
+        if not field:
+            continue
+        if field.startswith('$') or '' in field.split('.'):
+            raise ValueError("Invalid field")
+        if field not in field_list:
+            field_list.append(field)
+    if "thing_id" not in field_list:
+        field_list.append("thing_id")
+    # a field nested in another requested field is returned with it, and mongodb rejects both paths in one projection
+    return [field for field in field_list if not any(field.startswith(f"{other}.") for other in field_list)]
+
+
+def stream_search_result(thing_type: str, thing_id: str, query_parameters: dict, fields: list = None):
+    """Stream the search result of the subtree rooted at current directory in NDJSON format
+
+    Local thing descriptions are emitted straight from the mongodb cursor, then children's streams are relayed.
+    Copies pushed up from descendants are skipped, since the directory holding the original one is always in the 
+    same subtree. So each thing description is emitted once, without keeping track of the emitted ones.
+
+    Args:
+        thing_type(str): Type of thing descriptions to return. If this is None, there is no constraint on the type.
+        thing_id(str): ID of the thing description to return. If this is None, there is no constraint on the id.
+        query_parameters(dict): Query parameters of the requests sent to children directories.
+        fields(list): the fields of the thing descriptions to return, see `get_search_fields`. If this is None, every field is returned.
+
+    Yields:
+        bytes: one thing description in JSON format per line, ending with a newline
+    """
+    for thing in find_local_things(get_local_query(thing_type, thing_id, True), fields):
+        yield json.dumps(to_json_document(thing)).encode() + b"\n"
+
+    request_arguments = get_children_requests(thing_type, url_for("api.search"), query_parameters, thing_id)
+    if request_arguments:
+        yield from stream_children_result(request_arguments, app.config.get('SEARCH_STREAM_BUFFER_SIZE', 256),
+                                          app.config.get('SEARCH_STREAM_STALL_TIMEOUT', 30))
+
+
+def encode_search_cursor(state: dict) -> str:
+    """Encode the progress of a paginated search into an opaque continuation token
+
+    Args:
+        state(dict): the progress of the search, see `get_search_page`
+    Returns:
+        str: URL-safe continuation token
+    """
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> dict:
+    """Decode a continuation token created by `encode_search_cursor`
+
+    Args:
+        cursor(str): the continuation token
+    Returns:
+        dict: the progress of the search
+    Raises:
+        ValueError: if the token is not a valid continuation token
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if type(state) != dict or type(state.get("children", {})) != dict or type(state.get("local_done", False)) != bool:
+        raise ValueError("Invalid cursor")
+    local_last_id = state.get("local")
+    if local_last_id is not None and (type(local_last_id) != str or not ObjectId.is_valid(local_last_id)):
+        raise ValueError("Invalid cursor")
+    if any(type(child_cursor) not in (str, type(None)) for child_cursor in state.get("children", {}).values()):
+        raise ValueError("Invalid cursor")
+    return state
+
+
+def get_search_page(thing_type: str, thing_id: str, query_parameters: dict, limit: int, state: dict,
+                    fields: list = None) -> tuple:
+    """Get one page of the search result of the subtree rooted at current directory
+
+    The local collection is read first, ordered by '_id', then each relevant child directory in turn. Each child is asked 
+    for no more results than needed to fill the page, and returns its own continuation token. The progress is kept in 
+    `state`: the last local '_id' returned ("local"), whether the local collection is exhausted ("local_done"), and the 
+    continuation token of each child already requested ("children"), set to None when the child is exhausted.
+    A child that fails, or does not answer with a list, is treated as exhausted, and `g.partial_result` is set so the page
+    is marked as partial.
+    Copies pushed up from descendants are skipped, since the directory holding the original one is in the same subtree.
+
+    Args:
+        thing_type(str): Type of thing descriptions to return. If this is None, there is no constraint on the type.
+        thing_id(str): ID of the thing description to return. If this is None, there is no constraint on the id.
+        query_parameters(dict): Query parameters of the requests sent to children directories.
+        limit(int): maximum number of thing descriptions in the page
+        state(dict): the progress of the search decoded from the continuation token, or an empty dict for the first page
+        fields(list): the fields of the thing descriptions to return, see `get_search_fields`. If this is None, every field is returned.
+
+    Returns:
+        tuple: the list of thing descriptions in the page, and the progress of the search (None if the search is complete)
+    """
+    page = []
+    children_state = dict(state.get("children", {}))
+    local_last_id = state.get("local")
+    local_done = state.get("local_done", False)
+
+    # 1. local thing descriptions
+    if not local_done:
+        local_query = get_local_query(thing_type, thing_id, True)
+        if local_last_id is not None:
+            local_query["_id"] = {"$gt": ObjectId(local_last_id)}
+        # read one more thing description to know whether the local collection is exhausted
+        # '_id' is needed for the continuation token even if it is not returned
+        local_fields = fields + ["_id"] if fields and "_id" not in fields else fields
+        local_things = list(find_local_things(local_query, local_fields).sort("_id", 1).limit(limit + 1))
+        local_done = len(local_things) <= limit
+        local_things = local_things[:limit]
+        if local_things:
+            local_last_id = str(local_things[-1]["_id"])
+        if local_fields is not fields:
+            for thing in local_things:
+                del thing["_id"]
+        page.extend(to_json_document(thing) for thing in local_things)
+
+    # 2. children directories, in the same order for every page
+    child_parameters = {key: value for key, value in query_parameters.items() if key != "cursor"}
+    children_requests = get_children_requests(thing_type, url_for("api.search"), child_parameters, thing_id)
+    for request_url, parameters in children_requests:
+        if len(page) >= limit:
+            break
+        if request_url in children_state and children_state[request_url] is None:
+            continue
+        parameters["limit"] = limit - len(page)
+        if children_state.get(request_url):
+            parameters["cursor"] = children_state[request_url]
+        try:
+            response = peer_session.get(request_url, params=parameters)
+        except requests.RequestException:
+            response = None
+        child_page = None
+        if response is not None and response.status_code == 200:
+            try:
+                child_page = decode_response(response)
+            except ValueError:
+                pass
+        if type(child_page) != list:
+            # the failed child is given up, so that the pagination ends, and the result is reported as partial
+            children_state[request_url] = None
+            g.partial_result = True
+            continue
+        page.extend(child_page)
+        if response.headers.get(PARTIAL_RESULT_HEADER):
+            g.partial_result = True
+        # children not supporting pagination return everything at once, without continuation token
+        children_state[request_url] = response.headers.get(NEXT_CURSOR_HEADER)
+
+    # the search is complete when the local collection and every relevant child are exhausted
+    if local_done and all(children_state.get(request_url, "") is None for request_url, _ in children_requests):
+        return page, None
+    return page, {"local": local_last_id, "local_done": local_done, "children": children_state}
+
+
+def thing_id_exists(thing_id: str) -> bool:
+    """Check whether a thing description with the given id exists anywhere in the tree
+
+    The search starts from the root directory, and only visits the directories whose thing_id filters may contain the id.
+
+    Args:
+        thing_id (str): the id to look for
+    Returns:
+        bool: True if the id is found, or if the search failed
+    """
+    if not thing_id:
+        return False
+    if routing_table.parent is None:
+        if ThingDescription.objects(thing_id=thing_id).only('thing_id').first() is not None:
+            return True
+        if get_children_result(None, url_for("api.search"), {"thing_id": thing_id}, thing_id):
+            return True
+        # a child which failed to answer may hold the id
+        return g.pop('partial_result', False)
+    master_dir = routing_table.master
+    if master_dir is None:
+        return False
+    try:
+        response = peer_session.get(urljoin(master_dir.url, url_for("api.search")), params={"thing_id": thing_id})
+    except requests.RequestException:
+        return True
+    return response.status_code != 200 or len(decode_response(response)) > 0
+
+
+@api.route('/id_filter', methods=['POST'])
+def update_id_filter():
+    """Set bits in the thing_id filter that the current directory keeps for a child directory, see Droit/bloom.py
+
+    The bits that were not set in the filter of any child yet are reported to the parent directory in turn.
+
+    Args:
+        All of the following arguments are passed in the request body in JSON format.
+        name (str): the name of the reporting child directory
+        indices (list): the positions of the bits to set
+        bits (int), hashes (int): the filter parameters used by the child, they must match the current directory's ones
+
+    Returns:
+        HTTP Response: HTTP status code 200 if the filter is updated, otherwise 400.
+    """
+    if not is_json_request(request, ["name", "indices"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    child_name = body['name']
+    indices = body['indices']
+    if child_name not in routing_table.children:
+        return "Unknown child directory", 400
+    if body.get('bits', id_filters.size) != id_filters.size or body.get('hashes', id_filters.num_hashes) != id_filters.num_hashes:
+        return "Mismatched thing_id filter parameters", 400
+    if type(indices) != list or not all(type(index) == int and 0 <= index < id_filters.size for index in indices):
+        return jsonify(ERROR_JSON), 400
+
+    new_indices = id_filters.add_indices(child_name, indices)
+    propagate_id_filter(sorted(new_indices), f"id_filter:{uuid.uuid4().hex}")
+    return make_response("Update thing_id filter succesfully.", 200)
+
+
+@api.route('/subtree_version', methods=['POST'])
+def update_subtree_version():
+    """Increment the subtree version of the current directory when the subtree of a child directory has changed
+
+    The change is notified to the parent directory in turn, see `propagate_subtree_change`.
+
+    Args:
+        name (str): the name of the notifying child directory, passed in the request body in JSON format
+
+    Returns:
+        HTTP Response: HTTP status code 200 if the version is updated, otherwise 400.
+    """
+    if not is_json_request(request, ["name"]):
+        return jsonify(ERROR_JSON), 400
+    if request.get_json()['name'] not in routing_table.children:
+        return "Unknown child directory", 400
+    propagate_subtree_change()
+    return make_response("Update subtree version succesfully.", 200)
+
+
+def get_membership_body() -> tuple:
+    """Parse the body of a join or leave request
+
+    Returns:
+        tuple: the name of the child directory and the list of member names (None if missing), or None if the body is invalid
+    """
+    if not is_json_request(request, ["name"]):
+        return None
+    body = request.get_json()
+    name = body['name']
+    members = body.get('members')
+    if type(name) != str or not name or \
+            (members is not None and (type(members) != list or any(type(member) != str for member in members))):
+        return None
+    if app.config.get('HOST_NAME') == name or (members and app.config.get('HOST_NAME') in members):
+        return None
+    return name, members or None
+
+
+def get_membership_conflicts(name: str, members: list) -> list:
+    """Find the joining directories that already have another place in the tree known by the current directory
+
+    The master, the ancestors of the current directory, its other children and the descendants reached through another
+    child can not join under the child 'name'.
+
+    Args:
+        name (str): the child directory reporting the joining directories
+        members (list[str]): the names of the joining directories
+
+    Returns:
+        list: the names of the conflicting directories, empty if the join is allowed
+    """
+    names = set(members) | {name}
+    routes = routing_table.routes
+    conflicts = names & ({'master'} | {ancestor.name for ancestor in routes.ancestors})
+    conflicts.update(directory.directory_name for directory in DirectoryNameToURL.objects(directory_name__in=list(names))
+                     if directory.relationship != 'child' or directory.directory_name != name)
+    conflicts.update(mapping.target_name for mapping in TargetToChildName.objects(target_name__in=list(names))
+                     if mapping.child_name != name)
+    return sorted(conflicts)
+
+
+@api.route('/join', methods=['POST'])
+def join():
+    """Add directories to the subtree of the current directory without restarting it
+
+    The routing collections are updated in place, then the joining directories are reported to the parent directory,
+    and so on up to the root. A new directory announces itself to its parent when it starts, see `announce_to_parent`.
+
+    Args:
+        All of the following arguments are passed in the request body in JSON format.
+        name (str): the child directory reporting the joining directories. It becomes a new child if it is unknown.
+        url (str): the base URL of the child directory, required if it is unknown. The URL of a known child can not
+            be changed, the child has to leave first.
+        members (list[str]): optional, the names of the joining directories, by default only the child directory.
+
+    Returns:
+        HTTP Response: HTTP status code 200 if the directories joined, otherwise 400. A directory already reached
+            through another child, or an ancestor of the current directory, can not join, see `get_membership_conflicts`.
+    """
+    membership = get_membership_body()
+    if membership is None:
+        return jsonify(ERROR_JSON), 400
+    name, members = membership
+    members = members or [name]
+    url = request.get_json().get('url')
+    if url is not None and (type(url) != str or not url):
+        return jsonify(ERROR_JSON), 400
+    conflicts = get_membership_conflicts(name, members)
+    if conflicts:
+        return jsonify({"error": "Directories already in the tree must leave before they join again.",
+                        "conflicts": conflicts}), 400
+    routes = routing_table.routes
+    if name not in routes.children:
+        if url is None:
+            return jsonify(ERROR_JSON), 400
+        DirectoryNameToURL.objects(directory_name=name).update_one(
+            set__url=url.rstrip('/'), set__relationship='child', upsert=True)
+    elif url is not None and url.rstrip('/') != routes.children[name]:
+        # a known child keeps its URL until it leaves
+        return jsonify({"error": "The directory is already a child with another URL, it must leave first.",
+                        "conflicts": [name]}), 400
+
+    descendants = [member for member in members if member != name]
+    if descendants:
+        TargetToChildName._get_collection().bulk_write([
+            UpdateOne({"targetLoc": member}, {"$set": {"childLoc": name}}, upsert=True) for member in descendants
+        ], ordered=False)
+    routing_table.invalidate()
+    for member in members:
+        referral_cache.invalidate(member)
+    subtree_version.bump()
+
+    propagate_membership("join", members)
+    return make_response("Joined", 200)
+
+
+@api.route('/leave', methods=['POST'])
+def leave():
+    """Remove directories from the subtree of the current directory without restarting it
+
+    The routing collections and aggregation data about the leaving directories are removed in place, then the leaving
+    directories are reported to the parent directory, and so on up to the root. If the child directory itself leaves,
+    its whole subtree leaves with it and its thing_id filter is dropped. Copies of thing descriptions pushed up from the
+    leaving directories are deleted, see `delete_local_replicas`.
+    A directory joining again reports its whole subtree to the parent, see `report_subtree_to_parent`.
+
+    Args:
+        All of the following arguments are passed in the request body in JSON format.
+        name (str): the child directory whose subtree the directories leave.
+        members (list[str]): optional, the names of the leaving directories, by default the child directory.
+
+    Returns:
+        HTTP Response: HTTP status code 200 if the directories left, otherwise 400.
+    """
+    membership = get_membership_body()
+    if membership is None:
+        return jsonify(ERROR_JSON), 400
+    name, members = membership
+    routes = routing_table.routes
+    if name not in routes.children:
+        return jsonify(ERROR_JSON), 400
+    members = members or [name]
+    if name in members:
+        subtree = [target for target, child in routes.descendant_to_child.items() if child == name]
+        members = [name] + [member for member in dict.fromkeys(members + subtree) if member != name]
+        DirectoryNameToURL.objects(directory_name=name, relationship='child').delete()
+        TargetToChildName.objects(child_name=name).delete()
+        IdFilter.objects(directory_name=name).delete()
+    else:
+        TargetToChildName.objects(target_name__in=members, child_name=name).delete()
+    for aggregation in TypeToChildrenNames.objects(children_names__in=members):
+        aggregation.update(pull_all__children_names=members,
+                           **{f"unset__children_counts__{member}": True for member in members
+                              if member in (aggregation.children_counts or {})})
+        # the locations are reported to the parent again if they join again
+        for member in members:
+            reported_aggregations.discard(aggregation.thing_type, member)
+    delete_local_replicas(members)
+    routing_table.invalidate()
+    for member in members:
+        referral_cache.invalidate(member)
+    subtree_version.bump()
+
+    propagate_membership("leave", members)
+    return make_response("Left", 200)
+
+
 @api.route('/register', methods=['POST'])
 def register():
     """Register thing description at the target location. 
@@ -219,9 +1412,16 @@ def register():
         location (str): the location where the thing description should be registered
         publicity (number): specify the number of levels that the thing description should be duplicate to upper level directory.
             By default this is zero, means it does not need to be pushed up.
+        replica (bool): optional, set by the push-up operation to mark the thing description as a copy of a descendant's one.
+            The "origin" field of a copy names the directory storing the original, it is dropped from other thing descriptions.
+        check_duplicate (bool): optional, if true the registration is rejected when a thing description with the same id
+            already exists anywhere in the tree. The check is a search by id from the root directory, which only visits
+            the directories whose thing_id filters may contain the id.
 
     Returns:
         HTTP Response: if the register is completed, a simple success string with HTTP status code 200 is returned
+            If the thing description is stored but the parent directory could not be updated, HTTP status code 200 is
+            returned as well, with the 'X-Propagation-Failed' header.
             Otherwise a reason is returned in the response and HTTP status code is set to 400
     """
 
@@ -232,6 +1432,7 @@ def register():
     location = body['location']
     thing_description = body['td']
     publicity = int(body['publicity']) if 'publicity' in body else 0
+    replica = True if body.get('replica') else None
     headers = {
         'Content-Type': 'application/json',
         'Accept-Charset': 'UTF-8'
@@ -249,22 +1450,48 @@ def register():
         # remove it to avoid duplicate key error when creating new object
         if "publicity" in thing_description:
             del thing_description["publicity"]
-        new_td = ThingDescription(publicity=publicity, **thing_description)
+        if "replica" in thing_description:
+            del thing_description["replica"]
+        # only copies pushed up from a descendant keep the directory storing the original
+        if not replica:
+            thing_description.pop("origin", None)
+        if body.get('check_duplicate') and thing_id_exists(thing_description.get("thing_id")):
+            return make_response("Register failed - Duplicate thing_id", 400)
+        new_td = ThingDescription(publicity=publicity, replica=replica, **thing_description)
+        thing_type = thing_description.get("thing_type")
+        begin_type_write(thing_type)
+        created_count = 0
         try:
             new_td.save()
+            created_count = 1
         except Exception as e:
             registration_result = False
-
-        # 3b. push up thing description and update parent directory's aggregation data
-        push_up_result = push_up_things(thing_description, publicity)
-        aggregation_result = add_parent_aggregation(
-            thing_description["thing_type"], local_server_name)
+        finally:
+            # the write ends even if the request fails, see `begin_type_write`
+            type_count = update_type_count(thing_type, created_count)
+
+        # 3b. update parent directory's aggregation data and push up thing description
+        # the aggregation is only updated when the directory starts holding this type
+        if registration_result:
+            propagate_subtree_change()
+            if type_count == 1:
+                aggregation_result = propagate_aggregation(thing_type, local_server_name, True)
+            propagate_type_count(thing_type, local_server_name)
+            # copies pushed up are already in the filter of the child they come from
+            if not replica:
+                thing_id = thing_description["thing_id"]
+                propagate_id_filter(id_filters.indices(thing_id), f"id_filter:{thing_id}")
+        push_up_result = propagate_push_up([thing_description], publicity)
 
         # 3c. return result
-        if push_up_result and registration_result and aggregation_result:
-            return make_response("Created", 200)
-        else:
+        if not registration_result:
             return make_response("Register failed - Internal database error", 400)
+        if push_up_result and aggregation_result:
+            return make_response("Created", 200)
+        # the thing description is stored, only the ancestors miss it
+        response = make_response("Created - propagation to the parent directory failed", 200)
+        response.headers[PROPAGATION_FAILED_HEADER] = "true"
+        return response
 
     # otherwise, the request should be redirected to other directory
     register_api = url_for("api.register")
@@ -273,14 +1500,144 @@ def register():
 
     # check if any of above condition is satisified
     if target_url is not None:
-        master_response = requests.post(
-            target_url, data=json.dumps(body), headers=headers)
-        return make_response(master_response.reason, master_response.status_code)
+        try:
+            master_response = peer_session.post(
+                target_url, data=json.dumps(body), headers=headers)
+        except requests.RequestException:
+            referral_cache.mark_unreachable(location)
+            return make_response("Register failed - target location is not reachable", 400)
+        forwarded_response = make_response(master_response.reason, master_response.status_code)
+        if PROPAGATION_FAILED_HEADER in master_response.headers:
+            forwarded_response.headers[PROPAGATION_FAILED_HEADER] = master_response.headers[PROPAGATION_FAILED_HEADER]
+        return relay_referral(location, master_response, forwarded_response)
 
     # Otherwise the input location is invalid, return
     return jsonify(ERROR_JSON), 400
 
 
+@api.route('/register_batch', methods=['POST'])
+def register_batch():
+    """Register a list of thing descriptions at the target location.
+
+    If the current directory is the target location specified by `location` argument, the thing descriptions are inserted
+    locally with a single bulk write. Then at most one batch 'push-up' request is sent to the parent directory, and one
+    aggregation update per thing type.
+    Otherwise it will delegate the operation to the next possible directory (if there is ), and return whatever the result it receives
+
+    Args:
+        All of the following arguments are passed in the request body in JSON format.
+        tds (list): the thing descriptions to be registered
+        location (str): the location where the thing descriptions should be registered
+        publicity (number): specify the number of levels that the thing descriptions should be duplicate to upper level directory.
+        replica (bool): optional, set by the push-up operation to mark the thing descriptions as copies of a descendant's ones,
+            see `register`.
+
+    Returns:
+        HTTP Response: a JSON object with HTTP status code 200, whose "results" list gives the status of each thing description
+            in the same order as "tds": {"thing_id": ..., "status": "created"} or {"thing_id": ..., "status": "failed", "reason": ...}.
+            "propagated" is False if the push-up or the aggregation update failed.
+            If the request is invalid, HTTP status code 400 is returned.
+    """
+    if not is_json_request(request, ["tds", "location"]):
+        return jsonify(ERROR_JSON), 400
+    body = request.get_json()
+    location = body['location']
+    thing_descriptions = body['tds']
+    if type(thing_descriptions) != list:
+        return jsonify(ERROR_JSON), 400
+    try:
+        publicity = int(body['publicity']) if 'publicity' in body else 0
+    except (TypeError, ValueError):
+        return jsonify(ERROR_JSON), 400
+    replica = True if body.get('replica') else None
+
+    local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
+    if local_server_name != location:
+        # the request should be redirected to other directory
+        target_url = get_target_url(location, url_for("api.register_batch"))
+        if target_url is None:
+            return jsonify(ERROR_JSON), 400
+        try:
+            response = peer_session.post(target_url, data=json.dumps(body), headers={
+                'Content-Type': 'application/json',
+                'Accept-Charset': 'UTF-8'
+            })
+        except requests.RequestException:
+            referral_cache.mark_unreachable(location)
+            return jsonify({"error": "Target location is not reachable."}), 400
+        if response.status_code != 200:
+            return relay_referral(location, response, jsonify(ERROR_JSON)), response.status_code
+        return relay_referral(location, response, make_data_response(decode_response(response))), 200
+
+    # 1. validate each thing description
+    results = [None] * len(thing_descriptions)
+    valid_things = []  # list of (index, cleaned thing description, mongo document)
+    for index, thing_description in enumerate(thing_descriptions):
+        if type(thing_description) != dict:
+            results[index] = {"thing_id": None, "status": "failed", "reason": "Invalid thing description."}
+            continue
+        thing_description = clean_thing_description(dict(thing_description))
+        thing_description.pop("publicity", None)
+        thing_description.pop("replica", None)
+        if not replica:
+            thing_description.pop("origin", None)
+        try:
+            new_td = ThingDescription(publicity=publicity, replica=replica, **thing_description)
+            new_td.validate()
+        except Exception as e:
+            results[index] = {"thing_id": thing_description.get("thing_id"), "status": "failed", "reason": str(e)}
+            continue
+        valid_things.append((index, thing_description, new_td.to_mongo()))
+
+    # 2. insert all valid thing descriptions with one bulk write
+    write_errors = {}
+    thing_types = {thing_description.get("thing_type") for _, thing_description, _ in valid_things}
+    created_counts = {thing_type: 0 for thing_type in thing_types}
+    for thing_type in thing_types:
+        begin_type_write(thing_type)
+    try:
+        if valid_things:
+            try:
+                ThingDescription._get_collection().insert_many(
+                    [document for _, _, document in valid_things], ordered=False)
+            except BulkWriteError as e:
+                write_errors = {error["index"]: error["errmsg"] for error in e.details["writeErrors"]}
+        for position, (_, thing_description, _) in enumerate(valid_things):
+            if position not in write_errors:
+                created_counts[thing_description.get("thing_type")] += 1
+    finally:
+        # the writes end even if the request fails, see `begin_type_write`
+        type_counts = {thing_type: update_type_count(thing_type, created_count)
+                       for thing_type, created_count in created_counts.items()}
+
+    created_things = []
+    for position, (index, thing_description, _) in enumerate(valid_things):
+        if position in write_errors:
+            results[index] = {"thing_id": thing_description["thing_id"], "status": "failed", "reason": write_errors[position]}
+        else:
+            results[index] = {"thing_id": thing_description["thing_id"], "status": "created"}
+            created_things.append(thing_description)
+
+    # 3. update parent directory's aggregation data once per type and push up created thing descriptions in one request
+    propagated = True
+    if created_things:
+        propagated = propagate_subtree_change()
+    if not replica:
+        created_indices = set()
+        for thing_description in created_things:
+            created_indices.update(id_filters.indices(thing_description["thing_id"]))
+        propagated = propagate_id_filter(sorted(created_indices), f"id_filter:{uuid.uuid4().hex}") and propagated
+    for thing_type, created_count in created_counts.items():
+        if created_count == 0:
+            continue
+        if type_counts[thing_type] == created_count:
+            propagated = propagate_aggregation(thing_type, local_server_name, True) and propagated
+        propagated = propagate_type_count(thing_type, local_server_name) and propagated
+    propagated = propagate_push_up(created_things, publicity) and propagated
+
+    return make_data_response({"results": results, "created": len(created_things), "propagated": propagated}), 200
+
+
 @api.route('/update_aggregate', methods=['POST', 'DELETE'])
 def update_type_aggregation():
     """Update local aggregation data when a thing is registered/deleted at any children directory
@@ -291,6 +1648,8 @@ def update_type_aggregation():
     Args:
         thing_type (str): the type of the thing description may need to be updated.
         location (str): specify where the update operation should be done.
+        count (int): optional, the number of thing descriptions of this type stored at the location. If it is positive,
+            the location is added to the aggregation data as well.
 
     Returns:
         HTTP Response: a brief string explaining the result and corresponding HTTP status code.
@@ -303,6 +1662,17 @@ def update_type_aggregation():
         thing_type = body['thing_type']
         location = body['location']
 
+        # a child reporting the number of thing descriptions stored at the location only adds the location if it is positive
+        if 'count' in body:
+            try:
+                count = int(body['count'])
+            except (TypeError, ValueError):
+                return jsonify(ERROR_JSON), 400
+            set_location_count(thing_type, location, count)
+            propagate_type_count(thing_type, location)
+            if count <= 0:
+                return make_response("Update aggregation data succesfully.", 200)
+
         # 3. update database
         children_locations = TypeToChildrenNames.objects(
             thing_type=thing_type).first()
@@ -318,7 +1688,7 @@ def update_type_aggregation():
 
         children_locations.save()
         # 4. recursively update the aggregation data at parent's directory
-        add_parent_aggregation(thing_type, location)
+        propagate_aggregation(thing_type, location, True)
 
     elif request.method == 'DELETE':
         location = request.args.get('location')
@@ -328,11 +1698,14 @@ def update_type_aggregation():
         # delete location from the thing_type's aggregation list
         children_locations = TypeToChildrenNames.objects(
             thing_type=thing_type).first()
-        if children_locations is not None:
+        if children_locations is not None and location in children_locations.children_names:
             children_locations.children_names.remove(location)
+            # the count of the location is reported later than its removal, see Droit/reports.py
+            if children_locations.children_counts:
+                children_locations.children_counts.pop(location, None)
             children_locations.save()
             # recursivly delete parent's aggregation data for the same record
-            delete_parent_aggregation(thing_type, location)
+            propagate_aggregation(thing_type, location, False)
 
     return make_response("Update aggregation data succesfully.", 200)
 
@@ -347,6 +1720,34 @@ def adjacent_directory():
     return jsonify(DirectoryNameToURL.objects().to_json()), 200
 
 
+@api.route('/resolve', methods=['GET'])
+def resolve():
+    """Return the referral to the directory responsible for the `location` argument, without forwarding any request
+
+    Clients resolve a location iteratively, like a DNS stub resolver: they ask the returned directory again until the
+    referral is final, then cache it for `ttl` seconds and send their requests straight to that directory.
+
+    Args:
+        location (str): the name of the directory to be reached
+
+    Returns:
+        HTTP Response: {"location": ..., "url": ..., "final": ..., "ttl": ...} in JSON format with HTTP status 200.
+            "url" is the base URL of the directory itself if "final" is true, otherwise the base URL of the next directory
+            to ask. If the location can not be reached, HTTP status code 400 is returned.
+    """
+    location = request.args.get('location')
+    if not location or not location.strip():
+        return jsonify(ERROR_JSON), 400
+    location = location.strip()
+    ttl = app.config.get('RESOLVE_TTL', 300)
+    if location == app.config.get('HOST_NAME'):
+        return jsonify({"location": location, "url": request.host_url.rstrip('/'), "final": True, "ttl": ttl}), 200
+    next_hop_url = get_target_url(location)
+    if next_hop_url is None:
+        return jsonify(ERROR_JSON), 400
+    return jsonify({"location": location, "url": next_hop_url.rstrip('/'), "final": False, "ttl": ttl}), 200
+
+
 @api.route('/search', methods=['GET'])
 def search():
     """Search the thing descriptions according to the conditions from the target directory and return all satisfying thing descriptions
@@ -361,14 +1762,33 @@ def search():
             is no constraint on the type.
         id (str) : the unique thing id of the thing description. Only the thing description having this id will be returned. If this is missing,
             then there is no constraint on the id.
+        limit (number): optional, the maximum number of thing descriptions to return in one page.
+        cursor (str): optional, the continuation token returned with the previous page.
+        fields (str): optional, comma-separated list of the fields to return, for example "thing_type,title,properties.geo".
+            The projection is applied by every directory of the subtree, "thing_id" is always returned and "_id" only
+            if it is listed.
 
     Returns:
         HTTP Response: If the search operation is complete without error, a list of thing descriptions in JSON format is returned with HTTP code
             setting to 200. Otherwise a string description will be in the response body along with HTTP status code 400 is returned.
+            If the request accepts 'application/x-ndjson', the thing descriptions are streamed one per line as soon as they are found.
+            If `limit` is specified, at most `limit` thing descriptions are returned, and the continuation token of the next page 
+            is returned in the 'X-Next-Cursor' header. The header is missing on the last page.
     """
     location = request.args.get('location')
     local_server_name = app.config['HOST_NAME'] if 'HOST_NAME' in app.config else "Unknown"
     request_query_string = urlencode(request.args)
+    request_query_parameters = request.args.to_dict()
+    is_streaming = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return "Search failed(invalid limit)", 400
+        if limit <= 0:
+            return "Search failed(invalid limit)", 400
     if not location or not location.strip():
         location = local_server_name
     else:
@@ -381,18 +1801,45 @@ def search():
         # clean empty input string
         thing_type = None if not thing_type or not thing_type.strip() else thing_type.strip()
         thing_id = None if not thing_id or not thing_id.strip() else thing_id.strip()
+        try:
+            fields = get_search_fields(request.args.get('fields'))
+        except ValueError:
+            return "Search failed(invalid fields)", 400
+
+        if limit is not None:
+            try:
+                state = decode_search_cursor(cursor) if cursor else {}
+            except ValueError:
+                return "Search failed(invalid cursor)", 400
+            page, next_state = get_search_page(thing_type, thing_id, request_query_parameters, limit, state, fields)
+            response = make_data_response(page)
+            if next_state is not None:
+                response.headers[NEXT_CURSOR_HEADER] = encode_search_cursor(next_state)
+            if g.get('partial_result'):
+                response.headers[PARTIAL_RESULT_HEADER] = "true"
+            return response, 200
+
+        if is_streaming:
+            return Response(stream_with_context(stream_search_result(thing_type, thing_id, request_query_parameters, fields)),
+                            status=200, mimetype=NDJSON_MIMETYPE)
+
+        cache_key, version, cached_response = get_cached_response("search", {
+            key: value for key, value in request_query_parameters.items() if key not in ("location", "iterative")
+        })
+        if cached_response is not None:
+            return cached_response, 200
 
         thing_list = []
         # 1. add result in current directory
-        local_things = json.loads(ThingDescription.objects(thing_type=thing_type).to_json()) if thing_type is not None else \
-            json.loads(ThingDescription.objects.to_json())
+        local_things = [to_json_document(thing)
+                        for thing in find_local_things(get_local_query(thing_type, thing_id, False), fields)]
 
         if local_things is not None:
             thing_list.extend(local_things)
 
         # 2. get results from children's directory
         children_things = get_children_result(
-            thing_type, url_for("api.search"), request_query_string)
+            thing_type, url_for("api.search"), request_query_parameters, thing_id)
         thing_list.extend(children_things)
         # 3. deduplicate by thing_id
         thing_id_set = set()
@@ -401,7 +1848,7 @@ def search():
             if thing["thing_id"] not in thing_id_set and (thing_id is None or thing["thing_id"] == thing_id):
                 thing_id_set.add(thing["thing_id"])
                 result_list.append(thing)
-        return jsonify(result_list), 200
+        return cache_response(cache_key, version, make_data_response(result_list)), 200
 
     # 2. redirect to the target location
     target_url = get_target_url(location, url_for('api.search'))
@@ -415,12 +1862,26 @@ def search():
     else:
         request_url = f"{target_url}?{request_query_string}"
         try:
-            response = requests.get(request_url)
+            if is_streaming:
+                response = peer_session.get(request_url, headers={'Accept': NDJSON_MIMETYPE}, stream=True)
+            else:
+                response = peer_session.get(request_url)
         except:
+            referral_cache.mark_unreachable(location)
             return "Search failed", 400
 
         if response.status_code == 200:
-            return jsonify(response.json()), 200
+            if is_streaming:
+                return relay_referral(location, response, Response(
+                    response.iter_content(chunk_size=None), status=200,
+                    content_type=response.headers.get('Content-Type', NDJSON_MIMETYPE))), 200
+            forwarded_response = make_data_response(decode_response(response))
+            for header in (NEXT_CURSOR_HEADER, PARTIAL_RESULT_HEADER):
+                if header in response.headers:
+                    forwarded_response.headers[header] = response.headers[header]
+            return relay_referral(location, response, forwarded_response), 200
+        response.close()
+        return relay_referral(location, response, make_response("Search failed", 400))
 
     return "Search failed", 400
 
@@ -460,11 +1921,11 @@ def delete():
     if target_url is not None:
         request_url = f"{target_url}?{urlencode(request.args)}"
         try:
-            response = requests.delete(request_url)
+            response = peer_session.delete(request_url)
         except:
+            referral_cache.mark_unreachable(location)
             return "", 400
-        if response.status_code == 200:
-            return "", 200
+        return relay_referral(location, response, make_response("", 200 if response.status_code == 200 else 400))
 
     return "", 400
 
@@ -490,7 +1951,8 @@ def relocate():
 
     Returns:
         HTTP Response: The response is a pure string HTTP response with corresponding HTTP status code indicating the result
-        if the relocation operation is completed, 200 is returned. Otherwise 400 is returned.
+        if the relocation operation is completed, 200 is returned, with the 'X-Propagation-Failed' header if the target
+        directory stored the thing description but could not update its parent directory. Otherwise 400 is returned.
     """
     if not is_json_request(request, ["thing_id", "from", "to"]):
         return jsonify(ERROR_JSON), 400
@@ -511,33 +1973,47 @@ def relocate():
         if relocate_thing is None or target_url is None:
             return jsonify(ERROR_JSON), 400
         # 1. insert this thing description at 'to_location'
+        thing_description = json.loads(relocate_thing.to_json())
+        # the target directory gives the thing description a new '_id'
+        thing_description.pop("_id", None)
         request_data = {
-            "td": json.loads(relocate_thing.to_json()),
+            "td": thing_description,
             "location": to_location,
             "publicity": relocate_thing.publicity
         }
         try:
-            response = requests.post(
+            response = peer_session.post(
                 target_url, data=json.dumps(request_data), headers=headers)
-            pass
         except:
+            referral_cache.mark_unreachable(to_location)
+            return "Relocate failed", 400
+        learn_referral(to_location, response)
+        if response.status_code != 200:
+            # keep the thing description here if the target did not register it
             return "Relocate failed", 400
-        # 2. delete this thing description at 'from_location'
+        # 2. delete this thing description at 'from_location', the target stored it even if its propagation failed
         delete_local_thing_description(thing_id)
 
-        return "", 200
+        relocate_response = make_response("", 200)
+        if PROPAGATION_FAILED_HEADER in response.headers:
+            relocate_response.headers[PROPAGATION_FAILED_HEADER] = response.headers[PROPAGATION_FAILED_HEADER]
+        return relocate_response
 
     # delegate the request to other directory
     request_url = get_target_url(from_location, url_for("api.relocate"))
     if request_url is None:
         return "Request failed", 400
     try:
-        response = requests.post(
+        response = peer_session.post(
             request_url, data=json.dumps(body), headers=headers)
     except:
+        referral_cache.mark_unreachable(from_location)
         return "Request failed", 400
 
-    return "", response.status_code
+    forwarded_response = make_response("", response.status_code)
+    if PROPAGATION_FAILED_HEADER in response.headers:
+        forwarded_response.headers[PROPAGATION_FAILED_HEADER] = response.headers[PROPAGATION_FAILED_HEADER]
+    return relay_referral(from_location, response, forwarded_response)
 
 
 def deduplicate_by_id(thing_list):
@@ -624,6 +2100,108 @@ def get_final_aggregation(thing_list, operation):
         result["result"] = sum([thing_description["_query_data"] for thing_description in thing_list])
     return result
 
+def get_partial_aggregation(thing_list, operation, data_field):
+    """Get the partial aggregation state of a thing list, which can be merged with the states of other directories
+
+    The state has a fixed size whatever the number of things: the number of things holding the data field, and
+    the sum, minimum or maximum of the data field depending on the operation.
+
+    Args:
+        thing_list(list): the list of thing description
+        operation(str): one of the five aggregation operations
+        data_field(str): property names. If it contains hierarchical property, then seperate each part using dot '.'
+
+    Returns:
+        dict: the partial aggregation state
+    """
+    compressed_thing_list = get_compressed_list(thing_list, operation, data_field)
+    partial = {"count": len(compressed_thing_list)}
+    if operation == "COUNT":
+        return partial
+    values = [thing_description["_query_data"] for thing_description in compressed_thing_list]
+    if operation in ("SUM", "AVG"):
+        partial["sum"] = sum(values)
+    elif operation == "MIN":
+        partial["min"] = min(values) if values else None
+    elif operation == "MAX":
+        partial["max"] = max(values) if values else None
+    return partial
+
+def get_local_partial_aggregation(queryset, operation, data_field):
+    """Get the partial aggregation state of the thing descriptions matched by a query, computed by mongodb
+
+    The query is compiled into one aggregation with a `$match` stage (the query conditions, and the existence of
+    the data field) and a `$group` stage, so only the aggregation state is returned by the database.
+
+    Args:
+        queryset(QuerySet): the mongoengine query matching the thing descriptions to aggregate
+        operation(str): one of the five aggregation operations
+        data_field(str): property names. If it contains hierarchical property, then seperate each part using dot '.'
+
+    Returns:
+        dict: the partial aggregation state, in the same format as `get_partial_aggregation`
+    """
+    pipeline = []
+    group = {"_id": None, "count": {"$sum": 1}}
+    if operation != "COUNT":
+        pipeline.append({"$match": {data_field: {"$exists": True, "$ne": None}}})
+        key = "sum" if operation in ("SUM", "AVG") else operation.lower()
+        group[key] = {f"${key}": f"${data_field}"}
+    pipeline.append({"$group": group})
+
+    result = list(queryset.aggregate(*pipeline))
+    if not result:
+        return get_partial_aggregation([], operation, data_field)
+    partial = result[0]
+    del partial["_id"]
+    return partial
+
+def merge_partial_aggregations(partial_list, operation):
+    """Merge partial aggregation states of several directories into one
+
+    Args:
+        partial_list(list): the list of partial aggregation states
+        operation(str): one of the five aggregation operations
+
+    Returns:
+        dict: the merged partial aggregation state
+    """
+    partial = {"count": sum(item["count"] for item in partial_list)}
+    if operation in ("SUM", "AVG"):
+        partial["sum"] = sum(item["sum"] for item in partial_list)
+    elif operation in ("MIN", "MAX"):
+        key = operation.lower()
+        values = [item[key] for item in partial_list if item.get(key) is not None]
+        reduce_function = min if operation == "MIN" else max
+        partial[key] = reduce_function(values) if values else None
+    return partial
+
+def get_final_aggregation_from_partial(partial, operation):
+    """Generate the HTTP response content according to the operation and the merged partial aggregation state
+
+    Args:
+        partial(dict): the partial aggregation state of the whole subtree
+        operation(str): one of the five aggregation operations
+
+    Returns:
+        dict: formatted result containing the aggregation data
+    """
+    if operation != "COUNT" and partial["count"] == 0:
+        return {"operation": operation, "result": "unknown"}
+
+    result = {"operation": operation}
+    if operation == "COUNT":
+        result["result"] = partial["count"]
+    elif operation == "MIN":
+        result["result"] = partial["min"]
+    elif operation == "MAX":
+        result["result"] = partial["max"]
+    elif operation == "AVG":
+        result["result"] = partial["sum"] / partial["count"]
+    elif operation == "SUM":
+        result["result"] = partial["sum"]
+    return result
+
 @api.route('/custom_query', methods=['GET'])
 def custom_query():
     """Return all thing descriptions from the target directory and its descandant directories that satisfy the filter conditions
@@ -666,6 +2244,11 @@ def custom_query():
     if location == local_server_name:
         operation = script_json["operation"].strip()
         thing_type = script_json["type"].strip()
+        cache_key, version, cached_response = get_cached_response("custom_query", {
+            key: value for key, value in script_json.items() if key != "location"
+        })
+        if cached_response is not None:
+            return cached_response, 200
         
         filter_map = {}
         # add geographical filter condition
@@ -678,22 +2261,52 @@ def custom_query():
         for filter_name in filters:
             filter_map[filter_name.replace(".", "__")] = filters[filter_name]
 
-        try:
-            thing_list = json.loads(ThingDescription.objects(thing_type=thing_type, **filter_map).to_json())
-        except:
-            return jsonify({"reason": "filter condition error."}), 400
-
         # 3. get children result.
         # "_sub_dir" field checks whether current directory is a recursive node
-        # if this field is true, which means the request must return a compressed thing list results
+        # if this field is true, which means the request must return a partial aggregation state,
+        # or a compressed thing list results when the parent does not ask for "_partial" states
         # otherwise, return the final aggregation result
         is_sub_dir = "_sub_dir" in script_json
+        is_partial = not is_sub_dir or "_partial" in script_json
         script_json["_sub_dir"] = True  # Give hint to children directory
+        if is_partial:
+            script_json["_partial"] = True
+            # copies pushed up from descendants are counted by the directory they are registered at,
+            # which is always in the same subtree, so each thing is aggregated exactly once
+            filter_map["replica__ne"] = True
+
+        # the local partial state is computed by mongodb, only the compressed list is built from thing descriptions
+        try:
+            if is_partial:
+                local_partial = get_local_partial_aggregation(
+                    ThingDescription.objects(thing_type=thing_type, **filter_map), operation, data_field)
+            else:
+                thing_list = [to_json_document(thing) for thing in
+                              find_local_things(ThingDescription.objects(thing_type=thing_type, **filter_map)._query)]
+        except:
+            return jsonify({"reason": "filter condition error."}), 400
+
         # delete the "location" field in the query string, then each children will treat themselves as the target dir
         if "location" in script_json:
             del script_json["location"]
         children_result_list = get_children_result(thing_type, url_for(
-            "api.custom_query"), f"data={json.dumps(script_json)}")
+            "api.custom_query"), {"data": json.dumps(script_json)})
+
+        # 4. return data
+        if is_partial:
+            # children return partial states, except directories not supporting them, which return compressed thing lists
+            partial_list = [local_partial] + [item for item in children_result_list if "count" in item]
+            compressed_children_list = [item for item in children_result_list if "thing_id" in item]
+            if compressed_children_list:
+                partial_list.append(get_partial_aggregation(
+                    deduplicate_by_id(compressed_children_list), operation, data_field))
+            partial = merge_partial_aggregations(partial_list, operation)
+            # return the aggregation result if current directory is the root
+            # otherwise return the partial state
+            if not is_sub_dir:
+                return cache_response(cache_key, version, make_data_response(get_final_aggregation_from_partial(partial, operation))), 200
+            return cache_response(cache_key, version, make_data_response(partial)), 200
+
         thing_list.extend(children_result_list)
         thing_list = deduplicate_by_id(thing_list)
         #
@@ -701,14 +2314,7 @@ def custom_query():
         # COUNT: [{id1}, {id2}, {id3}, ...]
         # MIN,MAX,SUM,AVG: [{id, data: a}, {id, data: b}]
         compressed_thing_list = get_compressed_list(thing_list, operation, data_field)
-
-        # 4. return data
-        # return the aggregation result if current directory is the root
-        # otherwise return the compressed list
-        if not is_sub_dir:
-            return jsonify(get_final_aggregation(compressed_thing_list, operation)), 200
-        else:
-            return jsonify(compressed_thing_list), 200
+        return cache_response(cache_key, version, make_data_response(compressed_thing_list)), 200
 
     # when location is not here, delegate to other directories
     request_url = get_target_url(
@@ -716,11 +2322,15 @@ def custom_query():
     if request_url is None:
         return jsonify("Request failed(location does not exist.)"), 400
     try:
-        response = requests.get(f"{request_url}?data={script}")
+        response = peer_session.get(request_url, params={"data": script})
     except:
+        referral_cache.mark_unreachable(script_json["location"])
         return jsonify("Request failed(target location is not running.)"), 400
 
     if response.status_code == 200:
-        return jsonify(response.json()), 200
+        forwarded_response = make_data_response(decode_response(response))
+        if PARTIAL_RESULT_HEADER in response.headers:
+            forwarded_response.headers[PARTIAL_RESULT_HEADER] = response.headers[PARTIAL_RESULT_HEADER]
+        return relay_referral(script_json["location"], response, forwarded_response), 200
 
-    return jsonify("Request failed(from other location)"), 400
+    return relay_referral(script_json["location"], response, jsonify("Request failed(from other location)")), 400
@@ -0,0 +1,122 @@
+"""
+Helpers defined in this file select the wire format of the data exchanged between directories.
+
+Responses carrying data are negotiated with the `Accept` header of the request: directories ask each other for BSON
+(`application/bson`), which is more compact and faster to parse than JSON, while external clients and the dashboard keep
+receiving JSON. Since a BSON document must be an object, the data is wrapped as `{"data": ...}`.
+Large bodies are compressed with gzip in both directions: responses when the client sends `Accept-Encoding: gzip`,
+and requests sent to other directories, which are decompressed by `GzipRequestMiddleware` before flask reads them.
+Directories advertise that they accept compressed requests with an `Accept-Encoding: gzip` response header (RFC 7694),
+and requests are only compressed for the directories which sent it, so directories of older versions keep working.
+For more information about BSON, please refer to http://bsonspec.org/
+"""
+import io
+import gzip
+import bson
+from flask import current_app, request, jsonify
+from werkzeug.wsgi import get_input_stream
+
+BSON_MIMETYPE = "application/bson"
+JSON_MIMETYPE = "application/json"
+DEFAULT_GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# response header listing the content codings accepted in request bodies
+REQUEST_ENCODING_HEADER = "Accept-Encoding"
+
+
+class GzipRequestMiddleware(object):
+    """WSGI middleware decompressing request bodies sent with `Content-Encoding: gzip`
+
+    Args:
+        wsgi_app: the WSGI application receiving the decompressed requests
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING', '').strip().lower() == 'gzip':
+            try:
+                body = gzip.decompress(get_input_stream(environ).read())
+            except (OSError, EOFError):
+                start_response('400 BAD REQUEST', [('Content-Type', 'text/plain')])
+                return [b"Invalid gzip request body"]
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+
+def init_wire_format(app) -> None:
+    """Decompress gzip request bodies and compress large responses of the flask app
+
+    Args:
+        app (flask.Flask): the flask app of the current directory
+    """
+    app.wsgi_app = GzipRequestMiddleware(app.wsgi_app)
+    app.after_request(compress_response)
+    app.after_request(advertise_request_encoding)
+
+
+def advertise_request_encoding(response):
+    """Tell the client that request bodies compressed with gzip are accepted, see `GzipRequestMiddleware`
+
+    """
+    response.headers.setdefault(REQUEST_ENCODING_HEADER, 'gzip')
+    return response
+
+
+def get_response_mimetype() -> str:
+    """Return the format of the data returned to the current request: BSON if the client prefers it, otherwise JSON
+
+    """
+    if request.accept_mimetypes[BSON_MIMETYPE] > request.accept_mimetypes[JSON_MIMETYPE]:
+        return BSON_MIMETYPE
+    return JSON_MIMETYPE
+
+
+def make_data_response(data):
+    """Create the response carrying 'data' in the format negotiated with the client, see `get_response_mimetype`
+
+    Args:
+        data: any JSON-serializable object
+    Returns:
+        flask.Response: the response with HTTP status code 200
+    """
+    if get_response_mimetype() == BSON_MIMETYPE:
+        return current_app.response_class(bson.BSON.encode({"data": data}), mimetype=BSON_MIMETYPE)
+    return jsonify(data)
+
+
+def decode_response(response):
+    """Return the data carried by the response of another directory, in BSON or JSON format
+
+    Args:
+        response (requests.Response): the response of the other directory
+    Raises:
+        ValueError: if the body can not be decoded
+    """
+    if response.headers.get('Content-Type', '').startswith(BSON_MIMETYPE):
+        try:
+            return bson.BSON(response.content).decode()["data"]
+        except (bson.errors.BSONError, KeyError) as e:
+            raise ValueError(str(e))
+    return response.json()
+
+
+def compress_response(response):
+    """Compress the body of a large response with gzip if the client accepts it
+
+    Streamed responses are sent as they are, so their first lines are not delayed.
+    """
+    min_size = current_app.config.get('WIRE_GZIP_MIN_SIZE', DEFAULT_GZIP_MIN_SIZE)
+    if min_size is None or response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers or 'gzip' not in request.accept_encodings:
+        return response
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+    response.set_data(gzip.compress(body, GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,62 @@
+"""
+Benchmark of the local read path of `search`: mongoengine documents versus raw pymongo documents
+
+Thing descriptions are inserted in a scratch database, then read back and serialized to JSON with each read path.
+The throughput (thing descriptions per second) and the CPU time per thing description of each path are printed.
+With `--url`, the `/api/search` endpoint of a running directory is benchmarked as well.
+"""
+import json
+import time
+import click
+import requests
+from mongoengine import connect, disconnect
+from Droit.models import ThingDescription
+from Droit.views.api import to_json_document
+
+
+def run_path(name: str, read, rounds: int, count: int) -> None:
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for _ in range(rounds):
+        body = json.dumps(read())
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    results = rounds * count
+    print(f"{name:<12} {results / wall:>12.0f} things/s {cpu / results * 1e6:>10.2f} us CPU/thing {len(body):>12} bytes")
+
+
+@click.command()
+@click.option('--host', default='mongodb://localhost:27017', type=str, help="URI of the mongodb server.")
+@click.option('--count', default=10000, type=int, help="Number of thing descriptions to insert.")
+@click.option('--rounds', default=5, type=int, help="Number of times each read path is run.")
+@click.option('--url', default=None, type=str, help="Base URL of a running directory whose search endpoint is benchmarked.")
+def main(host, count, rounds, url):
+    """
+    Compare the throughput and the CPU cost of the read paths of a local search
+    """
+    connect('goldie_benchmark', host=host)
+    ThingDescription.drop_collection()
+    properties = {f"property{i}": {"type": "number", "forms": [{"href": f"http://device/property{i}"}]} for i in range(10)}
+    ThingDescription._get_collection().insert_many([
+        ThingDescription(thing_id=f"thing{i}", thing_type="bench", title=f"thing {i}", properties=properties).to_mongo()
+        for i in range(count)
+    ])
+
+    run_path("mongoengine", lambda: json.loads(ThingDescription.objects(thing_type="bench").to_json()), rounds, count)
+    run_path("pymongo", lambda: [to_json_document(thing) for thing in
+                                 ThingDescription._get_collection().find({"thing_type": "bench"})], rounds, count)
+    run_path("projection", lambda: [to_json_document(thing) for thing in ThingDescription._get_collection().find(
+        {"thing_type": "bench"}, {"thing_id": 1, "thing_type": 1})], rounds, count)
+
+    if url is not None:
+        session = requests.Session()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            response = session.get(f"{url}/api/search")
+        wall = time.perf_counter() - start
+        print(f"{'http':<12} {rounds / wall:>12.2f} requests/s {len(response.content):>12} bytes")
+
+    ThingDescription.drop_collection()
+    disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 import os
+import json
+from urllib.parse import urlsplit
 
 """
 Set up the configuration for flask environment using classes
@@ -37,160 +39,103 @@ class DevConfig(BaseConfig):
     # Mongo Engine
     MONGODB_HOST = 'localhost'
     MONGODB_PORT = 27017
-
-class Level1DevConfig(DevConfig):
-    HOST_NAME = "level1"
-    ENV_NAME = "Level1-Dev"
-    PORT=5001
-    # mongo engine
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level1'
-    # pymongo
-    MONGO_URI = "mongodb://localhost:27017/level1"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5001/'
-    OAUTH2_JWT_KEY = 'level1-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-
-class Level2aDevConfig(DevConfig):
-    HOST_NAME = "level2a"
-    ENV_NAME = "Level2a-Dev"
-    PORT=5002
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level2a'
-    MONGO_DBNAME = 'level2a'
-    MONGO_URI = "mongodb://localhost:27017/level2a"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5002/'
-    OAUTH2_JWT_KEY = 'level2a-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-class Level2bDevConfig(DevConfig):
-    HOST_NAME = "level2b"
-    ENV_NAME = "Level2b-Dev"
-    PORT=5003
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level2b'
-    MONGO_DBNAME = 'level2b'
-    MONGO_URI = "mongodb://localhost:27017/level2b"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5003/'
-    OAUTH2_JWT_KEY = 'level2b-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-class Level3aaDevConfig(DevConfig):
-    HOST_NAME = "level3aa"
-    ENV_NAME = "Level3aa-Dev"
-    PORT=5004
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level3aa'
-    MONGO_DBNAME = 'level3aa'
-    MONGO_URI = "mongodb://localhost:27017/level3aa"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5004/'
-    OAUTH2_JWT_KEY = 'level3aa-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-class Level3abDevConfig(DevConfig):
-    HOST_NAME = "level3ab"
-    ENV_NAME = "Level3ab-Dev"
-    PORT=5005
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level3ab'
-    MONGO_DBNAME = 'level3ab'
-    MONGO_URI = "mongodb://localhost:27017/level3ab"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5005/'
-    OAUTH2_JWT_KEY = 'level3ab-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-class Level4abaDevConfig(DevConfig):
-    HOST_NAME = "level4aba"
-    ENV_NAME = "Level4aba-Dev"
-    PORT=5006
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level4aba'
-    MONGO_DBNAME = 'level4aba'
-    MONGO_URI = "mongodb://localhost:27017/level4aba"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5006/'
-    OAUTH2_JWT_KEY = 'level4aba-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-class Level4abbDevConfig(DevConfig):
-    HOST_NAME = "level4abb"
-    ENV_NAME = "Level4abb-Dev"
-    PORT=5007
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level4abb'
-    MONGO_DBNAME = 'level4abb'
-    MONGO_URI = "mongodb://localhost:27017/level4abb"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5007/'
-    OAUTH2_JWT_KEY = 'level4abb-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-
-class Level5abbaDevConfig(DevConfig):
-    HOST_NAME = "level5abba"
-    ENV_NAME = "Level5abba-Dev"
-    PORT=5008
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level5abba'
-    MONGO_DBNAME = 'level5abba'
-    MONGO_URI = "mongodb://localhost:27017/level5abba"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5008/'
-    OAUTH2_JWT_KEY = 'level5abba-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-
-class Level5abbbDevConfig(DevConfig):
-    HOST_NAME = "level5abbb"
-    ENV_NAME = "Level5abbb-Dev"
-    PORT=5009
-    MONGODB_PORT = 27017
-    MONGODB_DB = 'level5abbb'
-    MONGO_DBNAME = 'level5abbb'
-    MONGO_URI = "mongodb://localhost:27017/level5abbb"
-    # OAUth2
-    OAUTH2_JWT_ENABLED = True
-    OAUTH2_JWT_ISS = 'http://localhost:5007/'
-    OAUTH2_JWT_KEY = 'level5abbb-secret'
-    OAUTH2_JWT_ALG = 'HS256'
-    OAUTH2_JWT_EXP = 3600
-
-
-dev_config = {
-    "level1": Level1DevConfig,
-    "level2a": Level2aDevConfig,
-    "level2b": Level2bDevConfig,
-    "level3aa": Level3aaDevConfig,
-    "level3ab": Level3abDevConfig,
-    "level4aba": Level4abaDevConfig,
-    "level4abb": Level4abbDevConfig,
-    "level5abba": Level5abbaDevConfig,
-    "level5abbb": Level5abbbDevConfig
-}
-
-
-class DepConfig(BaseConfig):
-    # Deployment Environment Configurations
-    ENV_NAME = "Deployment"
+    # Maximum number of children directories requested concurrently by one directory process, shared by all requests
+    CHILDREN_REQUEST_WORKERS = 8
+    # Maximum number of thing descriptions received from children but not sent yet by a streaming search
+    SEARCH_STREAM_BUFFER_SIZE = 256
+    # Maximum number of children responses relayed concurrently to streaming search clients by one directory process
+    SEARCH_STREAM_WORKERS = 32
+    # Number of seconds a streaming search waits for a client which does not read before it ends the stream
+    SEARCH_STREAM_STALL_TIMEOUT = 30
+    # Connection pools and default timeouts (in seconds) of the HTTP client shared by inter-directory requests
+    PEER_POOL_CONNECTIONS = 16
+    PEER_POOL_MAXSIZE = 32
+    PEER_CONNECT_TIMEOUT = 3.05
+    PEER_READ_TIMEOUT = 30
+    # Seconds after which the process-local routing table is reloaded from mongodb, 0 means never
+    ROUTING_REFRESH_INTERVAL = 60
+    # Deliver push-up and aggregation updates to the parent in the background, see Droit/outbox.py
+    OUTBOX_ENABLED = True
+    OUTBOX_POLL_INTERVAL = 1
+    OUTBOX_BATCH_SIZE = 500
+    OUTBOX_RETRY_BASE = 1
+    OUTBOX_RETRY_MAX = 300
+    OUTBOX_LEASE_SECONDS = 60
+    # Size (in bits) and number of hash functions of the thing_id Bloom filters, identical in the whole tree
+    ID_FILTER_BITS = 1 << 20
+    ID_FILTER_HASHES = 7
+    # In-memory cache of search and custom_query results, validated by the subtree version, see Droit/cache.py
+    # Disabled by default: cached results may miss recent changes in the subtree for a few seconds, up to SEARCH_CACHE_TTL
+    SEARCH_CACHE_ENABLED = False
+    SEARCH_CACHE_MAX_ENTRIES = 1024
+    SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    SEARCH_CACHE_TTL = 60
+    SUBTREE_VERSION_CHECK_INTERVAL = 1
+    # Wire format asked to other directories ("bson" or "json"), and minimum size (in bytes) of the request and
+    # response bodies compressed with gzip, None means never. Requests are only compressed for directories accepting it
+    PEER_WIRE_FORMAT = "bson"
+    PEER_GZIP_MIN_SIZE = 1024
+    WIRE_GZIP_MIN_SIZE = 1024
+    # Seconds during which clients may cache the referrals returned by /api/resolve
+    RESOLVE_TTL = 300
+    # Learn the URLs of remote directories from forwarded responses and reach them directly, see Droit/referrals.py
+    REFERRAL_CACHE_ENABLED = True
+    # Seconds a learned referral is kept
+    REFERRAL_TTL = 300
+    # Seconds an unknown location or an unreachable referral is remembered
+    REFERRAL_NEGATIVE_TTL = 30
+    REFERRAL_CACHE_MAX_ENTRIES = 4096
+    # Worker processes and threads per worker of the gunicorn server, None means 2 * CPUs + 1 workers
+    SERVER_WORKERS = None
+    SERVER_THREADS = 8
+    # Seconds before a silent worker is restarted, and seconds given to workers to finish their requests on reload or stop
+    SERVER_TIMEOUT = 60
+    SERVER_GRACEFUL_TIMEOUT = 30
+    # Lock file electing the gunicorn worker that runs the background workers, None means one in the temporary directory
+    SERVER_LOCK_FILE = None
+    # In multi-tenant mode (run.py --tenants), serve the requests between co-hosted directories in-process
+    TENANT_LOCAL_CALLS = True
+    # Seconds between two reports of the coalesced type counts and subtree changes to the parent, see Droit/reports.py
+    PARENT_REPORT_INTERVAL = 1
+    # Announce the directory and its subtree to the parent when it starts, see /api/join
+    JOIN_ON_STARTUP = True
+    # Blueprints loaded at startup: 'full' serves the web pages, the dashboard and the authentication, 'api' only /api
+    STARTUP_PROFILE = 'full'
+
+# Port of a directory whose url in the topology file has none
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def make_dev_config(directory: dict) -> type:
+    """
+    Create the configuration class of a directory listed in the topology file, see Droit/topology.py
+    """
+    name = directory['name']
+    url = directory['url'].rstrip('/')
+    parts = urlsplit(url)
+    if parts.scheme not in DEFAULT_PORTS:
+        raise ValueError(f"Invalid url of directory {name} in the topology file: {directory['url']}")
+    attributes = {
+        'HOST_NAME': name,
+        'ENV_NAME': f"{name.capitalize()}-Dev",
+        # the port of the url, or the default port of its scheme
+        'PORT': parts.port or DEFAULT_PORTS[parts.scheme],
+        'DIRECTORY_URL': url,
+        # mongo engine
+        'MONGODB_DB': name,
+        # pymongo
+        'MONGO_DBNAME': name,
+        'MONGO_URI': f"mongodb://{DevConfig.MONGODB_HOST}:{DevConfig.MONGODB_PORT}/{name}",
+        # OAUth2
+        'OAUTH2_JWT_ISS': f"{url}/",
+        'OAUTH2_JWT_KEY': f"{name}-secret",
+    }
+    attributes.update(directory.get('config', {}))
+    return type(f"{name.capitalize()}DevConfig", (DevConfig,), attributes)
+
+
+# The tree of directories, the GOLDIE_TOPOLOGY environment variable selects another topology file
+TOPOLOGY_FILE = os.environ.get('GOLDIE_TOPOLOGY', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'topology.json'))
+
+with open(TOPOLOGY_FILE) as topology_file:
+    dev_config = {directory['name']: make_dev_config(directory) for directory in json.load(topology_file)['directories']}
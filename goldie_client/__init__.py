@@ -0,0 +1,10 @@
+"""
+Python client of the GOLDIE directory API
+
+Example:
+    from goldie_client import DirectoryClient
+
+    client = DirectoryClient("http://localhost:5001")
+    buses = client.search(location="level3ab", thing_type="bus")
+"""
+from .client import DirectoryClient, ReferralCache, DirectoryError
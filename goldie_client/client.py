@@ -0,0 +1,236 @@
+"""
+The client defined in this file talks to a tree of directories the way a DNS stub resolver talks to name servers.
+
+Instead of sending every request to the entry directory (usually the master), which forwards it hop by hop, the client
+resolves the target location iteratively with `/api/resolve`, caches the referral (location => URL of the directory
+responsible for it) for the TTL returned by the directory, and then sends its requests straight to that directory.
+All requests go through one pooled, keep-alive HTTP session.
+"""
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = (3.05, 30)
+DEFAULT_REFERRAL_TTL = 300
+DEFAULT_POOL_MAXSIZE = 32
+DEFAULT_MAX_WORKERS = 8
+MAX_REFERRAL_HOPS = 16
+
+
+class DirectoryError(Exception):
+    """Raised when a directory can not be reached or rejects a request
+
+    Attributes:
+        status_code (int): the HTTP status code of the response, or None if no response was received
+    """
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ReferralCache(object):
+    """Thread-safe TTL cache of location => directory URL referrals
+
+    Attributes:
+        default_ttl (float): number of seconds a referral is kept when the directory does not give a TTL
+    """
+
+    def __init__(self, default_ttl: float = DEFAULT_REFERRAL_TTL):
+        self.default_ttl = default_ttl
+        self._referrals = {}
+        self._lock = threading.Lock()
+
+    def get(self, location: str) -> str:
+        """Return the cached URL of the directory responsible for the location, or None if missing or expired
+
+        """
+        with self._lock:
+            referral = self._referrals.get(location)
+            if referral is None:
+                return None
+            url, expires_at = referral
+            if time.monotonic() >= expires_at:
+                del self._referrals[location]
+                return None
+            return url
+
+    def put(self, location: str, url: str, ttl: float = None) -> None:
+        with self._lock:
+            self._referrals[location] = (url, time.monotonic() + (self.default_ttl if ttl is None else ttl))
+
+    def invalidate(self, location: str = None) -> None:
+        """Forget the referral of the location, or every referral if location is None
+
+        """
+        with self._lock:
+            if location is None:
+                self._referrals.clear()
+            else:
+                self._referrals.pop(location, None)
+
+
+class DirectoryClient(object):
+    """Client of the directory API resolving locations iteratively
+
+    Args:
+        url (str): base URL of the entry directory, for example "http://localhost:5001"
+        referral_ttl (float): number of seconds a referral is cached when the directory does not give a TTL
+        timeout (tuple): connect and read timeouts (in seconds) of every request
+        pool_maxsize (int): maximum number of idle connections kept for each directory
+        max_workers (int): maximum number of locations queried concurrently by `search_many`
+    """
+
+    def __init__(self, url: str, referral_ttl: float = DEFAULT_REFERRAL_TTL, timeout: tuple = DEFAULT_TIMEOUT,
+                 pool_maxsize: int = DEFAULT_POOL_MAXSIZE, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.referrals = ReferralCache(referral_ttl)
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def resolve(self, location: str) -> str:
+        """Return the base URL of the directory responsible for the location
+
+        The cached referral is used if it has not expired. Otherwise the entry directory is asked first, then every
+        directory it refers to, until one of them answers for the location itself.
+
+        Args:
+            location (str): the name of the directory to be reached
+        Returns:
+            str: the base URL of the directory
+        Raises:
+            DirectoryError: if the location can not be resolved
+        """
+        url = self.referrals.get(location)
+        if url is not None:
+            return url
+        url = self.url
+        for _ in range(MAX_REFERRAL_HOPS):
+            referral = self._send('GET', f"{url}/api/resolve", params={"location": location}).json()
+            if referral["final"]:
+                self.referrals.put(location, referral["url"], referral.get("ttl"))
+                return referral["url"]
+            url = referral["url"]
+        raise DirectoryError(f"Too many referrals to resolve '{location}'")
+
+    def search(self, location: str = None, thing_type: str = None, thing_id: str = None, fields: list = None,
+               **params) -> list:
+        """Search the thing descriptions in the subtree of the location
+
+        Args:
+            location (str): the root directory of the search, the entry directory if this is missing
+            thing_type (str): optional, the type of the thing descriptions to return
+            thing_id (str): optional, the id of the thing description to return
+            fields (list): optional, the fields of the thing descriptions to return, "thing_id" is always returned
+            params: any other argument of `/api/search`
+        Returns:
+            list: the thing descriptions
+        """
+        if thing_type is not None:
+            params["thing_type"] = thing_type
+        if thing_id is not None:
+            params["thing_id"] = thing_id
+        if fields:
+            params["fields"] = ",".join(fields)
+        return self._request(location, 'GET', "/api/search", params=params).json()
+
+    def search_many(self, locations: list, **kwargs) -> dict:
+        """Search the subtrees of several locations concurrently, each one at the directory responsible for it
+
+        Args:
+            locations (list): the root directories of the searches
+            kwargs: the arguments of `search`
+        Returns:
+            dict: mapping from each location to its list of thing descriptions, or to the DirectoryError raised
+        """
+        def search_location(location):
+            try:
+                return self.search(location, **kwargs)
+            except DirectoryError as e:
+                return e
+
+        locations = list(locations)
+        if not locations:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(locations))) as executor:
+            return dict(zip(locations, executor.map(search_location, locations)))
+
+    def register(self, thing_description: dict, location: str, publicity: int = 0) -> None:
+        """Register a thing description at the location
+
+        Raises:
+            DirectoryError: if the registration failed
+        """
+        body = {"td": thing_description, "location": location, "publicity": publicity}
+        self._request(location, 'POST', "/api/register", data=json.dumps(body),
+                      headers={'Content-Type': 'application/json'})
+
+    def delete(self, thing_id: str, location: str) -> None:
+        """Delete the thing description from the location
+
+        Raises:
+            DirectoryError: if the deletion failed
+        """
+        self._request(location, 'DELETE', "/api/delete", params={"location": location, "thing_id": thing_id})
+
+    def custom_query(self, operation: str, thing_type: str, data: str = None, location: str = None,
+                     filters: dict = None) -> dict:
+        """Aggregate the thing descriptions of a type in the subtree of the location
+
+        Args:
+            operation (str): one of "COUNT", "SUM", "AVG", "MIN" and "MAX"
+            thing_type (str): the type of the aggregated thing descriptions
+            data (str): the aggregated field, for example "properties.speed.value", required except for "COUNT"
+            location (str): the root directory of the aggregation, the entry directory if this is missing
+            filters (dict): optional, the filter conditions of `/api/custom_query`
+        Returns:
+            dict: {"operation": ..., "result": ...}
+        """
+        script = {"operation": operation, "type": thing_type}
+        if data is not None:
+            script["data"] = data
+        if location is not None:
+            script["location"] = location
+        if filters:
+            script["filter"] = filters
+        return self._request(location, 'GET', "/api/custom_query", params={"data": json.dumps(script)}).json()
+
+    def _request(self, location: str, method: str, api: str, **kwargs) -> requests.Response:
+        # requests go straight to the directory responsible for the location. If it can not be reached with a cached
+        # referral, the referral may be stale: resolve the location again and retry once
+        if location is None:
+            return self._send(method, f"{self.url}{api}", **kwargs)
+        cached = self.referrals.get(location) is not None
+        try:
+            return self._send(method, f"{self.resolve(location)}{api}", **kwargs)
+        except DirectoryError:
+            if not cached:
+                raise
+            self.referrals.invalidate(location)
+            return self._send(method, f"{self.resolve(location)}{api}", **kwargs)
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            raise DirectoryError(f"{url} is not reachable: {e}")
+        if response.status_code != 200:
+            raise DirectoryError(f"{method} {url} failed with HTTP status {response.status_code}", response.status_code)
+        return response
@@ -1,30 +1,125 @@
+import time
+# the cold start of the directory is measured from here, see Droit/startup.py
+STARTED_AT = time.perf_counter()
+
 import click
 from flask_mongoengine import MongoEngine
-from Droit import create_app
-from Droit.auth.models import auth_db
-from Droit.databases import init_dir_to_url, init_target_to_child_name, clear_database
+from Droit import create_app, PROFILES
+from Droit.databases import init_routing_collections, clear_database
 from Droit.databases import mongo
-from Droit.auth.oauth2 import oauth, config_oauth, initiate_providers
-from config import dev_config
+from Droit.peers import peer_session
+from Droit.fanout import init_children_executors
+from Droit.routing import init_routing_table
+from Droit.outbox import outbox
+from Droit.rebuild import start_rebuild, reset_pending_writes
+from Droit.server import run_server
+from Droit.tenants import serve_tenants
+from Droit.topology import Topology
+from Droit.views.api import announce_to_parent
+from Droit.startup import record_startup, format_startup
+from config import dev_config, TOPOLOGY_FILE
 
 @click.command()
 @click.option('--init-db', default=True, type=bool, help="Clean previous data and insert URL mappings into database.\nBy default it's True")
-@click.option('--debug', default=True, type=bool, help="Use Debug Mode.\nBy default it's True.")
+@click.option('--warm', default=False, type=bool, help="Warm restart: keep the thing descriptions of the previous run and rebuild the derived state in the background.\nIf it is True, '--init-db' is ignored. By default it's False.")
+@click.option('--debug', default=False, type=bool, help="Use Debug Mode of the development server.\nBy default it's False.")
 @click.option('--host', default='localhost', type=str, help="The host that this app is running on.\n By default it is localhost")
-@click.option('--level', default='level1', type=click.Choice(['level1','level2a','level2b','level3aa','level3ab','level4aba','level4abb','level5abba','level5abbb'], case_sensitive=False), 
+@click.option('--level', default='level1', type=click.Choice(list(dev_config), case_sensitive=False), 
                     help = "Specify which directory to run.\nBy default its the level1.\n If the mode is 'all', this argument will be ignored.")
-def main(level, init_db, debug, host):
+@click.option('--server', default='dev', type=click.Choice(['dev', 'gunicorn'], case_sensitive=False),
+                    help="The server to run the app with: the Werkzeug development server, or gunicorn with several worker processes.\nBy default it's dev.")
+@click.option('--workers', default=None, type=int, help="Number of gunicorn worker processes.\nBy default it's SERVER_WORKERS of the config, or 2 * CPUs + 1.")
+@click.option('--threads', default=None, type=int, help="Number of threads of each gunicorn worker process.\nBy default it's SERVER_THREADS of the config.")
+@click.option('--profile', default=None, type=click.Choice(PROFILES, case_sensitive=False),
+                    help="Startup profile: 'full' serves the web pages, the dashboard and the authentication, 'api' only serves /api and skips their imports.\nBy default it's STARTUP_PROFILE of the config.")
+@click.option('--tenants', default=None, type=str,
+                    help="Comma-separated levels to host together in this process, or 'all'. Each one listens on its own port and requests between them skip the network.\nIf it is given, '--level' and '--server' are ignored.")
+def main(level, init_db, warm, debug, host, server, workers, threads, profile, tenants):
     """
     Load all configurations for the application, and then start running
     """
-    app = create_app()
-    # initialize Flask app
+    if tenants:
+        # host several directories in this process, see Droit/tenants.py
+        levels = list(dev_config) if tenants == 'all' else [name.strip() for name in tenants.split(',')]
+        unknown_levels = [name for name in levels if name not in dev_config]
+        if unknown_levels:
+            raise click.BadParameter(f"unknown levels {', '.join(unknown_levels)}", param_hint='--tenants')
+        topology = Topology.load(TOPOLOGY_FILE)
+        apps = []
+        for name in levels:
+            # each co-hosted directory is measured from the end of the previous one, the memory is the one of the whole process
+            started_at = STARTED_AT if not apps else time.perf_counter()
+            apps.append(create_directory_app(name, init_db, topology, tenant=True, warm=warm, profile=profile))
+            click.echo(format_startup(name, record_startup(apps[-1], started_at, apps[-1].config['STARTUP_PROFILE'])))
+        serve_tenants(apps, host, on_start=start_background_workers)
+        return
+
+    app = create_directory_app(level, init_db, Topology.load(TOPOLOGY_FILE), warm=warm, profile=profile)
+    click.echo(format_startup(level, record_startup(app, STARTED_AT, app.config['STARTUP_PROFILE'])))
+    if server == 'gunicorn':
+        # the background workers run in one gunicorn worker process, see Droit/server.py
+        run_server(app, host, app.config["PORT"], workers, threads, on_elected=start_background_workers)
+        return
+    start_background_workers(app)
+    app.run(debug = debug, host= host, port= app.config["PORT"])
+
+
+def create_directory_app(level, init_db, topology, tenant=False, warm=False, profile=None):
+    """
+    Create the app of the 'level' directory and initialize its database, with the routing collections derived from 'topology'
+
+    If 'tenant' is True, the app is hosted with other directories in this process and uses its own mongodb connection alias
+    If 'warm' is True, the database of the previous run is kept, see Droit/rebuild.py
+    'profile' selects the blueprints to load, STARTUP_PROFILE of the config if it is None, see Droit/__init__.py
+    """
     app_config = dev_config[level]
+    profile = profile or getattr(app_config, 'STARTUP_PROFILE', 'full')
+    app = create_app(profile)
+    # initialize Flask app
     app.config.update(**app_config.to_dict())
+    app.config['STARTUP_PROFILE'] = profile
+    if tenant:
+        app.config['MONGODB_ALIAS'] = level
+    app.config['WARM_RESTART'] = warm
 
     # initialize db connections for mongo engine, and pymongo
     mongo_db = MongoEngine(app)
-    mongo.init_app(app)
+    if not tenant:
+        # the pymongo client is not used by the views, co-hosted directories share the client of mongoengine
+        mongo.init_app(app)
+    # initialize the pooled HTTP client used to talk to other directories
+    peer_session.init_app(app)
+    # initialize the thread pools sending the requests of this directory to its children
+    init_children_executors(app)
+    if profile == 'full':
+        init_auth(app, level, create_tables=init_db or warm)
+
+    with app.app_context():
+        if warm:
+            # keep the thing descriptions, and the directories that joined at runtime
+            init_routing_collections(level, topology, replace=False)
+            reset_pending_writes()
+        elif init_db:
+            # Initialize IoT related tables in MongoDB
+            clear_database()
+            init_routing_collections(level, topology)
+        # load the routing collections into the process-local routing table
+        init_routing_table(app)
+    if app.config.get('JOIN_ON_STARTUP', False):
+        # report this directory to its parent, whose routing collections may not list it yet
+        with app.test_request_context():
+            announce_to_parent()
+    return app
+
+
+def init_auth(app, level, create_tables):
+    """
+    Initialize OAuth 2.0 and OpenID Connect 1.0 for the 'level' directory, and create the tables of the authentication if 'create_tables' is True
+    """
+    # imported here, so the 'api' profile does not load Authlib and Flask-SQLAlchemy
+    from Droit.auth.models import auth_db
+    from Droit.auth.oauth2 import oauth, config_oauth, initiate_providers
+
     # initialize flask-sqlalchemy used by OAuth 2.0 and OpenID Connect 1.0
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///./{level}.db'
     auth_db.init_app(app)
@@ -32,17 +127,21 @@ def main(level, init_db, debug, host):
     oauth.init_app(app)
     config_oauth(app)
     initiate_providers(level)
-    
-    if init_db:
+    if create_tables:
         with app.app_context():
             # Create all tables for authentication
             auth_db.create_all()
-        # Initialize IoT related tables in MongoDB
-        clear_database()
-        init_dir_to_url(level)
-        init_target_to_child_name(level)
-    app.run(debug = debug, host= host, port= app.config["PORT"])
-    
+
+
+def start_background_workers(app):
+    """
+    Start delivering propagation events to the parent directory in the background, and rebuilding the derived state after a warm restart
+    """
+    outbox.start(app)
+    if app.config.get('WARM_RESTART', False):
+        start_rebuild(app)
+
+
 if __name__ == "__main__":
     main()
     
\ No newline at end of file
@@ -3,8 +3,9 @@ Starting scripts for running all directories all together.
 
 """
 import subprocess
+from config import dev_config
 
-level_names = ["level1", "level2a", "level2b", "level3aa", "level3ab", "level4aba", "level4abb", "level5abba", "level5abbb"]
+level_names = list(dev_config)
 
 processes = [subprocess.Popen(["python", "./run.py", "--level", level_name]) for level_name in level_names]
 